@@ -1,22 +1,23 @@
 import argparse
 import os
 from collections import defaultdict
-from typing import Literal, cast, get_args
+from typing import TYPE_CHECKING, Literal
 
-import logfire
-from pydantic_ai.models import KnownModelName
+from ai_framework_demo.model_names import KNOWN_MODEL_NAMES
 
-from ai_framework_demo.langchain.agent import LangchainAgentRunner
-from ai_framework_demo.pydanticai.agent import PydanticAIAgentRunner
-from ai_framework_demo.run_agent import run_agent
+if TYPE_CHECKING:
+    from ai_framework_demo.run_agent import AgentRunner
 
-FrameworkChoice = Literal["langchain", "pydanticai"]
+# Frameworks, provider SDKs and logfire are imported by load_runner_class() once the framework has been chosen,
+# since importing them all takes seconds (which is paid by every process, even just to show the help text)
+
+FrameworkChoice = Literal["langchain", "langgraph", "pydanticai"]
 
 
 def format_model_options() -> str:
     # Group models by provider
     grouped: defaultdict[str, list[str]] = defaultdict(list)
-    for item in cast(tuple[KnownModelName], get_args(KnownModelName)):
+    for item in KNOWN_MODEL_NAMES:
         if item == "test" or item.startswith("google-vertex"):
             continue
         provider, model = item.split(":")
@@ -27,13 +28,15 @@ def format_model_options() -> str:
     return "\n".join(formatted_lines)
 
 
-def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description="AI Framework Demo - Compare Langchain and PydanticAI implementations")
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="AI Framework Demo - Compare Langchain, LangGraph and PydanticAI implementations"
+    )
 
     parser.add_argument(
         "framework",
         type=str,
-        choices=["langchain", "pydanticai"],
+        choices=["langchain", "langgraph", "pydanticai"],
         default="pydanticai",
         help="Which framework to use (default: pydanticai)",
     )
@@ -54,6 +57,98 @@ def parse_args() -> argparse.Namespace:
         # Don't strictly enforce choices since new models may be added
     )
 
+    parser.add_argument(
+        "--fallback-models",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Models to fall back to (in order) when a request to the model fails, which are tried first while the "
+        "model is unavailable. Models of other providers than the model use their provider's API key environment "
+        "variable",
+        metavar="PROVIDER:MODEL",
+    )
+
+    parser.add_argument(
+        "--cheap-model",
+        type=str,
+        default=None,
+        help="Cheaper model for simple turns (e.g. greetings and questions about the menu), with turns which order "
+        "something sent to the model",
+        metavar="PROVIDER:MODEL",
+    )
+
+    parser.add_argument(
+        "--hedge-requests",
+        action="store_true",
+        help="Also send a request to the next fallback model when the first model has taken longer than its p95 "
+        "latency to respond, using whichever response arrives first",
+    )
+
+    parser.add_argument(
+        "--model-cooldown",
+        type=float,
+        default=30,
+        help="Seconds for which a model is tried after the others once a request to it has failed (default: 30)",
+    )
+
+    parser.add_argument(
+        "--call-timeout",
+        type=float,
+        default=60,
+        help="Seconds after which a model request is abandoned and retried (default: 60, 0 for no timeout)",
+    )
+
+    parser.add_argument(
+        "--turn-timeout",
+        type=float,
+        default=180,
+        help="Seconds after which a conversation turn fails, including any retries (default: 180, 0 for no timeout)",
+    )
+
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=2,
+        help="Retries of model requests which failed with a transient error (e.g. a timeout, rate limit or server "
+        "error), with jittered exponential backoff (default: 2)",
+    )
+
+    parser.add_argument(
+        "--turn-retries",
+        type=int,
+        default=1,
+        help="Retries of turns which failed with a transient error, which are only made if the turn hadn't created "
+        "an order (default: 1)",
+    )
+
+    parser.add_argument(
+        "--circuit-breaker-failures",
+        type=int,
+        default=5,
+        help="Consecutive failed requests to a provider after which its requests fail fast (default: 5)",
+    )
+
+    parser.add_argument(
+        "--circuit-breaker-reset",
+        type=float,
+        default=30,
+        help="Seconds after which a request to a provider whose requests are failing fast is tried again (default: 30)",
+    )
+
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=None,
+        help="Model request rate limit of each provider API key (default: unlimited)",
+    )
+
+    parser.add_argument(
+        "--tokens-per-minute",
+        type=float,
+        default=None,
+        help="Model token rate limit of each provider API key (default: unlimited)",
+    )
+
     parser.add_argument(
         "--api-key",
         type=str,
@@ -69,6 +164,21 @@ def parse_args() -> argparse.Namespace:
         help="Name of the restaurant (default: Le Bistro)",
     )
 
+    parser.add_argument(
+        "--tenants-dir",
+        type=str,
+        default=None,
+        help="Directory of restaurants to serve, each a JSON or TOML file named after its tenant ID with its "
+        "restaurant_name and menu (mapping category to item descriptions)",
+    )
+
+    parser.add_argument(
+        "--tenant",
+        type=str,
+        default=None,
+        help="ID of the restaurant in --tenants-dir to serve, instead of --restaurant-name with the default menu",
+    )
+
     parser.add_argument(
         "--table-number",
         type=int,
@@ -76,7 +186,251 @@ def parse_args() -> argparse.Namespace:
         help="Table number for the order (default: 1)",
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--orders-db",
+        type=str,
+        default=None,
+        help="Path of a SQLite database to store orders in, instead of keeping them in memory",
+    )
+
+    parser.add_argument(
+        "--order-events-socket",
+        type=str,
+        default=None,
+        help="Path of a Unix socket to serve order events on as soon as orders are created, e.g. to a kitchen display "
+        "(python -m ai_framework_demo.kitchen)",
+    )
+
+    parser.add_argument(
+        "--checkpoint-db",
+        type=str,
+        default=None,
+        help="Path of a SQLite database to store LangGraph conversation checkpoints in, so conversations can be "
+        "resumed with --thread-id (default: kept in memory)",
+    )
+
+    parser.add_argument(
+        "--thread-id",
+        type=str,
+        default=None,
+        help="ID of the LangGraph conversation thread to resume from the checkpoint database "
+        "(default: start a new thread)",
+    )
+
+    parser.add_argument(
+        "--snapshot-dir",
+        type=str,
+        default=None,
+        help="Directory to append a compact snapshot of each table's session to after every turn. A table's session "
+        "is restored from its snapshot when it is started again, e.g. by another process after a restart",
+    )
+
+    parser.add_argument(
+        "--memory-max-tokens",
+        type=int,
+        default=None,
+        help="Approximate token budget of the conversation history sent with each request, "
+        "older turns are dropped when it is exceeded (default: unbounded, the whole history is sent)",
+    )
+
+    parser.add_argument(
+        "--memory-drop-stale-tool-results",
+        action="store_true",
+        help="Replace results of tools which were called again later in the conversation with a placeholder",
+    )
+
+    parser.add_argument(
+        "--memory-summarise",
+        action="store_true",
+        help="Summarise conversation turns dropped from the history with the LLM, instead of discarding them",
+    )
+
+    parser.add_argument(
+        "--max-conversation-tokens",
+        type=int,
+        default=None,
+        help="Token budget of each conversation. Conversations which have spent half of their budget (or their "
+        "table's) have their history compacted, from 80%% their turns go to --cheap-model (if given), and once it is "
+        "spent the conversation is ended",
+    )
+
+    parser.add_argument(
+        "--max-conversation-cost",
+        type=float,
+        default=None,
+        help="Budget of each conversation in USD, estimated from the list prices of the models",
+    )
+
+    parser.add_argument(
+        "--max-table-tokens",
+        type=int,
+        default=None,
+        help="Token budget of all conversations of each table in the process",
+    )
+
+    parser.add_argument(
+        "--max-table-cost",
+        type=float,
+        default=None,
+        help="Budget of all conversations of each table in the process in USD",
+    )
+
+    parser.add_argument(
+        "--usage-export",
+        type=str,
+        default=None,
+        help="Path of a JSON file to write the token usage and estimated cost of the process to as conversations run, "
+        "by model, table and active conversation",
+    )
+
+    parser.add_argument(
+        "--response-cache",
+        action="store_true",
+        help="Serve repeated model requests (e.g. greetings and menu questions) from a cache of previous responses. "
+        "Requests in a turn which has created an order are never served from the cache",
+    )
+
+    parser.add_argument(
+        "--response-cache-path",
+        type=str,
+        default=None,
+        help="Path of a SQLite database to store cached responses in, instead of keeping them in memory",
+    )
+
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=3600,
+        help="Seconds after which cached responses expire (default: 3600)",
+    )
+
+    parser.add_argument(
+        "--response-cache-max-entries",
+        type=int,
+        default=1024,
+        help="Maximum number of cached responses, least recently used responses are evicted (default: 1024)",
+    )
+
+    parser.add_argument(
+        "--response-cache-similarity",
+        type=float,
+        default=1.0,
+        help="Minimum similarity ratio (0-1) of a user message to a cached message for its response to be used, "
+        "after normalising case, punctuation and whitespace (default: 1.0, exact matches only)",
+    )
+
+    parser.add_argument(
+        "--http-max-connections",
+        type=int,
+        default=100,
+        help="Maximum number of HTTP connections shared by all model clients (default: 100)",
+    )
+
+    parser.add_argument(
+        "--http-max-keepalive-connections",
+        type=int,
+        default=20,
+        help="Maximum number of idle HTTP connections kept alive for re-use (default: 20)",
+    )
+
+    parser.add_argument(
+        "--http2",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Use HTTP/2 for model clients which support it, if the h2 package is installed (default: enabled)",
+    )
+
+    parser.add_argument(
+        "--structured-output",
+        type=str,
+        choices=["auto", "native", "tool"],
+        default="auto",
+        help="How LangChain and LangGraph agents get the structured response from the model: with a JSON schema "
+        "response format (native), or by forcing it to call a response tool (tool). The default (auto) uses native "
+        "structured output where the provider supports it alongside tool calling (OpenAI), otherwise the tool",
+    )
+
+    parser.add_argument(
+        "--intent-router",
+        action="store_true",
+        help="Answer turns which need no model (requests for the menu and questions about dietary requirements) "
+        "directly from the menu service",
+    )
+
+    parser.add_argument(
+        "--speculate",
+        action="store_true",
+        help="Call the read-only tools the model is likely to need in the next turn (e.g. get_menu after the greeting) "
+        "while waiting for the user, adding their results to its context so it can answer without calling them",
+    )
+
+    parser.add_argument(
+        "--speculative-tools",
+        nargs="+",
+        default=None,
+        metavar="TURN:TOOL",
+        help="Tools to call speculatively before each turn, in addition to those learned from the model's tool calls "
+        "(default: 1:get_menu, i.e. the first turn after the greeting)",
+    )
+
+    parser.add_argument(
+        "--warm-up",
+        action="store_true",
+        help="Open connections to the model provider at startup, so the first response isn't delayed by it",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Trace each turn and print a summary of where its time and tokens went at the end of the conversation",
+    )
+
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default=None,
+        help="Path of a JSON Lines file to append the spans of each traced turn to",
+    )
+
+    parser.add_argument(
+        "--otlp-endpoint",
+        type=str,
+        default=None,
+        help="OTLP/HTTP endpoint of an OpenTelemetry collector to export the spans of each traced turn to "
+        "(e.g. http://localhost:4318/v1/traces)",
+    )
+
+    return parser
+
+
+def parse_args() -> argparse.Namespace:
+    return build_parser().parse_args()
+
+
+def load_runner_class(args: argparse.Namespace) -> "type[AgentRunner]":
+    """Import the agent runner of the chosen framework, configuring it for the process"""
+    if args.framework == "pydanticai":
+        import logfire
+
+        from ai_framework_demo.pydanticai.agent import PydanticAIAgentRunner
+
+        logfire.configure(send_to_logfire="if-token-present", console=None if args.debug else False)
+        return PydanticAIAgentRunner
+    elif args.framework == "langchain":
+        # Logfire registers a Pydantic plugin, which would otherwise import it when the first model is defined
+        os.environ.setdefault("PYDANTIC_DISABLE_PLUGINS", "logfire-plugin")
+
+        from ai_framework_demo.langchain.agent import LangchainAgentRunner
+
+        return LangchainAgentRunner
+    elif args.framework == "langgraph":
+        os.environ.setdefault("PYDANTIC_DISABLE_PLUGINS", "logfire-plugin")
+
+        from ai_framework_demo.langchain.graph import LangGraphAgentRunner
+
+        return LangGraphAgentRunner
+    else:
+        raise ValueError(f"Invalid framework: {args.framework}")
 
 
 def main() -> None:
@@ -89,13 +443,11 @@ def main() -> None:
             "API key must be provided either via --api-key argument or OPENAI_API_KEY environment variable"
         )
 
-    if args.framework == "pydanticai":
-        logfire.configure(send_to_logfire="if-token-present", console=None if args.debug else False)
-        run_agent(PydanticAIAgentRunner, args)
-    elif args.framework == "langchain":
-        run_agent(LangchainAgentRunner, args)
-    else:
-        raise ValueError(f"Invalid framework: {args.framework}")
+    runner_class = load_runner_class(args)
+
+    from ai_framework_demo.run_agent import run_agent
+
+    run_agent(runner_class, args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import statistics
+from pathlib import Path
+
+from rich.console import Console
+from rich.progress import Progress
+from rich.table import Table
+
+from ai_framework_demo.__main__ import build_parser, load_runner_class
+from ai_framework_demo.batch.evaluation import (
+    BatchEvaluation,
+    EvalResult,
+    read_conversations,
+    replay_scripted_conversations,
+)
+from ai_framework_demo.usage import TurnUsage
+
+
+def parse_args() -> argparse.Namespace:
+    parser = build_parser()
+    parser.description = (
+        "Run a batch of scripted conversations through an agent concurrently, e.g. to regression test its behaviour "
+        "with guest personas, writing the outcome of each conversation to a JSONL file"
+    )
+    batch_group = parser.add_argument_group("batch evaluation")
+    batch_group.add_argument(
+        "--input",
+        type=Path,
+        default=None,
+        help='JSONL file of conversations to run, each a JSON object like {"id": "vegan-1", "user_messages": [...]} '
+        'with optional "model" and "table_number" overrides',
+    )
+    batch_group.add_argument(
+        "--replay-scripted",
+        type=int,
+        default=0,
+        metavar="COPIES",
+        help="Instead of an input file, replay this many copies of each built-in scripted conversation with the "
+        "offline stand-in model (no API key required)",
+    )
+    batch_group.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="Latency to inject into each request of replayed scripted conversations (default: 0)",
+    )
+    batch_group.add_argument(
+        "--output",
+        type=Path,
+        required=True,
+        help="JSONL file to append the result of each conversation to. "
+        "Conversations which already have a result in it are skipped, so an interrupted run can be resumed",
+    )
+    batch_group.add_argument(
+        "--concurrency", type=int, default=32, help="Number of conversations to run at the same time (default: 32)"
+    )
+    args = parser.parse_args()
+    if (args.input is None) == (not args.replay_scripted):
+        parser.error("exactly one of --input or --replay-scripted must be provided")
+    return args
+
+
+def build_summary_table(results: list[EvalResult]) -> Table:
+    table = Table(title="Batch evaluation, latencies in ms")
+    columns = (
+        "convs",
+        "errors",
+        "ended",
+        "orders",
+        "turns",
+        "req/turn",
+        "tok/conv",
+        "turn p50",
+        "turn max",
+        "conv p50",
+    )
+    for column in columns:
+        table.add_column(column, justify="right")
+
+    successful = [result for result in results if result.error is None]
+    turns = sum(result.turns for result in successful)
+    usage = sum((result.usage for result in successful), TurnUsage())
+    turn_latencies = [latency for result in successful for latency in result.turn_latency_ms]
+    table.add_row(
+        str(len(results)),
+        str(len(results) - len(successful)),
+        str(sum(result.ended for result in successful)),
+        str(sum(len(result.orders) for result in successful)),
+        # Per conversation
+        f"{turns / len(successful):.2f}" if successful else "-",
+        f"{usage.requests / turns:.2f}" if turns else "-",
+        f"{(usage.input_tokens + usage.output_tokens) / len(successful):.0f}" if successful else "-",
+        f"{statistics.median(turn_latencies):.1f}" if turn_latencies else "-",
+        f"{max(turn_latencies):.1f}" if turn_latencies else "-",
+        f"{statistics.median(result.latency_ms for result in successful):.1f}" if successful else "-",
+    )
+    return table
+
+
+async def run_batch(args: argparse.Namespace) -> list[EvalResult]:
+    conversations = (
+        replay_scripted_conversations(args.replay_scripted, args.latency_ms)
+        if args.replay_scripted
+        else read_conversations(args.input)
+    )
+    with Progress(transient=True) as progress:
+        task = progress.add_task("Conversations", total=None)
+        evaluation = BatchEvaluation(
+            load_runner_class(args),
+            args,
+            args.output,
+            concurrency=args.concurrency,
+            on_result=lambda _: progress.advance(task),
+        )
+        return await evaluation.run(conversations)
+
+
+def main() -> None:
+    args = parse_args()
+    results = asyncio.run(run_batch(args))
+    console = Console()
+    console.print(build_summary_table(results))
+    console.print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
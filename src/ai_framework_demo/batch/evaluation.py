@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import json
+import time
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, TextIO
+
+from ai_framework_demo.run_agent import AgentRunner, build_agent_runner
+from ai_framework_demo.scripted import GREETING_MESSAGE, SCRIPTED_CONVERSATIONS
+from ai_framework_demo.services import MenuService, OrderService
+from ai_framework_demo.usage import TurnUsage
+
+
+@dataclass
+class EvalConversation:
+    """A conversation of scripted user turns to run through an agent, read from a line of the input JSONL file"""
+
+    id: str
+    user_messages: list[str]
+    # Model to use instead of the one in the CLI arguments, e.g. a scripted model for this conversation
+    model: str | None = None
+    table_number: int = 1
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "EvalConversation":
+        return cls(
+            id=str(data["id"]),
+            user_messages=list(data["user_messages"]),
+            model=data.get("model"),
+            table_number=data.get("table_number", 1),
+        )
+
+
+@dataclass
+class EvalResult:
+    """Outcome of running a conversation, written as a line of the output JSONL file"""
+
+    id: str
+    model: str
+    turns: int = 0
+    ended: bool = False
+    responses: list[str] = field(default_factory=list)
+    # Items of each order created by the agent
+    orders: list[list[str]] = field(default_factory=list)
+    usage: TurnUsage = field(default_factory=TurnUsage)
+    turn_latency_ms: list[float] = field(default_factory=list)
+    latency_ms: float = 0
+    error: str | None = None
+
+
+def read_conversations(path: Path) -> Iterator[EvalConversation]:
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield EvalConversation.from_dict(json.loads(line))
+
+
+def replay_scripted_conversations(copies: int, latency_ms: float = 0) -> Iterator[EvalConversation]:
+    """Conversations replaying each scripted conversation with its deterministic stand-in model, `copies` times"""
+    for index in range(copies):
+        for conversation in SCRIPTED_CONVERSATIONS.values():
+            yield EvalConversation(
+                id=f"{conversation.name}-{index}",
+                user_messages=conversation.user_messages,
+                model=f"scripted:{conversation.name}@{latency_ms}",
+            )
+
+
+def load_completed_ids(results_path: Path) -> set[str]:
+    """
+    Get the IDs of conversations which have already been run successfully, from the results of an interrupted run.
+    A partially written last line is removed, so further results can be appended.
+    """
+    if not results_path.exists():
+        return set()
+    content = results_path.read_bytes()
+    if content and not content.endswith(b"\n"):
+        content = content[: content.rfind(b"\n") + 1]
+        with open(results_path, "r+b") as file:
+            file.truncate(len(content))
+    completed = set()
+    for line in content.splitlines():
+        result = json.loads(line)
+        # Conversations which failed are run again, so the last result of each conversation is the one to use
+        if result.get("error") is None:
+            completed.add(result["id"])
+        else:
+            completed.discard(result["id"])
+    return completed
+
+
+class BatchEvaluation:
+    """
+    Runs many scripted conversations through an agent concurrently, appending the result of each to a JSONL file
+    as soon as it has finished. Conversations which already have a result are skipped, so an interrupted run
+    can be resumed (conversations which were in progress are run again from the start).
+    """
+
+    def __init__(
+        self,
+        runner_class: type[AgentRunner],
+        args: argparse.Namespace,
+        results_path: Path,
+        concurrency: int = 32,
+        on_result: Callable[[EvalResult], None] | None = None,
+    ):
+        self.runner_class = runner_class
+        self.args = args
+        self.results_path = results_path
+        self.concurrency = concurrency
+        self.on_result = on_result
+        # Read-only, so shared by all conversations
+        self.menu_service = MenuService()
+        self.results: list[EvalResult] = []
+
+    async def run(self, conversations: Iterable[EvalConversation]) -> list[EvalResult]:
+        """Run the conversations which have not been completed yet, returning their results"""
+        completed_ids = load_completed_ids(self.results_path)
+        pending = (conversation for conversation in conversations if conversation.id not in completed_ids)
+        with open(self.results_path, "a") as results_file:
+            # Each worker takes the next pending conversation when it has finished its previous one
+            await asyncio.gather(*(self._run_worker(pending, results_file) for _ in range(self.concurrency)))
+        return self.results
+
+    async def _run_worker(self, conversations: Iterator[EvalConversation], results_file: TextIO) -> None:
+        for conversation in conversations:
+            result = await self.run_conversation(conversation)
+            results_file.write(json.dumps(asdict(result)) + "\n")
+            results_file.flush()
+            self.results.append(result)
+            if self.on_result is not None:
+                self.on_result(result)
+
+    async def run_conversation(self, conversation: EvalConversation) -> EvalResult:
+        model = conversation.model or self.args.model
+        args = argparse.Namespace(**(vars(self.args) | {"model": model, "table_number": conversation.table_number}))
+        # Each conversation has its own order service, so its orders can be told apart
+        order_service = OrderService()
+        result = EvalResult(id=conversation.id, model=model)
+        start = time.perf_counter()
+        runner = None
+        try:
+            runner = build_agent_runner(self.runner_class, self.menu_service, order_service, args, conversation.id)
+            for user_message in [GREETING_MESSAGE, *conversation.user_messages]:
+                await self._run_turn(runner, user_message, result)
+                if result.ended:
+                    break
+        except Exception as e:
+            result.error = repr(e)
+        finally:
+            if runner is not None:
+                runner.close()
+        result.latency_ms = (time.perf_counter() - start) * 1000
+        result.orders = [order.menu_items for order in order_service.get_orders()]
+        return result
+
+    async def _run_turn(self, runner: AgentRunner, user_message: str, result: EvalResult) -> None:
+        start = time.perf_counter()
+        turns_before = len(runner.turn_usage)
+        try:
+            response = await runner.make_request_async(user_message)
+        finally:
+            result.usage += runner.turn_usage[-1] if len(runner.turn_usage) > turns_before else TurnUsage()
+        result.turn_latency_ms.append((time.perf_counter() - start) * 1000)
+        result.turns += 1
+        result.responses.append(response.message)
+        result.ended = response.end_conversation
@@ -0,0 +1,182 @@
+import argparse
+import asyncio
+import json
+import sys
+import tracemalloc
+from pathlib import Path
+
+from rich.console import Console
+from rich.table import Table
+
+from ai_framework_demo.bench.conversations import BenchResult, run_scripted_conversation
+from ai_framework_demo.langchain.agent import LangchainAgentRunner
+from ai_framework_demo.langchain.graph import LangGraphAgentRunner
+from ai_framework_demo.pydanticai.agent import PydanticAIAgentRunner
+from ai_framework_demo.run_agent import AgentRunner
+from ai_framework_demo.scripted import SCRIPTED_CONVERSATIONS, load_scripted_conversations
+
+RUNNERS: dict[str, type[AgentRunner]] = {
+    "pydanticai": PydanticAIAgentRunner,
+    "langchain": LangchainAgentRunner,
+    "langgraph": LangGraphAgentRunner,
+}
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarise(result: BenchResult) -> dict[str, float]:
+    durations = [turn.duration * 1000 for turn in result.turns]
+    overheads = [turn.overhead * 1000 for turn in result.turns]
+    summary = {
+        "turns": len(result.turns),
+        "model_requests_per_turn": sum(turn.model_requests for turn in result.turns) / len(result.turns),
+        "model_requests_per_conv": sum(turn.model_requests for turn in result.turns) / result.conversations,
+        "turn_p50_ms": percentile(durations, 50),
+        "turn_p99_ms": percentile(durations, 99),
+        "overhead_p50_ms": percentile(overheads, 50),
+        "overhead_p99_ms": percentile(overheads, 99),
+    }
+    peaks = [turn.peak_allocated_bytes for turn in result.turns if turn.peak_allocated_bytes is not None]
+    if peaks:
+        summary["peak_allocated_kib_p50"] = percentile([peak / 1024 for peak in peaks], 50)
+    return summary
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the per-turn overhead of each agent implementation, "
+        "by replaying scripted conversations with a deterministic stand-in model (no API key or network required)"
+    )
+    parser.add_argument("--runners", nargs="+", choices=list(RUNNERS), default=list(RUNNERS))
+    parser.add_argument(
+        "--conversations",
+        nargs="+",
+        default=None,
+        help="Names of the scripted conversations to replay (default: all)",
+    )
+    parser.add_argument(
+        "--conversations-file",
+        type=Path,
+        default=None,
+        help="JSON file of additional recorded conversations to load",
+    )
+    parser.add_argument("--iterations", type=int, default=20, help="Times to replay each conversation (default: 20)")
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="Latency to inject into each model request (default: 0)"
+    )
+    parser.add_argument(
+        "--trace-allocations",
+        action="store_true",
+        help="Measure peak memory allocated per turn with tracemalloc (slows down execution)",
+    )
+    parser.add_argument(
+        "--structured-output",
+        choices=["auto", "native", "tool"],
+        default="auto",
+        help="Structured output mode of the LangChain and LangGraph agents (default: auto, which is native). Both "
+        "modes make the same model requests per turn, and only differ in the overhead of the forced response tool call",
+    )
+    parser.add_argument(
+        "--intent-router",
+        action="store_true",
+        help="Answer turns which need no model from the services, to compare model requests per conversation",
+    )
+    parser.add_argument(
+        "--speculate",
+        action="store_true",
+        help="Call likely read-only tools ahead of each turn, to compare model requests per conversation",
+    )
+    parser.add_argument("--json", type=Path, default=None, help="Write results to this JSON file")
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="JSON results of a previous run to compare against, failing if p50 overhead regresses",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.25,
+        help="Maximum allowed relative increase in p50 overhead compared to the baseline (default: 0.25)",
+    )
+    return parser.parse_args()
+
+
+async def run_benchmarks(args: argparse.Namespace) -> dict[str, BenchResult]:
+    conversations = [SCRIPTED_CONVERSATIONS[name] for name in args.conversations or SCRIPTED_CONVERSATIONS]
+    latency = args.latency_ms / 1000
+    results: dict[str, BenchResult] = {}
+    for runner_name in args.runners:
+        runner_class = RUNNERS[runner_name]
+        # Warm up (imports, schema generation, caches), without recording measurements
+        for conversation in conversations:
+            await run_scripted_conversation(
+                runner_class,
+                conversation,
+                latency,
+                BenchResult(runner_name),
+                structured_output=args.structured_output,
+                intent_router=args.intent_router,
+                speculate=args.speculate,
+            )
+
+        result = results[runner_name] = BenchResult(runner_name)
+        for _ in range(args.iterations):
+            for conversation in conversations:
+                await run_scripted_conversation(
+                    runner_class,
+                    conversation,
+                    latency,
+                    result,
+                    args.trace_allocations,
+                    args.structured_output,
+                    args.intent_router,
+                    args.speculate,
+                )
+    return results
+
+
+def main() -> None:
+    args = parse_args()
+    if args.conversations_file:
+        load_scripted_conversations(args.conversations_file)
+    if args.trace_allocations:
+        tracemalloc.start()
+
+    results = asyncio.run(run_benchmarks(args))
+    summaries = {runner_name: summarise(result) for runner_name, result in results.items()}
+
+    table = Table(title=f"Per-turn overhead with {args.latency_ms}ms injected model latency")
+    columns = list(next(iter(summaries.values())))
+    table.add_column("runner")
+    for column in columns:
+        table.add_column(column, justify="right")
+    for runner_name, summary in summaries.items():
+        table.add_row(runner_name, *(f"{summary.get(column, 0):.2f}" for column in columns))
+    console = Console()
+    console.print(table)
+
+    if args.json:
+        args.json.write_text(json.dumps(summaries, indent=2))
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = [
+            f"{runner_name}: p50 overhead {summary['overhead_p50_ms']:.2f}ms "
+            f"vs baseline {baseline[runner_name]['overhead_p50_ms']:.2f}ms"
+            for runner_name, summary in summaries.items()
+            if runner_name in baseline
+            and summary["overhead_p50_ms"] > baseline[runner_name]["overhead_p50_ms"] * (1 + args.max_regression)
+        ]
+        if regressions:
+            console.print("[red]Overhead regressions:[/red]\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
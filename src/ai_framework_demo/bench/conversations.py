@@ -0,0 +1,69 @@
+import argparse
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+
+from ai_framework_demo.run_agent import AgentRunner, build_agent_runner
+from ai_framework_demo.scripted import ScriptedConversation
+from ai_framework_demo.services import MenuService, OrderService
+
+
+@dataclass
+class TurnMeasurement:
+    duration: float
+    model_requests: int
+    # Injected model latency, which is subtracted from the duration to get the framework overhead
+    model_latency: float
+    peak_allocated_bytes: int | None = None
+
+    @property
+    def overhead(self) -> float:
+        return self.duration - self.model_requests * self.model_latency
+
+
+@dataclass
+class BenchResult:
+    runner_name: str
+    conversations: int = 0
+    turns: list[TurnMeasurement] = field(default_factory=list)
+
+
+async def run_scripted_conversation(
+    runner_class: type[AgentRunner],
+    conversation: ScriptedConversation,
+    latency: float,
+    result: BenchResult,
+    trace_allocations: bool = False,
+    structured_output: str = "auto",
+    intent_router: bool = False,
+    speculate: bool = False,
+) -> None:
+    """Replay a scripted conversation with a new runner, recording measurements of each turn in `result`"""
+    args = argparse.Namespace(
+        model=f"scripted:{conversation.name}@{latency * 1000}",
+        api_key=None,
+        restaurant_name="Le Bistro",
+        table_number=1,
+        structured_output=structured_output,
+        intent_router=intent_router,
+        speculate=speculate,
+    )
+    runner = build_agent_runner(runner_class, MenuService(), OrderService(), args)
+    for turn in conversation.turns:
+        if trace_allocations:
+            tracemalloc.reset_peak()
+            allocated_before, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        await runner.make_request_async(turn.user_message)
+        duration = time.perf_counter() - start
+        measurement = TurnMeasurement(
+            duration=duration,
+            model_requests=runner.turn_usage[-1].requests if runner.turn_usage else 0,
+            model_latency=latency,
+        )
+        if trace_allocations:
+            _, peak = tracemalloc.get_traced_memory()
+            measurement.peak_allocated_bytes = peak - allocated_before
+        result.turns.append(measurement)
+    runner.close()
+    result.conversations += 1
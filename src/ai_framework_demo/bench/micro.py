@@ -0,0 +1,437 @@
+import argparse
+import asyncio
+import gc
+import json
+import math
+import sys
+import time
+import tracemalloc
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from langchain.agents.format_scratchpad.tools import format_to_tool_messages
+from langchain.agents.output_parsers.tools import ToolAgentAction
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from rich.console import Console
+from rich.table import Table
+
+from ai_framework_demo.bench.__main__ import RUNNERS, percentile
+from ai_framework_demo.langchain.agent import build_agent_prompt
+from ai_framework_demo.langchain.tools import StructuredResponseTool
+from ai_framework_demo.llm import PROMPT_TEMPLATE, LLMResponse, PrefetchedToolCall
+from ai_framework_demo.run_agent import AgentRunner
+from ai_framework_demo.services import MenuService, OrderService
+
+GREETING_MESSAGE = "*Greet the customer*"
+RESPONSE = LLMResponse(
+    message="Bonjour! Welcome to Le Bistro! Do you have any dietary restrictions?", end_conversation=False
+)
+# Fixed workload whose time, compared with the baseline's, gives the speed of the machine during the run
+CALIBRATION_BENCHMARK = "calibration"
+# Super-linear growth of a hot path with history length is flagged above this exponent (1 is linear)
+SUPER_LINEAR_EXPONENT = 1.2
+
+
+@dataclass
+class Sample:
+    duration: float
+    # Only measured in the pass with tracemalloc, since tracing allocations slows down execution
+    peak_allocated_bytes: int | None = None
+
+
+# Runs a single call of a hot path, appending a sample measured around only the call itself (not its setup)
+BenchmarkCall = Callable[[list[Sample]], Awaitable[None]]
+
+
+@contextmanager
+def measure(samples: list[Sample]) -> Iterator[None]:
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        allocated_before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    yield
+    sample = Sample(duration=time.perf_counter() - start)
+    if tracing:
+        sample.peak_allocated_bytes = tracemalloc.get_traced_memory()[1] - allocated_before
+    samples.append(sample)
+
+
+def sync_call(function: Callable[[], Any]) -> BenchmarkCall:
+    async def call(samples: list[Sample]) -> None:
+        with measure(samples):
+            function()
+
+    return call
+
+
+def synthetic_chat_history(messages: int) -> list[BaseMessage]:
+    return [
+        HumanMessage(content=f"Synthetic message {index // 2}")
+        if index % 2 == 0
+        else AIMessage(content=f"Synthetic response {index // 2}")
+        for index in range(messages)
+    ]
+
+
+def synthetic_intermediate_steps(messages: int) -> list[tuple[ToolAgentAction, str]]:
+    """Tool calls of a turn, each formatted as a message with the tool call and a message with its result"""
+    menu = json.dumps(MenuService().get_menu())
+    return [
+        (
+            ToolAgentAction(
+                tool="get_menu",
+                tool_input={},
+                log="",
+                message_log=[
+                    AIMessage(content="", tool_calls=[{"name": "get_menu", "args": {}, "id": f"call_{index}"}])
+                ],
+                tool_call_id=f"call_{index}",
+            ),
+            menu,
+        )
+        for index in range(messages // 2)
+    ]
+
+
+def synthetic_runner_history(runner_class: type[AgentRunner], messages: int) -> bytes:
+    """
+    Serialised history of a runner, made of turns which each fetch the menu (with the tool call and its result)
+    and respond to the user (with the user message and the response)
+    """
+    runner = runner_class(MenuService(), OrderService(), get_runner_args())
+    menu = MenuService().get_menu()
+    for index in range(messages // 4):
+        runner.add_tool_results(
+            [PrefetchedToolCall(tool_call_id=f"synthetic_{index}", tool_name="get_menu", args={}, result=menu)]
+        )
+        runner.record_turn(
+            f"Synthetic message {index}", LLMResponse(message=f"Synthetic response {index}", end_conversation=False)
+        )
+    _, history = runner.dump_history()
+    runner.close()
+    return history
+
+
+def get_runner_args() -> argparse.Namespace:
+    return argparse.Namespace(model="scripted:yellow_food", api_key=None, restaurant_name="Le Bistro", table_number=1)
+
+
+def prepare_calibration(_: int) -> BenchmarkCall:
+    # Pure Python, like the glue code, but without depending on any of it
+    return sync_call(lambda: sorted(str(value) for value in range(5_000)))
+
+
+def prepare_validate_json(_: int) -> BenchmarkCall:
+    data = RESPONSE.model_dump_json()
+    return sync_call(lambda: LLMResponse.model_validate_json(data))
+
+
+def prepare_structured_response_tool(_: int) -> BenchmarkCall:
+    # The tool serialises the response, which is then parsed again into an LLMResponse by the runner
+    tool = StructuredResponseTool()
+    return sync_call(
+        lambda: LLMResponse.model_validate_json(tool._run(message=RESPONSE.message, end_conversation=False))
+    )
+
+
+def prepare_format_static_prompt(_: int) -> BenchmarkCall:
+    # Uncached, to measure the cost which caching format_static_prompt() saves each turn
+    return sync_call(lambda: PROMPT_TEMPLATE.format(restaurant_name="Le Bistro"))
+
+
+def prepare_format_to_tool_messages(messages: int) -> BenchmarkCall:
+    intermediate_steps = synthetic_intermediate_steps(messages)
+    return sync_call(lambda: format_to_tool_messages(intermediate_steps))
+
+
+def prepare_chat_prompt_template(messages: int) -> BenchmarkCall:
+    prompt = build_agent_prompt("scripted:yellow_food")
+    prompt_input = {
+        "restaurant_name": "Le Bistro",
+        "table_number": 1,
+        "chat_history": synthetic_chat_history(messages),
+        "input": GREETING_MESSAGE,
+        "agent_scratchpad": [],
+    }
+    return sync_call(lambda: prompt.invoke(prompt_input))
+
+
+def runner_make_request(runner_class: type[AgentRunner]) -> Callable[[int], BenchmarkCall]:
+    """Benchmark the dispatch of a turn by a runner (with a scripted model), after restoring a synthetic history"""
+
+    def prepare(messages: int) -> BenchmarkCall:
+        history = synthetic_runner_history(runner_class, messages)
+
+        async def call(samples: list[Sample]) -> None:
+            runner = runner_class(MenuService(), OrderService(), get_runner_args())
+            runner.load_history([history])
+            with measure(samples):
+                await runner.make_request_async(GREETING_MESSAGE)
+            runner.close()
+
+        return call
+
+    return prepare
+
+
+@dataclass
+class MicroBenchmark:
+    name: str
+    # Prepares the hot path for a history length, returning a call of it
+    prepare: Callable[[int], BenchmarkCall]
+    scales_with_history: bool = True
+
+
+MICRO_BENCHMARKS = [
+    MicroBenchmark(CALIBRATION_BENCHMARK, prepare_calibration, scales_with_history=False),
+    MicroBenchmark("LLMResponse.model_validate_json", prepare_validate_json, scales_with_history=False),
+    MicroBenchmark("StructuredResponseTool round trip", prepare_structured_response_tool, scales_with_history=False),
+    MicroBenchmark("PROMPT_TEMPLATE.format", prepare_format_static_prompt, scales_with_history=False),
+    MicroBenchmark("format_to_tool_messages", prepare_format_to_tool_messages),
+    MicroBenchmark("ChatPromptTemplate.invoke", prepare_chat_prompt_template),
+    *(
+        MicroBenchmark(f"{runner_name}.make_request", runner_make_request(runner_class))
+        for runner_name, runner_class in RUNNERS.items()
+    ),
+]
+
+
+async def run_repeat(call: BenchmarkCall, iterations: int, max_seconds: float) -> list[Sample]:
+    """
+    Timed calls of a benchmark, stopping early once they take longer than max_seconds (for the slow hot paths).
+    Like timeit, garbage collection is disabled during the calls, since its pauses depend on the rest of the heap.
+    """
+    samples: list[Sample] = []
+    gc.collect()
+    gc.disable()
+    try:
+        deadline = time.perf_counter() + max_seconds
+        while len(samples) < iterations and (not samples or time.perf_counter() < deadline):
+            await call(samples)
+    finally:
+        gc.enable()
+    return samples
+
+
+async def measure_memory(call: BenchmarkCall, memory_iterations: int) -> list[Sample]:
+    samples: list[Sample] = []
+    tracemalloc.start()
+    try:
+        for _ in range(memory_iterations):
+            await call(samples)
+    finally:
+        tracemalloc.stop()
+    return samples
+
+
+def summarise(repeats: list[list[Sample]], memory_samples: list[Sample]) -> dict[str, float]:
+    durations = [[sample.duration * 1_000_000 for sample in samples] for samples in repeats]
+    return {
+        # The fastest of the repeats' medians, since noise (other processes, CPU frequency) only slows calls down
+        "p50_us": min(percentile(repeat, 50) for repeat in durations),
+        "p99_us": percentile([duration for repeat in durations for duration in repeat], 99),
+        "peak_allocated_kib": percentile([(sample.peak_allocated_bytes or 0) / 1024 for sample in memory_samples], 50),
+    }
+
+
+async def run_micro_benchmarks(args: argparse.Namespace) -> dict[str, dict[str, dict[str, float]]]:
+    """Results of each benchmark, by history length (or "-" for those which don't depend on the history)"""
+    benchmarks = [
+        benchmark
+        for benchmark in MICRO_BENCHMARKS
+        if not args.only or benchmark.name in args.only or benchmark.name == CALIBRATION_BENCHMARK
+    ]
+    calls: dict[tuple[str, str], BenchmarkCall] = {}
+    for benchmark in benchmarks:
+        for messages in args.messages if benchmark.scales_with_history else [0]:
+            call = benchmark.prepare(messages)
+            # Warm up (imports, schema generation, caches), without recording measurements
+            await call([])
+            calls[benchmark.name, str(messages) if benchmark.scales_with_history else "-"] = call
+
+    # The repeats of each benchmark are spread over the whole run, rather than run back to back, so that a slow period
+    # of the machine doesn't slow down all of them
+    repeats: dict[tuple[str, str], list[list[Sample]]] = {key: [] for key in calls}
+    for _ in range(args.repeats):
+        for key, call in calls.items():
+            repeats[key].append(await run_repeat(call, args.iterations, args.max_seconds))
+
+    results: dict[str, dict[str, dict[str, float]]] = {}
+    for (name, size), call in calls.items():
+        results.setdefault(name, {})[size] = summarise(
+            repeats[name, size], await measure_memory(call, args.memory_iterations)
+        )
+    return results
+
+
+def growth_exponent(results: dict[str, dict[str, float]]) -> float | None:
+    """Exponent of the growth of p50 time with history length, between the shortest and longest histories"""
+    sizes = sorted(int(size) for size in results if size != "-")
+    if len(sizes) < 2 or sizes[0] <= 0:
+        return None
+    shortest, longest = results[str(sizes[0])]["p50_us"], results[str(sizes[-1])]["p50_us"]
+    return math.log(longest / shortest) / math.log(sizes[-1] / sizes[0])
+
+
+def build_results_table(results: dict[str, dict[str, dict[str, float]]]) -> Table:
+    table = Table(title="Hot path micro-benchmarks (growth is the exponent of p50 time with history length)")
+    table.add_column("benchmark")
+    for column in ("messages", "p50 µs", "p99 µs", "peak KiB", "growth"):
+        table.add_column(column, justify="right")
+    for name, by_size in results.items():
+        exponent = growth_exponent(by_size)
+        growth = ""
+        if exponent is not None:
+            growth = f"{exponent:.2f}" + (" [red](super-linear)[/red]" if exponent > SUPER_LINEAR_EXPONENT else "")
+        for index, (size, result) in enumerate(by_size.items()):
+            table.add_row(
+                name if index == 0 else "",
+                size,
+                f"{result['p50_us']:.1f}",
+                f"{result['p99_us']:.1f}",
+                f"{result['peak_allocated_kib']:.1f}",
+                growth if index == len(by_size) - 1 else "",
+            )
+    return table
+
+
+def machine_slowdown(
+    results: dict[str, dict[str, dict[str, float]]], baseline: dict[str, dict[str, dict[str, float]]]
+) -> float:
+    """How much slower the machine was than during the baseline run, from the times of the calibration workload"""
+    result, baseline_result = (times.get(CALIBRATION_BENCHMARK, {}).get("-") for times in (results, baseline))
+    if result is None or baseline_result is None:
+        return 1.0
+    return result["p50_us"] / baseline_result["p50_us"]
+
+
+def compare_with_baseline(
+    results: dict[str, dict[str, dict[str, float]]],
+    baseline: dict[str, dict[str, dict[str, float]]],
+    max_regression: float,
+    min_regression_us: float,
+) -> tuple[Table, list[str]]:
+    """
+    Comparison report of p50 times and peak memory with a baseline, and the regressions beyond both the relative
+    threshold and the absolute one (below which the changes of µs-scale hot paths are noise).
+    Baseline times are scaled by the machine's slowdown since the baseline run, e.g. on a busy CI runner.
+    """
+    slowdown = machine_slowdown(results, baseline)
+    table = Table(
+        title=f"Comparison with baseline (p50 time and peak memory, ignoring changes under {min_regression_us:g}µs), "
+        f"baseline times scaled by the machine's slowdown of {slowdown:.2f}x"
+    )
+    table.add_column("benchmark")
+    for column in ("messages", "p50 µs", "baseline µs", "change", "peak KiB", "baseline KiB"):
+        table.add_column(column, justify="right")
+    regressions = []
+    for name, by_size in results.items():
+        for size, result in by_size.items():
+            if name == CALIBRATION_BENCHMARK or (baseline_result := baseline.get(name, {}).get(size)) is None:
+                continue
+            baseline_p50 = baseline_result["p50_us"] * slowdown
+            change = result["p50_us"] / baseline_p50 - 1
+            regressed = change > max_regression and result["p50_us"] - baseline_p50 > min_regression_us
+            table.add_row(
+                name,
+                size,
+                f"{result['p50_us']:.1f}",
+                f"{baseline_p50:.1f}",
+                f"[red]{change:+.0%}[/red]" if regressed else f"{change:+.0%}",
+                f"{result['peak_allocated_kib']:.1f}",
+                f"{baseline_result['peak_allocated_kib']:.1f}",
+            )
+            if regressed:
+                regressions.append(
+                    f"{name} ({size} messages): p50 {result['p50_us']:.1f}µs vs baseline {baseline_p50:.1f}µs"
+                )
+    return table, regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark the hot paths of the framework glue code run in each turn, with synthetic "
+        "conversation histories of increasing length, to find overheads which grow super-linearly with the history"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="Lengths of the synthetic histories (default: 10 100 1000)",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=[benchmark.name for benchmark in MICRO_BENCHMARKS],
+        default=None,
+        help="Names of the benchmarks to run (default: all)",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=200, help="Timed calls of each benchmark in each repeat (default: 200)"
+    )
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=0.5,
+        help="Time after which a repeat stops before its iterations, for slow hot paths (default: 0.5)",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=10,
+        help="Repeats of the timed calls, of which the fastest p50 time is reported (default: 10)",
+    )
+    parser.add_argument(
+        "--memory-iterations",
+        type=int,
+        default=3,
+        help="Calls of each benchmark with tracemalloc, to measure peak memory (default: 3)",
+    )
+    parser.add_argument("--json", type=Path, default=None, help="Write results to this JSON file, e.g. as a baseline")
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="JSON results of a previous run to compare against, failing if p50 time regresses",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.5,
+        help="Maximum allowed relative increase in p50 time compared to the baseline (default: 0.5)",
+    )
+    parser.add_argument(
+        "--min-regression-us",
+        type=float,
+        default=50.0,
+        help="Increases in p50 time below this many µs are never regressions, since they are noise (default: 50)",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    results = asyncio.run(run_micro_benchmarks(args))
+    console = Console()
+    console.print(build_results_table(results))
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+    if args.baseline:
+        table, regressions = compare_with_baseline(
+            results, json.loads(args.baseline.read_text()), args.max_regression, args.min_regression_us
+        )
+        console.print(table)
+        if regressions:
+            console.print("[red]Regressions:[/red]\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from rich.console import Console
+from rich.table import Table
+
+from ai_framework_demo.bench.__main__ import RUNNERS, percentile
+from ai_framework_demo.run_agent import AgentRunner
+from ai_framework_demo.scripted import SCRIPTED_CONVERSATIONS, ScriptedConversation
+from ai_framework_demo.services import MenuService, OrderService
+from ai_framework_demo.snapshots import USE_ZSTD, SnapshottingAgentRunner, read_session_snapshot
+
+
+@dataclass
+class SnapshotMeasurements:
+    """Cost of persisting a session after each turn, with snapshots and with naive JSON dumps of the whole history"""
+
+    snapshot_write: list[float] = field(default_factory=list)
+    naive_write: list[float] = field(default_factory=list)
+    snapshot_bytes_written: int = 0
+    naive_bytes_written: int = 0
+    snapshot_size: list[int] = field(default_factory=list)
+    naive_size: list[int] = field(default_factory=list)
+    snapshot_restore: list[float] = field(default_factory=list)
+    naive_restore: list[float] = field(default_factory=list)
+
+
+async def measure_conversation(
+    runner_class: type[AgentRunner],
+    conversation: ScriptedConversation,
+    snapshot_dir: Path,
+    measurements: SnapshotMeasurements,
+) -> None:
+    """Replay a scripted conversation, persisting the session both ways after each turn and restoring it at the end"""
+    args = argparse.Namespace(
+        model=f"scripted:{conversation.name}",
+        api_key=None,
+        restaurant_name="Le Bistro",
+        table_number=1,
+    )
+    menu_service, order_service = MenuService(), OrderService()
+    runner = runner_class(menu_service, order_service, args)
+    snapshot_path = snapshot_dir / f"{conversation.name}.snapshot"
+    naive_path = snapshot_dir / f"{conversation.name}.json"
+    snapshotting = SnapshottingAgentRunner(runner, order_service, args, snapshot_path)
+    tracker = runner.history_tracker  # type: ignore[attr-defined]
+    for turn in conversation.turns:
+        response = await runner.make_request_async(turn.user_message)
+
+        start = time.perf_counter()
+        snapshotting._write_turn(response, runner.turn_usage[-1] if runner.turn_usage else None)
+        measurements.snapshot_write.append(time.perf_counter() - start)
+
+        # The naive approach serialises the whole history after each turn, and overwrites the previous dump
+        start = time.perf_counter()
+        data = tracker.adapter.dump_messages(tracker.written)
+        naive_path.write_bytes(data)
+        measurements.naive_write.append(time.perf_counter() - start)
+        measurements.naive_bytes_written += len(data)
+    snapshot_size = snapshot_path.stat().st_size
+    measurements.snapshot_bytes_written += snapshot_size
+    measurements.snapshot_size.append(snapshot_size)
+    measurements.naive_size.append(naive_path.stat().st_size)
+
+    restored = runner_class(menu_service, OrderService(), args)
+    start = time.perf_counter()
+    snapshot = read_session_snapshot(snapshot_path)
+    assert snapshot is not None
+    restored.load_history(snapshot.history)
+    measurements.snapshot_restore.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    restored.load_history([naive_path.read_bytes()])
+    measurements.naive_restore.append(time.perf_counter() - start)
+    runner.close()
+    restored.close()
+
+
+async def run_benchmarks(args: argparse.Namespace) -> dict[str, SnapshotMeasurements]:
+    conversations = [SCRIPTED_CONVERSATIONS[name] for name in args.conversations or SCRIPTED_CONVERSATIONS]
+    results: dict[str, SnapshotMeasurements] = {}
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        for runner_name in args.runners:
+            # Warm up (imports, schema generation, caches), without recording measurements
+            for conversation in conversations:
+                await measure_conversation(
+                    RUNNERS[runner_name], conversation, Path(snapshot_dir), SnapshotMeasurements()
+                )
+            measurements = results[runner_name] = SnapshotMeasurements()
+            for _ in range(args.iterations):
+                for conversation in conversations:
+                    await measure_conversation(RUNNERS[runner_name], conversation, Path(snapshot_dir), measurements)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the size and time of appending session snapshots after each turn "
+        "with naive JSON dumps of the whole conversation history, by replaying scripted conversations"
+    )
+    parser.add_argument("--runners", nargs="+", choices=list(RUNNERS), default=list(RUNNERS))
+    parser.add_argument(
+        "--conversations",
+        nargs="+",
+        default=None,
+        help="Names of the scripted conversations to replay (default: all)",
+    )
+    parser.add_argument("--iterations", type=int, default=20, help="Times to replay each conversation (default: 20)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmarks(args))
+    table = Table(
+        title=f"Session snapshots ({'zstd' if USE_ZSTD else 'zlib'}) vs naive JSON dumps "
+        "(p50 times per turn and restore, KiB per conversation)"
+    )
+    table.add_column("runner")
+    for column in (
+        "write ms",
+        "naive write ms",
+        "written KiB",
+        "naive written KiB",
+        "size KiB",
+        "naive size KiB",
+        "restore ms",
+        "naive restore ms",
+    ):
+        table.add_column(column, justify="right")
+    for runner_name, measurements in results.items():
+        conversations = len(measurements.snapshot_size)
+        table.add_row(
+            runner_name,
+            f"{percentile(measurements.snapshot_write, 50) * 1000:.3f}",
+            f"{percentile(measurements.naive_write, 50) * 1000:.3f}",
+            f"{measurements.snapshot_bytes_written / conversations / 1024:.2f}",
+            f"{measurements.naive_bytes_written / conversations / 1024:.2f}",
+            f"{percentile(measurements.snapshot_size, 50) / 1024:.2f}",
+            f"{percentile(measurements.naive_size, 50) / 1024:.2f}",
+            f"{percentile(measurements.snapshot_restore, 50) * 1000:.3f}",
+            f"{percentile(measurements.naive_restore, 50) * 1000:.3f}",
+        )
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
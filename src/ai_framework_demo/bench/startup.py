@@ -0,0 +1,88 @@
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import get_args
+
+from ai_framework_demo.model_names import KNOWN_MODEL_NAMES
+
+# Modules which must not be imported just to start the CLI, since they are slow to import
+HEAVY_MODULES = (
+    "pydantic_ai",
+    "langchain",
+    "langchain_core",
+    "langgraph",
+    "logfire",
+    "openai",
+    "anthropic",
+    "groq",
+    "mistralai",
+    "google.generativeai",
+)
+
+# Maximum time in milliseconds to import the CLI and build its help text
+STARTUP_BUDGET_MS = 100
+
+# Imports the CLI module and builds its help text, reporting the time taken and which heavy modules were imported
+STARTUP_SCRIPT = f"""
+import sys, time
+start = time.perf_counter()
+from ai_framework_demo.__main__ import build_parser
+build_parser().format_help()
+print(time.perf_counter() - start)
+print(",".join(module for module in {HEAVY_MODULES!r} if module in sys.modules))
+"""
+
+
+def measure_startup(runs: int) -> tuple[float, list[str]]:
+    """Minimum time in seconds to import the CLI in a fresh interpreter, and the heavy modules imported by it"""
+    # The interpreters import this copy of the package, even if it isn't installed
+    source_dir = str(Path(__file__).parents[2])
+    env = os.environ | {"PYTHONPATH": os.pathsep.join(filter(None, (source_dir, os.environ.get("PYTHONPATH"))))}
+    durations: list[float] = []
+    heavy_modules: list[str] = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT], check=True, capture_output=True, text=True, env=env
+        ).stdout.splitlines()
+        durations.append(float(output[0]))
+        heavy_modules = [module for module in output[1].split(",") if module]
+    return min(durations), heavy_modules
+
+
+def get_outdated_model_names() -> set[str]:
+    """Model names which differ between the precomputed list and the installed version of PydanticAI"""
+    from pydantic_ai.models import KnownModelName
+
+    return set(get_args(KnownModelName)).symmetric_difference(KNOWN_MODEL_NAMES)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check that CLI startup time stays within budget")
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=STARTUP_BUDGET_MS,
+        help=f"Maximum CLI import time (default: {STARTUP_BUDGET_MS})",
+    )
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to measure (default: 5)")
+    args = parser.parse_args()
+
+    errors: list[str] = []
+    duration, heavy_modules = measure_startup(args.runs)
+    print(f"CLI import time: {duration * 1000:.1f}ms (budget {args.budget_ms:.0f}ms)")
+    if duration * 1000 > args.budget_ms:
+        errors.append(f"CLI import time {duration * 1000:.1f}ms exceeds budget of {args.budget_ms:.0f}ms")
+    if heavy_modules:
+        errors.append(f"Heavy modules imported at CLI startup: {', '.join(heavy_modules)}")
+    if outdated_model_names := get_outdated_model_names():
+        errors.append(f"KNOWN_MODEL_NAMES is out of date with PydanticAI: {', '.join(sorted(outdated_model_names))}")
+
+    if errors:
+        print("\n".join(errors), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
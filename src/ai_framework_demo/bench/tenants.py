@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from rich.console import Console
+from rich.table import Table
+
+from ai_framework_demo.bench.__main__ import RUNNERS, percentile
+from ai_framework_demo.run_agent import AgentRunner
+from ai_framework_demo.services import DEFAULT_MENU
+from ai_framework_demo.sessions import SessionManager
+from ai_framework_demo.tenants import TenantRegistry
+
+
+@dataclass
+class TenantMeasurements:
+    """Cost of loading the tenant registry, and of constructing sessions spread between its tenants"""
+
+    tenants: int
+    registry_load: float = 0
+    session_construction: list[float] = field(default_factory=list)
+    session_memory: float = 0
+
+
+def write_tenants(tenants_dir: Path, tenants: int) -> None:
+    """Write tenant files with their own restaurant name and a copy of the default menu"""
+    for index in range(tenants):
+        menu = {category: [f"{item} #{index}" for item in items] for category, items in DEFAULT_MENU.items()}
+        config = {"restaurant_name": f"Restaurant {index}", "menu": menu}
+        (tenants_dir / f"tenant-{index}.json").write_text(json.dumps(config))
+
+
+def measure_sessions(runner_class: type[AgentRunner], tenants: int, sessions: int) -> TenantMeasurements:
+    """Construct sessions for the tables of the tenants in turn, measuring their time and retained memory"""
+    measurements = TenantMeasurements(tenants)
+    with tempfile.TemporaryDirectory() as tenants_dir:
+        write_tenants(Path(tenants_dir), tenants)
+        start = time.perf_counter()
+        registry = TenantRegistry.load(Path(tenants_dir))
+        measurements.registry_load = time.perf_counter() - start
+    args = argparse.Namespace(model="scripted:menu_confirm", api_key=None, restaurant_name="Le Bistro", table_number=1)
+    manager = SessionManager(runner_class, args, tenants=registry)
+    tenant_ids = list(registry.tenants)
+    # Warm up (imports, schema generation, caches shared by all sessions), without recording measurements
+    manager.get_session(0, tenant_ids[0])
+    tracemalloc.start()
+    memory_before, _ = tracemalloc.get_traced_memory()
+    for table_number in range(1, sessions + 1):
+        start = time.perf_counter()
+        manager.get_session(table_number, tenant_ids[table_number % tenants])
+        measurements.session_construction.append(time.perf_counter() - start)
+    memory_after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    measurements.session_memory = (memory_after - memory_before) / sessions
+    asyncio.run(close_sessions(manager))
+    return measurements
+
+
+async def close_sessions(manager: SessionManager) -> None:
+    for tenant, table_number in list(manager.sessions):
+        await manager.close_session(table_number, tenant)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure how the time and memory of constructing table sessions scale with the number of "
+        "restaurants served by a process, which should stay flat since tenants' artefacts are shared"
+    )
+    parser.add_argument("--runners", nargs="+", choices=list(RUNNERS), default=list(RUNNERS))
+    parser.add_argument(
+        "--tenants", type=int, nargs="+", default=[1, 10, 100], help="Numbers of tenants to compare (default: 1 10 100)"
+    )
+    parser.add_argument("--sessions", type=int, default=200, help="Sessions to construct (default: 200)")
+    args = parser.parse_args()
+
+    table = Table(title=f"Construction of {args.sessions} sessions spread between tenants")
+    table.add_column("runner")
+    for column in ("tenants", "registry load ms", "session p50 ms", "session p99 ms", "KiB/session"):
+        table.add_column(column, justify="right")
+    for runner_name in args.runners:
+        for tenants in args.tenants:
+            measurements = measure_sessions(RUNNERS[runner_name], tenants, args.sessions)
+            table.add_row(
+                runner_name,
+                str(tenants),
+                f"{measurements.registry_load * 1000:.1f}",
+                f"{percentile(measurements.session_construction, 50) * 1000:.3f}",
+                f"{percentile(measurements.session_construction, 99) * 1000:.3f}",
+                f"{measurements.session_memory / 1024:.1f}",
+            )
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
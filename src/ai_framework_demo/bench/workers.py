@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import os
+import time
+
+from rich.console import Console
+from rich.table import Table
+
+from ai_framework_demo.scripted import SCRIPTED_CONVERSATIONS
+from ai_framework_demo.workers import WorkerPool
+
+
+async def run_tables(pool: WorkerPool, user_messages: list[str], first_table: int, tables: int) -> int:
+    """Run a conversation for each of the tables concurrently, returning the number of turns made"""
+    results = await pool.run_conversations(dict.fromkeys(range(first_table, first_table + tables), user_messages))
+    await asyncio.gather(*(pool.close_session(table_number) for table_number in results))
+    return sum(len(responses) for responses in results.values())
+
+
+async def measure_throughput(pool: WorkerPool, user_messages: list[str], tables: int, rounds: int) -> float:
+    """Turns per second made by the pool, after warming up each worker"""
+    await run_tables(pool, user_messages, 0, pool.workers)
+    turns = 0
+    start = time.perf_counter()
+    for round_number in range(rounds):
+        turns += await run_tables(pool, user_messages, (round_number + 1) * tables, tables)
+    return turns / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure how the throughput of a worker pool scales with the number of worker processes, "
+        "by running scripted conversations for many tables with a deterministic stand-in model (no API key required)"
+    )
+    parser.add_argument("framework", choices=["langchain", "langgraph", "pydanticai"])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=sorted({1, 2, os.cpu_count() or 1}),
+        help="Numbers of worker processes to compare (default: 1, 2 and the number of CPUs)",
+    )
+    parser.add_argument(
+        "--conversation",
+        choices=list(SCRIPTED_CONVERSATIONS),
+        default="menu_confirm",
+        help="Scripted conversation to run for each table (default: menu_confirm)",
+    )
+    parser.add_argument("--tables", type=int, default=64, help="Tables with a conversation at the same time")
+    parser.add_argument("--rounds", type=int, default=5, help="Times to run the conversations of the tables")
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="Latency to inject into each model request (default: 0)"
+    )
+    args = parser.parse_args()
+
+    pool_args = argparse.Namespace(
+        framework=args.framework,
+        debug=False,
+        model=f"scripted:{args.conversation}@{args.latency_ms}",
+        api_key=None,
+        restaurant_name="Le Bistro",
+        table_number=1,
+    )
+    user_messages = SCRIPTED_CONVERSATIONS[args.conversation].user_messages
+    table = Table(title=f"Worker pool throughput ({args.framework}, {os.cpu_count()} CPUs)")
+    for column in ("workers", "turns/s", "speedup"):
+        table.add_column(column, justify="right")
+    baseline = None
+    for workers in args.workers:
+        with WorkerPool(pool_args, workers) as pool:
+            throughput = asyncio.run(measure_throughput(pool, user_messages, args.tables, args.rounds))
+        baseline = baseline or throughput
+        table.add_row(str(workers), f"{throughput:.1f}", f"{throughput / baseline:.2f}x")
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import asdict, dataclass, field
+from functools import cache
+from pathlib import Path
+from typing import Any, Literal
+
+from rich.table import Table
+
+from ai_framework_demo.llm import LLMResponse
+from ai_framework_demo.memory import history_token_limit
+from ai_framework_demo.model_routing import prefer_cheap_model
+from ai_framework_demo.pricing import estimate_cost
+from ai_framework_demo.run_agent import AgentRunner, AgentRunnerWrapper
+from ai_framework_demo.usage import TurnUsage, turn_model_usage
+
+# Proportions of a budget spent from which its conversations are degraded: the conversation history is compacted to
+# BUDGET_HISTORY_TOKENS, then turns are also sent to the cheap model (with --cheap-model), and once the budget is spent
+# the conversation is ended
+BUDGET_COMPACT_AT = 0.5
+BUDGET_CHEAP_MODEL_AT = 0.8
+BUDGET_HISTORY_TOKENS = 2000
+BUDGET_EXHAUSTED_MESSAGE = (
+    "I'm sorry, I'm unable to continue this conversation. A member of staff will be with you shortly to help."
+)
+# Minimum seconds between writes of the usage totals to the export file, which is always written when a
+# conversation ends
+USAGE_EXPORT_INTERVAL = 1.0
+
+BudgetDegradation = Literal["compact", "cheap_model", "end_conversation"]
+
+
+@dataclass
+class UsageTotals:
+    """Token usage and estimated cost of a number of turns"""
+
+    turns: int = 0
+    usage: TurnUsage = field(default_factory=TurnUsage)
+    # Cost of the usage with models whose price is known, in USD
+    cost: float = 0
+
+    def add(self, usage: TurnUsage, cost: float | None, turns: int = 1) -> None:
+        self.turns += turns
+        self.usage += usage
+        self.cost += cost or 0
+
+    @property
+    def tokens(self) -> int:
+        return self.usage.input_tokens + self.usage.output_tokens
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"turns": self.turns, **asdict(self.usage), "cost": round(self.cost, 6)}
+
+
+class UsageAccountant:
+    """
+    Aggregates the token usage and estimated cost of all conversations in the process, by model, table and
+    conversation, for budgets and capacity planning. Usage can be recorded from any thread.
+    Conversations are only kept while they are active, their usage remains in the totals of their table.
+    """
+
+    def __init__(self) -> None:
+        self.total = UsageTotals()
+        self.by_model: dict[str, UsageTotals] = {}
+        self.by_table: dict[str, UsageTotals] = {}
+        self.by_conversation: dict[str, UsageTotals] = {}
+        self.conversations = 0
+        self._conversation_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start_conversation(self, table: str) -> str:
+        """Start accounting for a conversation of a table, returning its ID"""
+        with self._lock:
+            self.conversations += 1
+            conversation = f"{table}#{next(self._conversation_ids)}"
+            self.by_conversation[conversation] = UsageTotals()
+            self.by_table.setdefault(table, UsageTotals())
+        return conversation
+
+    def end_conversation(self, conversation: str) -> None:
+        with self._lock:
+            self.by_conversation.pop(conversation, None)
+
+    def record(self, conversation: str, table: str, model_usage: dict[str, TurnUsage]) -> float:
+        """Record the usage of a turn of a conversation by the models it was made with, returning its cost"""
+        usage = sum(model_usage.values(), TurnUsage())
+        costs = {model_name: estimate_cost(model_name, usage) for model_name, usage in model_usage.items()}
+        cost = sum(cost or 0 for cost in costs.values())
+        with self._lock:
+            self.total.add(usage, cost)
+            self.by_table.setdefault(table, UsageTotals()).add(usage, cost)
+            if (conversation_totals := self.by_conversation.get(conversation)) is not None:
+                conversation_totals.add(usage, cost)
+            for model_name, usage in model_usage.items():
+                self.by_model.setdefault(model_name, UsageTotals()).add(usage, costs[model_name])
+        return cost
+
+    def get_table_totals(self, table: str) -> UsageTotals:
+        with self._lock:
+            return self.by_table.get(table) or UsageTotals()
+
+    def export(self) -> dict[str, Any]:
+        """Get a snapshot of the totals, which can be serialised as JSON"""
+        with self._lock:
+            return {
+                "updated_at": time.time(),
+                "conversations": self.conversations,
+                "active_conversations": len(self.by_conversation),
+                "total": self.total.to_dict(),
+                "by_model": {name: totals.to_dict() for name, totals in self.by_model.items()},
+                "by_table": {table: totals.to_dict() for table, totals in self.by_table.items()},
+                "by_conversation": {
+                    conversation: totals.to_dict() for conversation, totals in self.by_conversation.items()
+                },
+            }
+
+    def write(self, path: Path | str) -> None:
+        """Write the totals to a JSON file, replacing it atomically so readers never see a partial file"""
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(self.export(), indent=2))
+        os.replace(tmp_path, path)
+
+
+@cache
+def get_usage_accountant() -> UsageAccountant:
+    """Get the usage accountant which is shared by all conversations in the process"""
+    return UsageAccountant()
+
+
+def build_usage_table(accountant: UsageAccountant) -> Table:
+    """Build a table of the token usage and estimated cost of each model"""
+    table = Table(title="Usage by model")
+    for column in ("model", "turns", "requests", "input tokens", "output tokens", "cache hit tokens", "cost $"):
+        table.add_column(column, justify="right")
+    for model_name, totals in [*accountant.by_model.items(), ("total", accountant.total)]:
+        table.add_row(
+            model_name,
+            str(totals.turns),
+            str(totals.usage.requests),
+            str(totals.usage.input_tokens),
+            str(totals.usage.output_tokens),
+            str(totals.usage.cache_read_tokens),
+            f"{totals.cost:.4f}",
+        )
+    return table
+
+
+@dataclass(frozen=True)
+class BudgetConfig:
+    """Limits of the tokens and estimated cost (in USD) of each conversation and of all conversations of a table"""
+
+    max_conversation_tokens: int | None = None
+    max_conversation_cost: float | None = None
+    max_table_tokens: int | None = None
+    max_table_cost: float | None = None
+
+    def get_spent(self, conversation: UsageTotals, table: UsageTotals) -> float:
+        """Get the largest proportion spent of any of the budgets"""
+        spent = [
+            totals.tokens / max_tokens if max_tokens else 0
+            for totals, max_tokens in ((conversation, self.max_conversation_tokens), (table, self.max_table_tokens))
+        ]
+        spent.extend(
+            totals.cost / max_cost if max_cost else 0
+            for totals, max_cost in ((conversation, self.max_conversation_cost), (table, self.max_table_cost))
+        )
+        return max(spent)
+
+    def __bool__(self) -> bool:
+        return self != BudgetConfig()
+
+
+def build_budget_config(args: argparse.Namespace) -> BudgetConfig:
+    """Build the budgets from the CLI arguments (limits of 0 disable them)"""
+    return BudgetConfig(
+        max_conversation_tokens=getattr(args, "max_conversation_tokens", None) or None,
+        max_conversation_cost=getattr(args, "max_conversation_cost", None) or None,
+        max_table_tokens=getattr(args, "max_table_tokens", None) or None,
+        max_table_cost=getattr(args, "max_table_cost", None) or None,
+    )
+
+
+@dataclass
+class BudgetStats:
+    """Turns of all conversations in the process which were degraded by their budgets"""
+
+    degraded_turns: dict[BudgetDegradation, int] = field(
+        default_factory=lambda: {"compact": 0, "cheap_model": 0, "end_conversation": 0}
+    )
+
+    def __str__(self) -> str:
+        return " ".join(f"{degradation}={count}" for degradation, count in self.degraded_turns.items())
+
+
+@cache
+def get_budget_stats() -> BudgetStats:
+    return BudgetStats()
+
+
+def get_table_key(table_number: int, tenant: str | None) -> str:
+    return str(table_number) if tenant is None else f"{tenant}/{table_number}"
+
+
+class BudgetedAgentRunner(AgentRunnerWrapper):
+    """
+    Wraps an agent runner to account for the token usage and estimated cost of each turn, by conversation, table and
+    model, and to degrade conversations which are spending their budget: their history is compacted more aggressively,
+    then turns go to the cheap model (if there is one), and once the budget of the conversation or its table is spent
+    the conversation is ended politely without a request to the model.
+    """
+
+    def __init__(
+        self,
+        runner: AgentRunner,
+        config: BudgetConfig,
+        model_name: str,
+        table_number: int,
+        tenant: str | None = None,
+        export_path: str | None = None,
+        cheap_model: str | None = None,
+    ):
+        super().__init__(runner)
+        self.config = config
+        self.model_name = model_name
+        self.cheap_model = cheap_model
+        self.table = get_table_key(table_number, tenant)
+        self.export_path = export_path
+        self.accountant = get_usage_accountant()
+        self.stats = get_budget_stats()
+        self.conversation = self.accountant.start_conversation(self.table)
+        # Includes the turns of a conversation restored from a snapshot, which count towards its budget
+        self.usage = UsageTotals()
+        if runner.turn_usage:
+            usage = sum(runner.turn_usage, TurnUsage())
+            self.usage.add(usage, estimate_cost(model_name, usage), turns=len(runner.turn_usage))
+        self._last_export = 0.0
+
+    def _get_spent(self) -> float:
+        return self.config.get_spent(self.usage, self.accountant.get_table_totals(self.table))
+
+    def _end_conversation(self, user_message: str) -> LLMResponse:
+        self.stats.degraded_turns["end_conversation"] += 1
+        response = LLMResponse(message=BUDGET_EXHAUSTED_MESSAGE, end_conversation=True)
+        self.runner.record_turn(user_message, response)
+        return response
+
+    @contextlib.contextmanager
+    def _account_turn(self, spent: float) -> Iterator[None]:
+        """Degrade the turn according to the budget spent, and record the usage of the turn once it has finished"""
+        turns_before = len(self.runner.turn_usage)
+        model_usage: dict[str, TurnUsage] = {}
+        tokens = [turn_model_usage.set(model_usage)]
+        if spent >= BUDGET_COMPACT_AT:
+            self.stats.degraded_turns["compact"] += 1
+            tokens.append(history_token_limit.set(BUDGET_HISTORY_TOKENS))
+        if spent >= BUDGET_CHEAP_MODEL_AT and self.cheap_model is not None:
+            self.stats.degraded_turns["cheap_model"] += 1
+            tokens.append(prefer_cheap_model.set(True))
+        try:
+            yield
+        finally:
+            for token in reversed(tokens):
+                token.var.reset(token)
+            if len(self.runner.turn_usage) > turns_before:
+                self._record_usage(self.runner.turn_usage[-1], model_usage)
+
+    def _record_usage(self, usage: TurnUsage, model_usage: dict[str, TurnUsage]) -> None:
+        # Usage is only attributed to models by the model router, otherwise all of it was made with the agent's model
+        if not model_usage:
+            model_usage = {self.model_name: usage}
+        cost = self.accountant.record(self.conversation, self.table, model_usage)
+        self.usage.add(usage, cost)
+        if self.export_path and time.monotonic() - self._last_export >= USAGE_EXPORT_INTERVAL:
+            self._export()
+
+    def _export(self) -> None:
+        assert self.export_path is not None
+        self.accountant.write(self.export_path)
+        self._last_export = time.monotonic()
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        if (spent := self._get_spent()) >= 1:
+            return self._end_conversation(user_message)
+        with self._account_turn(spent):
+            return self.runner.make_request(user_message)
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        if (spent := self._get_spent()) >= 1:
+            return self._end_conversation(user_message)
+        with self._account_turn(spent):
+            return await self.runner.make_request_async(user_message)
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        if (spent := self._get_spent()) >= 1:
+            response = self._end_conversation(user_message)
+            on_message(response.message)
+            return response
+        with self._account_turn(spent):
+            return await self.runner.stream_request(user_message, on_message)
+
+    def close(self) -> None:
+        self.accountant.end_conversation(self.conversation)
+        if self.export_path:
+            self._export()
+        self.runner.close()
+
+
+def build_budgeted_runner(runner: AgentRunner, args: argparse.Namespace) -> AgentRunner:
+    """Wrap an agent runner with usage accounting if budgets or the export of usage are enabled by the arguments"""
+    config = build_budget_config(args)
+    export_path = getattr(args, "usage_export", None)
+    if not config and not export_path:
+        return runner
+    return BudgetedAgentRunner(
+        runner,
+        config,
+        model_name=args.model,
+        table_number=args.table_number,
+        tenant=getattr(args, "tenant", None),
+        export_path=export_path,
+        cheap_model=getattr(args, "cheap_model", None),
+    )
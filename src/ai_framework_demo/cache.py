@@ -0,0 +1,337 @@
+import argparse
+import difflib
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from functools import cache
+from pathlib import Path
+from typing import Generic, TypeVar
+
+from ai_framework_demo.llm import TABLE_PROMPT_TEMPLATE
+
+MessageT = TypeVar("MessageT")
+
+# Tools with side effects: a model response which calls one of these is never cached, and no response is served from
+# the cache for a turn in which one of these has been called (since the response depends on the side effect)
+SIDE_EFFECT_TOOL_NAMES = frozenset({"create_order"})
+
+# The table prompt is the only part of the system prompt which differs between tables of the restaurant,
+# and is replaced with a placeholder so that responses can be shared between tables
+TABLE_PROMPT_PATTERN = re.compile(re.escape(TABLE_PROMPT_TEMPLATE.strip()).replace(r"\{table_number\}", r"\d+"))
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s*]")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalise_text(text: str) -> str:
+    """Normalise text for use in a cache key, so that trivially different messages share a cache entry"""
+    text = TABLE_PROMPT_PATTERN.sub("{table prompt}", text)
+    text = PUNCTUATION_PATTERN.sub("", text.lower())
+    return WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+@dataclass
+class CachedResponse:
+    # Serialised model response
+    value: str
+    # Time taken by the model to produce the response, which is saved by each cache hit
+    latency: float
+    created_at: float = field(default_factory=time.time)
+
+
+@dataclass
+class ResponseCacheKey:
+    # Hash of the model name and the conversation history other than the latest user message
+    context_hash: str
+    # Normalised latest user message, which can be matched by similarity
+    user_message: str
+
+
+@dataclass
+class ResponseCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Requests which could not be served from the cache, because of side effects in the turn
+    uncacheable: int = 0
+    latency_saved: float = 0
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses + self.uncacheable
+        return self.hits / requests if requests else 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.hits} hits, {self.misses} misses, {self.uncacheable} uncacheable "
+            f"({self.hit_rate:.0%} hit rate), {self.latency_saved:.2f}s latency saved"
+        )
+
+
+class ResponseCacheAdapter(ABC, Generic[MessageT]):
+    """Provides the framework-specific message operations required by the response cache"""
+
+    @abstractmethod
+    def message_key(self, message: MessageT) -> str:
+        """
+        Text which identifies the message content, excluding anything which differs between otherwise identical
+        conversations (e.g. tool call IDs and timestamps)
+        """
+
+    @abstractmethod
+    def user_message_text(self, message: MessageT) -> str | None:
+        """Text of the message if it is a user message, otherwise None"""
+
+    @abstractmethod
+    def tool_call_names(self, message: MessageT) -> list[str]:
+        """Names of the tools called by the message, if it is a model response"""
+
+    @abstractmethod
+    def dump_response(self, response: MessageT) -> str: ...
+
+    @abstractmethod
+    def load_response(self, value: str) -> MessageT: ...
+
+
+class ResponseCacheBackend(ABC):
+    """Storage of cached responses, grouped by conversation context then indexed by user message"""
+
+    def __init__(self, max_entries: int, ttl: float | None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def is_expired(self, response: CachedResponse) -> bool:
+        return self.ttl is not None and time.time() - response.created_at > self.ttl
+
+    @abstractmethod
+    def get(self, context_hash: str, user_message: str) -> CachedResponse | None: ...
+
+    @abstractmethod
+    def user_messages(self, context_hash: str) -> list[str]:
+        """User messages of the entries cached for a conversation context, to match by similarity"""
+
+    @abstractmethod
+    def set(self, context_hash: str, user_message: str, response: CachedResponse) -> None: ...
+
+
+class InMemoryResponseCacheBackend(ResponseCacheBackend):
+    """Process-local LRU cache"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float | None = None):
+        super().__init__(max_entries, ttl)
+        self._entries: OrderedDict[tuple[str, str], CachedResponse] = OrderedDict()
+        self._user_messages: dict[str, set[str]] = {}
+
+    def get(self, context_hash: str, user_message: str) -> CachedResponse | None:
+        key = (context_hash, user_message)
+        response = self._entries.get(key)
+        if response is None:
+            return None
+        if self.is_expired(response):
+            self._delete(key)
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def user_messages(self, context_hash: str) -> list[str]:
+        return list(self._user_messages.get(context_hash, ()))
+
+    def set(self, context_hash: str, user_message: str, response: CachedResponse) -> None:
+        key = (context_hash, user_message)
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        self._user_messages.setdefault(context_hash, set()).add(user_message)
+        while len(self._entries) > self.max_entries:
+            self._delete(next(iter(self._entries)))
+
+    def _delete(self, key: tuple[str, str]) -> None:
+        del self._entries[key]
+        context_hash, user_message = key
+        user_messages = self._user_messages[context_hash]
+        user_messages.discard(user_message)
+        if not user_messages:
+            del self._user_messages[context_hash]
+
+
+class SQLiteResponseCacheBackend(ResponseCacheBackend):
+    """LRU cache stored in a SQLite database, so that it persists between processes"""
+
+    def __init__(self, db_path: Path | str, max_entries: int = 1024, ttl: float | None = None):
+        super().__init__(max_entries, ttl)
+        self.db_path = db_path
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    context_hash TEXT NOT NULL,
+                    user_message TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    latency REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (context_hash, user_message)
+                );
+                CREATE INDEX IF NOT EXISTS response_cache_accessed_at ON response_cache (accessed_at);
+                """
+            )
+
+    def get(self, context_hash: str, user_message: str) -> CachedResponse | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, latency, created_at FROM response_cache WHERE context_hash = ? AND user_message = ?",
+                (context_hash, user_message),
+            ).fetchone()
+            if row is None:
+                return None
+            response = CachedResponse(*row)
+            if self.is_expired(response):
+                self._connection.execute(
+                    "DELETE FROM response_cache WHERE context_hash = ? AND user_message = ?",
+                    (context_hash, user_message),
+                )
+                return None
+            self._connection.execute(
+                "UPDATE response_cache SET accessed_at = ? WHERE context_hash = ? AND user_message = ?",
+                (time.time(), context_hash, user_message),
+            )
+            return response
+
+    def user_messages(self, context_hash: str) -> list[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT user_message FROM response_cache WHERE context_hash = ?", (context_hash,)
+            ).fetchall()
+        return [user_message for (user_message,) in rows]
+
+    def set(self, context_hash: str, user_message: str, response: CachedResponse) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (context_hash, user_message, response.value, response.latency, response.created_at, time.time()),
+            )
+            # Evict the least recently used entries
+            self._connection.execute(
+                "DELETE FROM response_cache WHERE rowid IN "
+                "(SELECT rowid FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class ResponseCache:
+    """
+    Cache of model responses, keyed on the model name and the normalised conversation history (including the
+    system prompt and tool results), so that repeated turns (e.g. greetings or menu questions) are served without
+    making a request to the model. A user message can also match the cached response to a near-duplicate message
+    in the same context, if its similarity ratio is at least `similarity_threshold`.
+    """
+
+    def __init__(
+        self,
+        backend: ResponseCacheBackend,
+        similarity_threshold: float = 1.0,
+        side_effect_tool_names: frozenset[str] = SIDE_EFFECT_TOOL_NAMES,
+    ):
+        self.backend = backend
+        self.similarity_threshold = similarity_threshold
+        self.side_effect_tool_names = side_effect_tool_names
+        self.stats = ResponseCacheStats()
+
+    def get_key(
+        self, model_name: str, messages: Sequence[MessageT], adapter: ResponseCacheAdapter[MessageT]
+    ) -> ResponseCacheKey | None:
+        """Get the cache key for a request, or None if the request must not be served from the cache"""
+        user_message_index = next(
+            (
+                index
+                for index in range(len(messages) - 1, -1, -1)
+                if adapter.user_message_text(messages[index]) is not None
+            ),
+            None,
+        )
+        if user_message_index is None:
+            return None
+        for message in messages[user_message_index + 1 :]:
+            if self.side_effect_tool_names.intersection(adapter.tool_call_names(message)):
+                self.stats.uncacheable += 1
+                return None
+
+        context = hashlib.sha256(model_name.encode())
+        for index, message in enumerate(messages):
+            if index != user_message_index:
+                context.update(b"\x00" + normalise_text(adapter.message_key(message)).encode())
+            else:
+                context.update(b"\x01")
+        user_message = adapter.user_message_text(messages[user_message_index])
+        assert user_message is not None
+        return ResponseCacheKey(context_hash=context.hexdigest(), user_message=normalise_text(user_message))
+
+    def get(self, key: ResponseCacheKey) -> CachedResponse | None:
+        """Get the cached response for the key (or a near-duplicate user message), recording the hit or miss"""
+        response = self.backend.get(key.context_hash, key.user_message)
+        if response is None and self.similarity_threshold < 1:
+            if similar_user_message := self._get_similar_user_message(key):
+                response = self.backend.get(key.context_hash, similar_user_message)
+        if response is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+            self.stats.latency_saved += response.latency
+        return response
+
+    def _get_similar_user_message(self, key: ResponseCacheKey) -> str | None:
+        best_ratio, best_user_message = self.similarity_threshold, None
+        matcher = difflib.SequenceMatcher(b=key.user_message)
+        for user_message in self.backend.user_messages(key.context_hash):
+            matcher.set_seq1(user_message)
+            # Cheap upper bounds of the ratio are checked first
+            if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+                continue
+            if (ratio := matcher.ratio()) >= best_ratio:
+                best_ratio, best_user_message = ratio, user_message
+        return best_user_message
+
+    def set(
+        self,
+        key: ResponseCacheKey,
+        response: MessageT,
+        latency: float,
+        adapter: ResponseCacheAdapter[MessageT],
+    ) -> None:
+        """Cache the response, unless it calls a tool with side effects"""
+        if self.side_effect_tool_names.intersection(adapter.tool_call_names(response)):
+            return
+        self.backend.set(key.context_hash, key.user_message, CachedResponse(adapter.dump_response(response), latency))
+
+
+@cache
+def get_response_cache(
+    path: str | None, max_entries: int, ttl: float | None, similarity_threshold: float
+) -> ResponseCache:
+    """Get the response cache which is shared by all agents in the process with the same configuration"""
+    backend = (
+        SQLiteResponseCacheBackend(path, max_entries, ttl) if path else InMemoryResponseCacheBackend(max_entries, ttl)
+    )
+    return ResponseCache(backend, similarity_threshold)
+
+
+def build_response_cache(args: argparse.Namespace) -> ResponseCache | None:
+    """Get the response cache configured by the CLI arguments, or None if response caching is disabled"""
+    if not getattr(args, "response_cache", False):
+        return None
+    return get_response_cache(
+        path=getattr(args, "response_cache_path", None),
+        max_entries=getattr(args, "response_cache_max_entries", 1024),
+        ttl=getattr(args, "response_cache_ttl", None),
+        similarity_threshold=getattr(args, "response_cache_similarity", 1.0),
+    )
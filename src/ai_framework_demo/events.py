@@ -0,0 +1,269 @@
+import asyncio
+import json
+import logging
+import threading
+from collections import Counter
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+from functools import cache
+from pathlib import Path
+from typing import Any
+
+from ai_framework_demo.services import Order, dump_order, load_order
+
+logger = logging.getLogger(__name__)
+
+# Events a subscriber can fall behind by before orders created with create_order_async() wait for it
+DEFAULT_MAX_LAG = 1024
+# Events kept for subscribers to replay, which must be at least the maximum lag
+DEFAULT_RETAINED_EVENTS = 16384
+# Maximum events read by a subscriber at once
+READ_BATCH_SIZE = 256
+
+
+@dataclass(frozen=True)
+class OrderEvent:
+    """An order which was created, at its offset in the log of order events"""
+
+    offset: int
+    order: Order
+
+
+class OrderEventsLostError(Exception):
+    """Raised when a subscriber has fallen so far behind that the events it hasn't read are no longer retained"""
+
+
+class OrderEventBus:
+    """
+    In-process log of created orders, which consumers (e.g. kitchen displays and billing) subscribe to by cursor,
+    so they get new orders as soon as they are created rather than polling the order service. The most recent
+    events are retained, so subscribers can replay them from an offset.
+
+    Orders created with create_order_async() wait while any subscriber is `max_lag` or more events behind
+    (backpressure). Orders created synchronously (e.g. by tools run in threads) never wait, so a subscriber which is
+    too slow may lose events, which is raised as OrderEventsLostError.
+    Orders can be published from any thread, and are read by subscribers in their own event loops.
+    """
+
+    def __init__(self, max_lag: int = DEFAULT_MAX_LAG, retained_events: int = DEFAULT_RETAINED_EVENTS):
+        if retained_events < max_lag:
+            raise ValueError("Retained events must be at least the maximum lag of subscribers")
+        self.max_lag = max_lag
+        self.retained_events = retained_events
+        # Events are trimmed in chunks once twice as many as retained are kept, so reads are O(1) by offset
+        self._events: list[OrderEvent] = []
+        self._first_offset = 0
+        self._subscriptions: set[OrderSubscription] = set()
+        self._capacity_waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future[None]]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def first_offset(self) -> int:
+        """Offset of the oldest event which can be replayed"""
+        return self._first_offset
+
+    @property
+    def next_offset(self) -> int:
+        """Offset of the next event to be published"""
+        return self._first_offset + len(self._events)
+
+    def publish(self, order: Order) -> OrderEvent:
+        with self._lock:
+            event = OrderEvent(offset=self.next_offset, order=order)
+            self._events.append(event)
+            if len(self._events) >= 2 * self.retained_events:
+                trimmed = len(self._events) - self.retained_events
+                del self._events[:trimmed]
+                self._first_offset += trimmed
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.notify()
+        return event
+
+    def _has_capacity(self) -> bool:
+        return all(self.next_offset - subscription.cursor < self.max_lag for subscription in self._subscriptions)
+
+    async def wait_for_capacity(self) -> None:
+        """Wait until all subscribers are less than `max_lag` events behind"""
+        while True:
+            with self._lock:
+                if self._has_capacity():
+                    return
+                future = asyncio.get_running_loop().create_future()
+                self._capacity_waiters.append((asyncio.get_running_loop(), future))
+            await future
+
+    def _capacity_changed(self) -> None:
+        with self._lock:
+            if not self._capacity_waiters or not self._has_capacity():
+                return
+            waiters, self._capacity_waiters = self._capacity_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_set_result, future)
+
+    def get_events(self, from_offset: int, limit: int = READ_BATCH_SIZE) -> list[OrderEvent]:
+        """Get the retained events from an offset"""
+        with self._lock:
+            if from_offset < self._first_offset:
+                raise OrderEventsLostError(
+                    f"Order events from offset {from_offset} are no longer retained (oldest is {self._first_offset})"
+                )
+            start = from_offset - self._first_offset
+            return self._events[start : start + limit]
+
+    def subscribe(self, from_offset: int | None = None) -> "OrderSubscription":
+        """
+        Subscribe to the events from an offset (e.g. 0 or `first_offset` to replay all retained events),
+        or only to new events if None. Must be called in the event loop the subscription will be read in.
+        """
+        with self._lock:
+            subscription = OrderSubscription(self, self.next_offset if from_offset is None else from_offset)
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: "OrderSubscription") -> None:
+        with self._lock:
+            self._subscriptions.discard(subscription)
+        self._capacity_changed()
+
+
+class OrderSubscription:
+    """Cursor over the events of an order event bus, which is read with `async for event in subscription`"""
+
+    def __init__(self, bus: OrderEventBus, cursor: int):
+        self.bus = bus
+        # Offset of the next event to read
+        self.cursor = cursor
+        self._loop = asyncio.get_running_loop()
+        self._published = asyncio.Event()
+        self._buffer: list[OrderEvent] = []
+
+    def notify(self) -> None:
+        """Wake up the subscriber, from any thread, after an event was published"""
+        try:
+            self._loop.call_soon_threadsafe(self._published.set)
+        except RuntimeError:
+            # The subscriber's event loop has been closed
+            pass
+
+    async def read(self, limit: int = READ_BATCH_SIZE) -> list[OrderEvent]:
+        """Wait for the next events, advancing the cursor past them"""
+        while True:
+            self._published.clear()
+            if events := self.bus.get_events(self.cursor, limit):
+                self.cursor = events[-1].offset + 1
+                self.bus._capacity_changed()
+                return events
+            await self._published.wait()
+
+    def __aiter__(self) -> "OrderSubscription":
+        return self
+
+    async def __anext__(self) -> OrderEvent:
+        if not self._buffer:
+            self._buffer = await self.read()
+            self._buffer.reverse()
+        return self._buffer.pop()
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+    def __enter__(self) -> "OrderSubscription":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+@cache
+def get_order_event_bus() -> OrderEventBus:
+    """Get the order event bus which is shared by all order services in the process"""
+    return OrderEventBus()
+
+
+@dataclass
+class KitchenAggregates:
+    """Order aggregates for the kitchen, which are updated with each order event rather than by scanning all orders"""
+
+    pending_by_item: Counter[str] = field(default_factory=Counter)
+    orders_by_table: Counter[int] = field(default_factory=Counter)
+    orders: int = 0
+    # Offset of the next event to apply, so that replayed events are only counted once
+    cursor: int = 0
+
+    def apply(self, event: OrderEvent) -> None:
+        if event.offset < self.cursor:
+            return
+        self.pending_by_item.update(event.order.menu_items)
+        self.orders_by_table[event.order.table_number] += 1
+        self.orders += 1
+        self.cursor = event.offset + 1
+
+    def complete_item(self, menu_item: str, count: int = 1) -> None:
+        """Mark servings of a menu item as prepared, so they are no longer pending"""
+        if self.pending_by_item[menu_item] < count:
+            raise ValueError(f"Only {self.pending_by_item[menu_item]} of {menu_item!r} are pending")
+        self.pending_by_item[menu_item] -= count
+        if not self.pending_by_item[menu_item]:
+            del self.pending_by_item[menu_item]
+
+    async def consume(self, events: AsyncIterator[OrderEvent]) -> None:
+        async for event in events:
+            self.apply(event)
+
+
+def encode_event(event: OrderEvent) -> bytes:
+    return json.dumps({"offset": event.offset, "order": dump_order(event.order)}).encode() + b"\n"
+
+
+def decode_event(data: dict[str, Any]) -> OrderEvent:
+    return OrderEvent(offset=data["offset"], order=load_order(data["order"]))
+
+
+async def serve_order_events(bus: OrderEventBus, socket_path: Path | str) -> asyncio.Server:
+    """
+    Serve the order events of the bus to consumers in other processes over a Unix socket. Each connection sends a JSON
+    line with the offset to read from (`{"from_offset": null}` for only new events), and receives an event per line.
+    Each connection only reads events from the bus as fast as its consumer receives them.
+    """
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = json.loads(await reader.readline() or b"{}")
+            with bus.subscribe(request.get("from_offset")) as subscription:
+                while True:
+                    events = await subscription.read()
+                    writer.write(b"".join(encode_event(event) for event in events))
+                    await writer.drain()
+        except OrderEventsLostError as e:
+            writer.write(json.dumps({"error": str(e)}).encode() + b"\n")
+        except (ConnectionError, json.JSONDecodeError) as e:
+            logger.debug("Order events connection closed: %r", e)
+        except asyncio.CancelledError:
+            # The server is shutting down. The cancellation isn't propagated, since Python 3.11's streams report
+            # cancelled connection handlers as unhandled errors
+            pass
+        finally:
+            writer.close()
+
+    Path(socket_path).unlink(missing_ok=True)
+    return await asyncio.start_unix_server(handle_connection, path=socket_path)
+
+
+async def read_order_events(socket_path: Path | str, from_offset: int | None = None) -> AsyncIterator[OrderEvent]:
+    """Read the order events served over a Unix socket (by serve_order_events()) from an offset"""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        writer.write(json.dumps({"from_offset": from_offset}).encode() + b"\n")
+        while line := await reader.readline():
+            data = json.loads(line)
+            if "error" in data:
+                raise OrderEventsLostError(data["error"])
+            yield decode_event(data)
+    finally:
+        writer.close()
+
+
+def _set_result(future: asyncio.Future[None]) -> None:
+    if not future.done():
+        future.set_result(None)
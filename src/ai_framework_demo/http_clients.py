@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import importlib.util
+import threading
+from dataclasses import dataclass
+from functools import cache
+
+import httpx
+
+from ai_framework_demo.resilience import DEFAULT_RESILIENCE
+
+# Base URLs of the providers whose clients use the shared HTTP connection pools, used to open connections in advance
+PROVIDER_BASE_URLS = {
+    "openai": "https://api.openai.com/v1",
+    "anthropic": "https://api.anthropic.com",
+    "google-gla": "https://generativelanguage.googleapis.com",
+    "groq": "https://api.groq.com",
+    "mistral": "https://api.mistral.ai",
+    "ollama": "http://localhost:11434",
+}
+
+
+@dataclass(frozen=True)
+class HttpPoolConfig:
+    """Configuration of the HTTP connection pools shared by all model clients in the process"""
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30
+    # Only used if the h2 package is installed (`pip install httpx[http2]`)
+    http2: bool = True
+    # Default timeouts match those of the OpenAI and Anthropic SDKs
+    timeout: float = 600
+    connect_timeout: float = 5
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    @property
+    def use_http2(self) -> bool:
+        return self.http2 and importlib.util.find_spec("h2") is not None
+
+
+DEFAULT_HTTP_POOL = HttpPoolConfig()
+
+
+class EventLoopTransport(httpx.AsyncBaseTransport):
+    """
+    Transport which keeps a separate connection pool for each event loop it is used from, since connections are bound
+    to the event loop they were opened in (e.g. PydanticAI's sync requests run in the thread's own event loop, and
+    each worker process or benchmark runs in its own). Pools of event loops which have been closed are discarded.
+    """
+
+    def __init__(self, config: HttpPoolConfig):
+        self.config = config
+        self._transports: dict[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport] = {}
+        self._lock = threading.Lock()
+
+    def _get_transport(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if (transport := self._transports.get(loop)) is None:
+                for closed_loop in [other for other in self._transports if other.is_closed()]:
+                    # Its connections can't be closed gracefully without their event loop
+                    del self._transports[closed_loop]
+                transport = self._transports[loop] = httpx.AsyncHTTPTransport(
+                    limits=self.config.limits, http2=self.config.use_http2
+                )
+        return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._get_transport().handle_async_request(request)
+
+    async def aclose(self) -> None:
+        """Close the connections opened in the current event loop"""
+        with self._lock:
+            transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+@cache
+def get_async_http_client(config: HttpPoolConfig) -> httpx.AsyncClient:
+    """
+    Get the async HTTP client shared by all model clients in the process with the same configuration, so that
+    connections to each provider are kept alive and re-used by every session (avoiding a TLS handshake per session).
+    It can be used from any event loop, each of which gets its own connection pool.
+    """
+    return httpx.AsyncClient(
+        transport=EventLoopTransport(config),
+        timeout=httpx.Timeout(config.timeout, connect=config.connect_timeout),
+    )
+
+
+@cache
+def get_http_client(config: HttpPoolConfig) -> httpx.Client:
+    """Get the sync HTTP client shared by all model clients in the process with the same configuration"""
+    return httpx.Client(
+        limits=config.limits,
+        http2=config.use_http2,
+        timeout=httpx.Timeout(config.timeout, connect=config.connect_timeout),
+    )
+
+
+def build_http_pool_config(args: argparse.Namespace) -> HttpPoolConfig:
+    """
+    Build the HTTP connection pool configuration from the CLI arguments.
+    The timeout is the model request deadline, which is how it is enforced on sync requests.
+    """
+    return HttpPoolConfig(
+        max_connections=getattr(args, "http_max_connections", DEFAULT_HTTP_POOL.max_connections),
+        max_keepalive_connections=getattr(
+            args, "http_max_keepalive_connections", DEFAULT_HTTP_POOL.max_keepalive_connections
+        ),
+        http2=getattr(args, "http2", DEFAULT_HTTP_POOL.http2),
+        timeout=getattr(args, "call_timeout", DEFAULT_RESILIENCE.call_timeout) or DEFAULT_HTTP_POOL.timeout,
+    )
+
+
+async def warm_up_connections(model_name: str, config: HttpPoolConfig) -> bool:
+    """
+    Open connections to the model's provider in the shared HTTP clients, so the first request of a session
+    doesn't pay for connection setup. Returns whether the provider could be reached.
+    """
+    provider = model_name.split(":", 1)[0]
+    if (base_url := PROVIDER_BASE_URLS.get(provider)) is None:
+        return False
+    try:
+        # The response status doesn't matter (the request is unauthenticated), only that the connection is opened
+        await asyncio.gather(
+            get_async_http_client(config).head(base_url),
+            asyncio.to_thread(get_http_client(config).head, base_url),
+        )
+    except httpx.HTTPError:
+        return False
+    return True
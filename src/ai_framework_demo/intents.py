@@ -0,0 +1,235 @@
+import logging
+import re
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from functools import cache
+from typing import Literal
+
+from ai_framework_demo.llm import LLMResponse
+from ai_framework_demo.run_agent import AgentRunner, AgentRunnerWrapper
+from ai_framework_demo.services import DIETARY_TAG_DESCRIPTIONS, DietaryTag, MenuIndex, MenuService
+from ai_framework_demo.tracing import trace_span
+from ai_framework_demo.usage import TurnUsage
+
+logger = logging.getLogger(__name__)
+
+IntentName = Literal["menu", "menu_search"]
+
+# Keywords of dietary requirements (matched against normalised messages), by tag
+DIETARY_KEYWORDS: dict[str, DietaryTag] = {
+    "vegan": "VG",
+    "vegetarian": "V",
+    "veggie": "V",
+    "gluten free": "GF",
+    "coeliac": "GF",
+    "celiac": "GF",
+}
+# Common names of menu categories, in addition to the category names themselves
+CATEGORY_SYNONYMS: dict[str, str] = {"starter": "appetizers", "starters": "appetizers", "pudding": "desserts"}
+
+# Requests for the menu, e.g. "can I see the menu?" or "what's on the menu?"
+MENU_REQUEST_PATTERN = re.compile(
+    r"\b(show|see|view|read|get|have|bring)( me| us)?( a| the| your)?( full)? menu\b"
+    r"|\bwhat( else)?( is| s)? on (the |your )?menu\b"
+    r"|^(the )?menu( please)?$"
+)
+# Questions about what is available, e.g. "what's gluten free?" or "any vegan desserts?"
+QUESTION_PATTERN = re.compile(r"^(whats?|which|any|do you (have|do|serve)|have you got|show me|are there|is there)\b")
+# Negated questions (e.g. "what is not vegan?" or "anything without gluten?"), which are left to the model since the
+# router would answer with the opposite items
+NEGATION_PATTERN = re.compile(r"\b(not|non|without|except|other than|\w+n t)\b")
+# Messages which order something, which are left to the model
+ORDER_PATTERN = re.compile(r"\b(i|we)( ll| will| d| would)? (have|like|take|get|want)\b|\border\b")
+# Messages which confirm what the waiter proposed (e.g. an order), which are also left to the model
+AFFIRMATIVE_MESSAGES = frozenset(
+    {
+        "yes",
+        "yes please",
+        "yep",
+        "yeah",
+        "confirm",
+        "confirmed",
+        "correct",
+        "that s right",
+        "that s correct",
+        "yes that s right",
+        "yes that s correct",
+        "sounds good",
+        "perfect",
+    }
+)
+
+
+def normalise_message(message: str) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", message.lower()).strip()
+
+
+@dataclass
+class Intent:
+    """A turn which can be answered without the model"""
+
+    name: IntentName
+    # Dietary tags and category to search the menu for
+    tags: list[DietaryTag] = field(default_factory=list)
+    category: str | None = None
+
+
+class IntentClassifier:
+    """
+    Classifies user messages with keyword and regular expression rules, which only match messages that can be
+    answered from the services alone. Anything else (including anything which orders something or confirms an order,
+    negated questions and questions about a particular menu item) is left to the model, so orders are only ever
+    created by the model's create_order tool calls.
+    """
+
+    def __init__(self, menu_index: MenuIndex):
+        self.menu_index = menu_index
+        self.category_keywords: dict[str, str] = {}
+        for category in menu_index.menu:
+            name = normalise_message(category)
+            first_word = name.split()[0]
+            for keyword in (name, name.removesuffix("s"), first_word, first_word.removesuffix("s") + "s"):
+                self.category_keywords[keyword] = category
+        for synonym, name in CATEGORY_SYNONYMS.items():
+            if (category := self.category_keywords.get(name)) is not None:
+                self.category_keywords[synonym] = category
+
+    def classify(self, user_message: str) -> Intent | None:
+        text = normalise_message(user_message)
+        if text in AFFIRMATIVE_MESSAGES or ORDER_PATTERN.search(text) or NEGATION_PATTERN.search(text):
+            return None
+        if self.menu_index.item_name_words.intersection(text.split()):
+            return None
+        tags = [tag for keyword, tag in DIETARY_KEYWORDS.items() if re.search(rf"\b{keyword}\b", text)]
+        category = next(
+            (category for keyword, category in self.category_keywords.items() if re.search(rf"\b{keyword}\b", text)),
+            None,
+        )
+        if MENU_REQUEST_PATTERN.search(text):
+            return Intent(name="menu_search", tags=tags, category=category) if tags or category else Intent("menu")
+        if tags and QUESTION_PATTERN.match(text):
+            return Intent(name="menu_search", tags=tags, category=category)
+        return None
+
+
+@dataclass
+class IntentRouterStats:
+    """Turns routed by all intent routers in the process"""
+
+    conversations: int = 0
+    turns: int = 0
+    routed_turns: Counter[str] = field(default_factory=Counter)
+    model_requests: int = 0
+
+    def __str__(self) -> str:
+        routed = ", ".join(f"{intent}={count}" for intent, count in self.routed_turns.items())
+        requests_per_conversation = self.model_requests / self.conversations if self.conversations else 0
+        return (
+            f"routed_turns={self.routed_turns.total()}/{self.turns} ({routed or 'none'}) "
+            f"model_requests_per_conversation={requests_per_conversation:.2f}"
+        )
+
+
+@cache
+def get_intent_router_stats() -> IntentRouterStats:
+    return IntentRouterStats()
+
+
+class IntentRoutingAgentRunner(AgentRunnerWrapper):
+    """
+    Wraps an agent runner to answer turns which need no model (requests for the menu and questions about dietary
+    requirements) directly from the menu service. Routed turns have no side effects.
+    Routed turns are added to the wrapped runner's conversation history, so the model knows about them later.
+    """
+
+    def __init__(self, runner: AgentRunner, menu_service: MenuService, table_number: int):
+        super().__init__(runner)
+        self.menu_service = menu_service
+        self.table_number = table_number
+        self.classifier = IntentClassifier(menu_service.get_index())
+        # Turns answered by the router have no usage, so aren't in the wrapped runner's usage.
+        # Includes the turns of a conversation restored from a snapshot
+        self._turn_usage = list(runner.turn_usage)
+        self.stats = get_intent_router_stats()
+        self.stats.conversations += 1
+
+    @property
+    def turn_usage(self) -> list[TurnUsage]:  # type: ignore[override]
+        return self._turn_usage
+
+    def _route(self, user_message: str) -> LLMResponse | None:
+        """Answer the turn if its intent can be answered without the model"""
+        # The first turn (greeting) always goes to the model, which also sets up its conversation history
+        intent = self.classifier.classify(user_message) if self.turn_usage else None
+        response = self._answer(intent) if intent is not None else None
+        logger.info(
+            "Table %d turn %d: %s",
+            self.table_number,
+            len(self.turn_usage) + 1,
+            f"answered {intent.name} intent" if intent and response else "sent to model",
+        )
+        if intent is None or response is None:
+            return None
+        self.stats.routed_turns[intent.name] += 1
+        self.runner.record_turn(user_message, response)
+        self.turn_usage.append(TurnUsage())
+        return response
+
+    def _answer(self, intent: Intent) -> LLMResponse | None:
+        with trace_span("tool", f"intent:{intent.name}"):
+            match intent.name:
+                case "menu":
+                    return LLMResponse(
+                        message=f"Here is our menu:\n{format_menu(self.menu_service.get_menu())}\n"
+                        "What can I get for you?",
+                        end_conversation=False,
+                    )
+                case "menu_search":
+                    results = self.menu_service.search_menu(tags=intent.tags, category=intent.category)
+                    if not results:
+                        # Leave it to the model to suggest alternatives
+                        return None
+                    return LLMResponse(
+                        message=f"Here are our {describe_search(intent)}:\n{format_menu(results)}\n"
+                        'Items marked as an "option" can be prepared that way on request. What can I get for you?',
+                        end_conversation=False,
+                    )
+
+    def _record_model_turn(self) -> None:
+        self.turn_usage.append(self.runner.turn_usage[-1] if self.runner.turn_usage else TurnUsage())
+        self.stats.model_requests += self.turn_usage[-1].requests
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        self.stats.turns += 1
+        if (response := self._route(user_message)) is None:
+            response = self.runner.make_request(user_message)
+            self._record_model_turn()
+        return response
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        self.stats.turns += 1
+        if (response := self._route(user_message)) is None:
+            response = await self.runner.make_request_async(user_message)
+            self._record_model_turn()
+        return response
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        self.stats.turns += 1
+        if (response := self._route(user_message)) is not None:
+            on_message(response.message)
+        else:
+            response = await self.runner.stream_request(user_message, on_message)
+            self._record_model_turn()
+        return response
+
+
+def format_menu(menu: dict[str, list[str]]) -> str:
+    return "\n".join(f"{category}: {', '.join(items)}" for category, items in menu.items())
+
+
+def describe_search(intent: Intent) -> str:
+    """Describe the items searched for, e.g. "vegan, gluten-free desserts" """
+    tags = ", ".join(DIETARY_TAG_DESCRIPTIONS[tag] for tag in intent.tags)
+    category = intent.category.lower() if intent.category else "dishes"
+    return f"{tags} {category}" if tags else category
@@ -0,0 +1,47 @@
+import argparse
+import asyncio
+
+from rich.console import Console
+
+from ai_framework_demo.events import KitchenAggregates, read_order_events
+
+
+async def run_kitchen_display(socket_path: str, from_offset: int | None) -> None:
+    """Print orders as soon as they are created, with the servings of each dish pending"""
+    console = Console()
+    aggregates = KitchenAggregates()
+    async for event in read_order_events(socket_path, from_offset):
+        aggregates.apply(event)
+        order = event.order
+        console.print(
+            f"[bold]#{event.offset}[/bold] {order.created_at:%H:%M:%S} Table {order.table_number}: "
+            + ", ".join(order.menu_items)
+        )
+        console.print(
+            "[dim]Pending: "
+            + ", ".join(f"{item} x{count}" for item, count in aggregates.pending_by_item.most_common())
+            + "[/dim]"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Kitchen display, which shows orders as soon as the waiter creates them "
+        "(run the waiter with --order-events-socket)"
+    )
+    parser.add_argument("socket", help="Path of the Unix socket the order events are served on")
+    parser.add_argument(
+        "--from-offset",
+        type=int,
+        default=0,
+        help="Offset of the order event to replay from (default: 0, all retained orders), or -1 for only new orders",
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_kitchen_display(args.socket, None if args.from_offset < 0 else args.from_offset))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,153 @@
 import argparse
-from collections.abc import Sequence
+from collections.abc import Callable, Sequence
+from functools import cache
+from typing import Any, Literal
 
-from langchain.agents.agent import AgentExecutor
 from langchain.agents.format_scratchpad.tools import format_to_tool_messages
 from langchain.agents.output_parsers.tools import ToolsAgentOutputParser
 from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import Runnable, RunnablePassthrough
 from langchain_core.runnables.config import RunnableConfig
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.tools import BaseTool
 
-from ai_framework_demo.langchain.model import build_model_from_name_and_api_key
+from ai_framework_demo.cache import ResponseCache, build_response_cache
+from ai_framework_demo.http_clients import DEFAULT_HTTP_POOL, HttpPoolConfig, build_http_pool_config
+from ai_framework_demo.langchain.cache import ResponseCachingChatModel
+from ai_framework_demo.langchain.executor import ParallelToolsAgentExecutor
+from ai_framework_demo.langchain.memory import LangchainMessageAdapter, LangchainSummariser
+from ai_framework_demo.langchain.model import get_shared_model
+from ai_framework_demo.langchain.prompt import get_system_message_template
+from ai_framework_demo.langchain.routing import build_routing_model
+from ai_framework_demo.langchain.streaming import stream_structured_response_message
+from ai_framework_demo.langchain.structured_output import (
+    bind_tools_with_structured_output,
+    build_structured_output_mode,
+)
 from ai_framework_demo.langchain.tools import (
     CreateOrderTool,
     GetMenuTool,
+    SearchMenuTool,
     StructuredResponseTool,
+    to_prefetched_tool_messages,
 )
-from ai_framework_demo.llm import PROMPT_TEMPLATE, LLMResponse
+from ai_framework_demo.langchain.tracing import TracingCallbackHandler
+from ai_framework_demo.langchain.usage import TurnUsageCallbackHandler
+from ai_framework_demo.llm import LLMResponse, PrefetchedToolCall
+from ai_framework_demo.memory import MemoryPolicy, MemoryStats, build_memory_policy
+from ai_framework_demo.model_routing import ModelRoutes, build_model_routes
+from ai_framework_demo.resilience import ResilienceConfig, build_resilience_config
 from ai_framework_demo.run_agent import AgentRunner
 from ai_framework_demo.services import MenuService, OrderService
+from ai_framework_demo.snapshots import HistoryTracker
+from ai_framework_demo.tracing import current_turn_trace, trace_span
+from ai_framework_demo.usage import TurnUsage
 
 
-def get_agent_executor(
-    tools: Sequence[BaseTool], model_name: str, api_key: str | None = None
-) -> RunnableWithMessageHistory:
-    """
-    Construct an agent with an LLM model, tools and system prompt
-    """
-    model = build_model_from_name_and_api_key(
-        model_name=model_name,
-        api_key=api_key,
-    )
-
-    prompt = ChatPromptTemplate.from_messages(
+def build_agent_prompt(model_name: str) -> ChatPromptTemplate:
+    """Prompt of the agent, with the conversation history and the tool calls made so far in the current turn"""
+    return ChatPromptTemplate.from_messages(
         [
-            (
-                "system",
-                PROMPT_TEMPLATE,
-            ),
+            get_system_message_template(model_name),
             ("placeholder", "{chat_history}"),
             ("human", "{input}"),
             ("placeholder", "{agent_scratchpad}"),
         ]
     )
 
-    # Re-implement create_tool_calling_agent() here, but force tool use
-    llm_with_tools = model.bind_tools(tools, tool_choice=True)
-    agent = (
+
+@cache
+def get_tool_calling_agent(
+    model_name: str,
+    api_key: str | None = None,
+    response_cache: ResponseCache | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    structured_output: Literal["native", "tool"] = "tool",
+    model_routes: ModelRoutes | None = None,
+    resilience: ResilienceConfig | None = None,
+) -> Runnable:
+    """
+    Construct the runnable which prompts the LLM model with the tools bound to it, and parses its tool calls or
+    structured response. It is shared by all conversations in the process with the same configuration, since the
+    restaurant name and table number are inputs of the prompt and only the tools' schemas are bound to the model.
+    """
+    model: BaseChatModel
+    if model_routes is None:
+        model = get_shared_model(
+            model_name=model_name,
+            api_key=api_key,
+            http_pool=http_pool,
+            resilience=resilience,
+        )
+    else:
+        # Requests are routed between several models, which are identified by the routes in cache keys and prompts
+        model = build_routing_model(model_routes, api_key=api_key, http_pool=http_pool, resilience=resilience)
+        model_name = model_routes.name
+    if response_cache is not None:
+        model = ResponseCachingChatModel(model=model, model_name=model_name, response_cache=response_cache)
+
+    prompt = build_agent_prompt(model_name)
+
+    # The tools are constructed without their dependencies, which are only needed to run them
+    tools: list[BaseTool] = [
+        GetMenuTool.model_construct(),
+        SearchMenuTool.model_construct(),
+        CreateOrderTool.model_construct(),
+    ]
+    if structured_output == "tool":
+        tools.append(StructuredResponseTool())
+
+    # Re-implement create_tool_calling_agent() here, but with structured output
+    # (in the tool mode, by forcing tool use)
+    llm_with_tools = bind_tools_with_structured_output(model, tools, structured_output)
+    return (
         RunnablePassthrough.assign(agent_scratchpad=lambda x: format_to_tool_messages(x["intermediate_steps"]))
         | prompt
         | llm_with_tools
         | ToolsAgentOutputParser()
     )
 
-    agent_executor = AgentExecutor.from_agent_and_tools(agent=agent, tools=tools)
+
+def get_agent_executor(
+    tools: Sequence[BaseTool],
+    message_history: BaseChatMessageHistory,
+    model_name: str,
+    api_key: str | None = None,
+    response_cache: ResponseCache | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    structured_output: Literal["native", "tool"] = "tool",
+    model_routes: ModelRoutes | None = None,
+    resilience: ResilienceConfig | None = None,
+) -> RunnableWithMessageHistory:
+    """
+    Construct an agent with an LLM model, tools and system prompt.
+    The final output of the agent is the structured response to the user, serialised as JSON.
+    """
+    agent = get_tool_calling_agent(
+        model_name=model_name,
+        api_key=api_key,
+        response_cache=response_cache,
+        http_pool=http_pool,
+        structured_output=structured_output,
+        model_routes=model_routes,
+        resilience=resilience,
+    )
+
+    if structured_output == "tool":
+        # The agent finishes when the StructuredResponseTool is called, which returns its arguments directly
+        tools = [*tools, StructuredResponseTool()]
+
+    agent_executor = ParallelToolsAgentExecutor.from_agent_and_tools(
+        agent=agent, tools=tools, native_structured_output=structured_output == "native"
+    )
 
     # Enable chat history/memory (very convoluted)
     # Use a single message history (no need for multiple threads)
-    message_history = ChatMessageHistory()
-
     agent_with_chat_history = RunnableWithMessageHistory(
         runnable=agent_executor,  # type: ignore[arg-type]
         get_session_history=lambda _: message_history,
@@ -71,19 +159,115 @@ def get_agent_executor(
 
 
 class LangchainAgentRunner(AgentRunner):
+    message_history: ChatMessageHistory
+    memory: MemoryPolicy
+    memory_stats: list[MemoryStats]
+    turn_usage: list[TurnUsage]
+
     def __init__(self, menu_service: MenuService, order_service: OrderService, args: argparse.Namespace):
         # Initialise tools with dependencies
         tools = [
             GetMenuTool(menu_service=menu_service),
-            CreateOrderTool(order_service=order_service),
-            StructuredResponseTool(),
+            SearchMenuTool(menu_service=menu_service),
+            CreateOrderTool(order_service=order_service, table_number=args.table_number),
         ]
-        self.agent_executor = get_agent_executor(tools=tools, model_name=args.model, api_key=args.api_key)
+        self.structured_output = build_structured_output_mode(args)
+        self.message_history = ChatMessageHistory()
+        self.agent_executor = get_agent_executor(
+            tools=tools,
+            message_history=self.message_history,
+            model_name=args.model,
+            api_key=args.api_key,
+            response_cache=build_response_cache(args),
+            http_pool=build_http_pool_config(args),
+            structured_output=self.structured_output,
+            model_routes=build_model_routes(args),
+            resilience=build_resilience_config(args),
+        )
         self.static_input_content = {"restaurant_name": args.restaurant_name, "table_number": args.table_number}
         self.config: RunnableConfig = {"configurable": {"session_id": "not-even-used"}}
+        self.memory = build_memory_policy(
+            args,
+            summariser=LangchainSummariser(
+                get_shared_model(
+                    model_name=args.model,
+                    api_key=args.api_key,
+                    http_pool=build_http_pool_config(args),
+                    resilience=build_resilience_config(args),
+                )
+            ),
+        )
+        self.memory_adapter = LangchainMessageAdapter()
+        self.history_tracker = HistoryTracker(self.memory_adapter)
+        self.memory_stats = []
+        self.turn_usage = []
+
+    async def _compact_message_history(self) -> None:
+        """Apply the memory policy to the message history before it is sent with the next request"""
+        with trace_span("memory", "compact_history"):
+            messages, stats = await self.memory.compact(self.message_history.messages, self.memory_adapter)
+        self.message_history.messages = messages
+        self.memory_stats.append(stats)
+
+    def _compact_message_history_sync(self) -> None:
+        with trace_span("memory", "compact_history"):
+            messages, stats = self.memory.compact_sync(self.message_history.messages, self.memory_adapter)
+        self.message_history.messages = messages
+        self.memory_stats.append(stats)
+
+    def _get_turn_config(self) -> tuple[RunnableConfig, TurnUsageCallbackHandler]:
+        """Get the config for a request, with a callback handler which records the usage of the turn"""
+        usage_handler = TurnUsageCallbackHandler()
+        callbacks: list[BaseCallbackHandler] = [usage_handler]
+        if (trace := current_turn_trace()) is not None:
+            callbacks.append(TracingCallbackHandler(trace))
+        return self.config | {"callbacks": callbacks}, usage_handler
+
+    def _parse_response(self, result: dict[str, Any]) -> LLMResponse:
+        # De-serialise structured response (the model's content in the native mode) into an LLMResponse
+        with trace_span("parse", "LLMResponse"):
+            return LLMResponse.model_validate_json(result["output"])
 
     def make_request(self, user_message: str) -> LLMResponse:
-        result = self.agent_executor.invoke(self.static_input_content | {"input": user_message}, self.config)
-        # De-serialise structured response into an LLMResponse
-        response = LLMResponse.model_validate_json(result["output"])
+        self._compact_message_history_sync()
+        config, usage_handler = self._get_turn_config()
+        result = self.agent_executor.invoke(self.static_input_content | {"input": user_message}, config)
+        self.turn_usage.append(usage_handler.usage)
+        return self._parse_response(result)
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        await self._compact_message_history()
+        config, usage_handler = self._get_turn_config()
+        result = await self.agent_executor.ainvoke(self.static_input_content | {"input": user_message}, config)
+        self.turn_usage.append(usage_handler.usage)
+        return self._parse_response(result)
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        await self._compact_message_history()
+        config, usage_handler = self._get_turn_config()
+        result = await stream_structured_response_message(
+            self.agent_executor.astream_events(
+                self.static_input_content | {"input": user_message}, config, version="v2"
+            ),
+            on_message,
+            native_structured_output=self.structured_output == "native",
+        )
+        self.turn_usage.append(usage_handler.usage)
+        response = self._parse_response(result)
+        on_message(response.message)
         return response
+
+    def dump_history(self) -> tuple[bool, bytes]:
+        return self.history_tracker.dump(self.message_history.messages)
+
+    def load_history(self, chunks: list[bytes]) -> None:
+        self.message_history.messages = self.history_tracker.load(chunks)
+
+    def record_turn(self, user_message: str, response: LLMResponse) -> None:
+        # Stored in the same way as the agent's turns, with the serialised structured response as the AI message
+        self.message_history.add_messages(
+            [HumanMessage(content=user_message), AIMessage(content=response.model_dump_json())]
+        )
+
+    def add_tool_results(self, tool_calls: list[PrefetchedToolCall]) -> None:
+        self.message_history.add_messages(to_prefetched_tool_messages(tool_calls))
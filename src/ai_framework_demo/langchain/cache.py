@@ -0,0 +1,164 @@
+import json
+import time
+from collections.abc import AsyncIterator, Iterator, Sequence
+from typing import Any
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+
+from ai_framework_demo.cache import ResponseCache, ResponseCacheAdapter, ResponseCacheKey
+
+
+class LangchainResponseCacheAdapter(ResponseCacheAdapter[BaseMessage]):
+    def message_key(self, message: BaseMessage) -> str:
+        key = f"{message.type}:{json.dumps(message.content)}"
+        if isinstance(message, AIMessage) and message.tool_calls:
+            key += json.dumps([[tool_call["name"], tool_call["args"]] for tool_call in message.tool_calls])
+        return key
+
+    def user_message_text(self, message: BaseMessage) -> str | None:
+        if isinstance(message, HumanMessage):
+            return message.content if isinstance(message.content, str) else json.dumps(message.content)
+        return None
+
+    def tool_call_names(self, message: BaseMessage) -> list[str]:
+        if isinstance(message, AIMessage):
+            return [tool_call["name"] for tool_call in message.tool_calls]
+        return []
+
+    def dump_response(self, response: BaseMessage) -> str:
+        assert isinstance(response, AIMessage)
+        return json.dumps({"content": response.content, "tool_calls": response.tool_calls})
+
+    def load_response(self, value: str) -> AIMessage:
+        return AIMessage(**json.loads(value))
+
+
+class ResponseCachingChatModel(BaseChatModel):
+    """Chat model which serves responses from a response cache when possible, instead of making a request"""
+
+    model: BaseChatModel
+    model_name: str
+    response_cache: ResponseCache
+    adapter: LangchainResponseCacheAdapter = LangchainResponseCacheAdapter()
+
+    @property
+    def _llm_type(self) -> str:
+        return f"response-caching-{self.model._llm_type}"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> Runnable[LanguageModelInput, BaseMessage]:
+        # Let the wrapped model format the tools for its provider, then pass them through to its requests
+        bound_model = self.model.bind_tools(tools, **kwargs)
+        return self.bind(**getattr(bound_model, "kwargs", {}))
+
+    def _get_cached(self, messages: list[BaseMessage]) -> tuple[ResponseCacheKey | None, AIMessage | None]:
+        key = self.response_cache.get_key(self.model_name, messages, self.adapter)
+        if key is not None and (cached := self.response_cache.get(key)) is not None:
+            return key, self.adapter.load_response(cached.value)
+        return key, None
+
+    def _set_cached(self, key: ResponseCacheKey | None, message: BaseMessage, start: float) -> None:
+        if key is not None:
+            response = AIMessage(content=message.content, tool_calls=getattr(message, "tool_calls", []))
+            self.response_cache.set(key, response, time.perf_counter() - start, self.adapter)
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key, cached = self._get_cached(messages)
+        if cached is not None:
+            return ChatResult(generations=[ChatGeneration(message=cached)])
+        start = time.perf_counter()
+        result = self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self._set_cached(key, result.generations[0].message, start)
+        return result
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key, cached = self._get_cached(messages)
+        if cached is not None:
+            return ChatResult(generations=[ChatGeneration(message=cached)])
+        start = time.perf_counter()
+        result = await self.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self._set_cached(key, result.generations[0].message, start)
+        return result
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        key, cached = self._get_cached(messages)
+        if cached is not None:
+            chunk = _to_chunk(cached)
+            if run_manager:
+                run_manager.on_llm_new_token("", chunk=chunk)
+            yield chunk
+            return
+        start = time.perf_counter()
+        response: AIMessageChunk | None = None
+        for chunk in self.model._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            response = _add_chunk(response, chunk)
+            yield chunk
+        if response is not None:
+            self._set_cached(key, response, start)
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        key, cached = self._get_cached(messages)
+        if cached is not None:
+            chunk = _to_chunk(cached)
+            if run_manager:
+                await run_manager.on_llm_new_token("", chunk=chunk)
+            yield chunk
+            return
+        start = time.perf_counter()
+        response: AIMessageChunk | None = None
+        async for chunk in self.model._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            response = _add_chunk(response, chunk)
+            yield chunk
+        if response is not None:
+            self._set_cached(key, response, start)
+
+
+def _to_chunk(message: AIMessage) -> ChatGenerationChunk:
+    """Convert a cached response into a single stream chunk"""
+    return ChatGenerationChunk(
+        message=AIMessageChunk(
+            content=message.content,
+            tool_call_chunks=[
+                {
+                    "name": tool_call["name"],
+                    "args": json.dumps(tool_call["args"]),
+                    "id": tool_call["id"],
+                    "index": index,
+                }
+                for index, tool_call in enumerate(message.tool_calls)
+            ],
+        )
+    )
+
+
+def _add_chunk(response: AIMessageChunk | None, chunk: ChatGenerationChunk) -> AIMessageChunk:
+    message = chunk.message
+    assert isinstance(message, AIMessageChunk)
+    return message if response is None else response + message
@@ -0,0 +1,111 @@
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from functools import cache
+
+from langchain.agents.agent import AgentExecutor, NextStepOutput
+from langchain.agents.output_parsers.tools import ToolAgentAction
+from langchain_core.agents import AgentAction, AgentFinish, AgentStep
+from langchain_core.callbacks import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain_core.tools import BaseTool
+
+from ai_framework_demo.langchain.structured_output import get_response_content
+from ai_framework_demo.langchain.tools import current_tool_call_id
+
+# Maximum number of sync tool calls run at the same time by all agents in the process
+TOOL_THREAD_POOL_MAX_WORKERS = 8
+
+
+@cache
+def get_tool_thread_pool() -> ThreadPoolExecutor:
+    """Get the thread pool which runs the sync tool calls of all agents in the process"""
+    return ThreadPoolExecutor(max_workers=TOOL_THREAD_POOL_MAX_WORKERS, thread_name_prefix="tool")
+
+
+class ParallelToolsAgentExecutor(AgentExecutor):
+    """
+    AgentExecutor which runs the tool calls of each agent step concurrently in sync runs as well as async runs
+    (which already use `asyncio.gather()`), with the results returned to the model in the order of the calls.
+
+    A step which calls a `return_direct` tool (i.e. the structured response tool) alongside other tools finishes
+    once they have all run, instead of requiring another model request. Likewise with native structured output,
+    a step whose model response has the response to the user as its content as well as tool calls.
+
+    The ID of each tool call is set in `current_tool_call_id` while it runs, for the idempotency keys of orders.
+    """
+
+    native_structured_output: bool = False
+
+    def _iter_next_step(
+        self,
+        name_to_tool_map: dict[str, BaseTool],
+        color_mapping: dict[str, str],
+        inputs: dict[str, str],
+        intermediate_steps: list[tuple[AgentAction, str]],
+        run_manager: CallbackManagerForChainRun | None = None,
+    ) -> Iterator[AgentFinish | AgentAction | AgentStep]:
+        # The base implementation performs each action as soon as it is iterated, which starts it in the thread pool
+        # (see _perform_agent_action()), so all actions are started before waiting for the first one to complete
+        futures: list[Future[AgentStep]] = []
+        for output in super()._iter_next_step(name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager):
+            if isinstance(output, Future):
+                futures.append(output)
+            else:
+                yield output
+        for future in futures:
+            yield future.result()
+
+    def _perform_agent_action(  # type: ignore[override]
+        self,
+        name_to_tool_map: dict[str, BaseTool],
+        color_mapping: dict[str, str],
+        agent_action: AgentAction,
+        run_manager: CallbackManagerForChainRun | None = None,
+    ) -> Future[AgentStep]:
+        # Copy the context so the tool run is traced as a child of the agent run
+        return get_tool_thread_pool().submit(
+            copy_context().run,
+            self._perform_tool_call,
+            name_to_tool_map,
+            color_mapping,
+            agent_action,
+            run_manager,
+        )
+
+    def _perform_tool_call(
+        self,
+        name_to_tool_map: dict[str, BaseTool],
+        color_mapping: dict[str, str],
+        agent_action: AgentAction,
+        run_manager: CallbackManagerForChainRun | None = None,
+    ) -> AgentStep:
+        # Runs in a copy of the context, so the tool call ID is only set for this call
+        current_tool_call_id.set(agent_action.tool_call_id if isinstance(agent_action, ToolAgentAction) else None)
+        return super()._perform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+
+    async def _aperform_agent_action(
+        self,
+        name_to_tool_map: dict[str, BaseTool],
+        color_mapping: dict[str, str],
+        agent_action: AgentAction,
+        run_manager: AsyncCallbackManagerForChainRun | None = None,
+    ) -> AgentStep:
+        # Each action is run in its own task (by asyncio.gather()), so the tool call ID is only set for this call
+        current_tool_call_id.set(agent_action.tool_call_id if isinstance(agent_action, ToolAgentAction) else None)
+        return await super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+
+    def _consume_next_step(self, values: NextStepOutput) -> AgentFinish | list[tuple[AgentAction, str]]:
+        next_step_output = super()._consume_next_step(values)
+        if not isinstance(next_step_output, list) or not next_step_output:
+            return next_step_output
+        if self.native_structured_output:
+            # The content of a model response with tool calls is only kept in the message log of its actions
+            action, _ = next_step_output[0]
+            if isinstance(action, ToolAgentAction) and (content := get_response_content(action.message_log[-1])):
+                return AgentFinish(return_values={"output": content}, log=content)
+        elif len(next_step_output) > 1:
+            # The base implementation only returns directly if a single tool was called
+            for next_step_action in reversed(next_step_output):
+                if (tool_return := self._get_tool_return(next_step_action)) is not None:
+                    return tool_return
+        return next_step_output
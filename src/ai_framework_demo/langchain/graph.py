@@ -1,47 +1,229 @@
 import argparse
+import uuid
+from collections.abc import Callable
+from functools import cache, partial
+from typing import Annotated, Any, Literal, TypedDict
 
-from langchain_core.messages import HumanMessage
-from langchain_core.messages.ai import AIMessage
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage, RemoveMessage, ToolCall
 from langchain_core.prompts import ChatPromptTemplate
-from langgraph.graph import END, MessagesState, StateGraph
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import END, StateGraph
+from langgraph.graph.message import Messages, add_messages
+from langgraph.graph.state import CompiledStateGraph
 from langgraph.prebuilt.tool_node import ToolNode
 
-from ai_framework_demo.langchain.model import build_model_from_name_and_api_key
-from ai_framework_demo.langchain.tools import StructuredResponseTool, create_order, get_menu
-from ai_framework_demo.llm import PROMPT_TEMPLATE, LLMResponse
+from ai_framework_demo.cache import ResponseCache, build_response_cache
+from ai_framework_demo.http_clients import DEFAULT_HTTP_POOL, HttpPoolConfig, build_http_pool_config
+from ai_framework_demo.langchain.cache import ResponseCachingChatModel
+from ai_framework_demo.langchain.memory import LangchainMessageAdapter, LangchainSummariser
+from ai_framework_demo.langchain.model import get_shared_model
+from ai_framework_demo.langchain.prompt import get_system_message_template
+from ai_framework_demo.langchain.routing import build_routing_model
+from ai_framework_demo.langchain.streaming import stream_structured_response_message
+from ai_framework_demo.langchain.structured_output import (
+    bind_tools_with_structured_output,
+    build_structured_output_mode,
+    get_response_content,
+)
+from ai_framework_demo.langchain.tools import (
+    STRUCTURED_RESPONSE_TOOL_NAME,
+    StructuredResponseTool,
+    create_order,
+    get_configurable,
+    get_menu,
+    search_menu,
+    to_prefetched_tool_messages,
+)
+from ai_framework_demo.langchain.tracing import TracingCallbackHandler
+from ai_framework_demo.langchain.usage import TurnUsageCallbackHandler
+from ai_framework_demo.llm import LLMResponse, PrefetchedToolCall
+from ai_framework_demo.memory import MemoryPolicy, MemoryStats, build_memory_policy
+from ai_framework_demo.model_routing import ModelRoutes, build_model_routes
+from ai_framework_demo.resilience import ResilienceConfig, build_resilience_config
+from ai_framework_demo.run_agent import AgentRunner
 from ai_framework_demo.services import MenuService, OrderService
+from ai_framework_demo.snapshots import HistoryTracker
+from ai_framework_demo.tracing import current_turn_trace
 
+# ID of a RemoveMessage which removes all previous messages, so that the message history can be replaced
+# (equivalent to REMOVE_ALL_MESSAGES in newer versions of LangGraph)
+REMOVE_ALL_MESSAGES = "__remove_all__"
 
-class AgentState(MessagesState):
-    """Custom agent state object with dependencies.
-    This is what will be passed through each node of the graph"""
 
-    menu_service: MenuService
-    order_service: OrderService
-    restaurant_name: str
-    table_number: int
+def update_messages(left: Messages, right: Messages) -> Messages:
+    """Message reducer which appends or updates messages like `add_messages()`, but can also replace all of them"""
+    right_messages = right if isinstance(right, list) else [right]
+    for index in range(len(right_messages) - 1, -1, -1):
+        message = right_messages[index]
+        if isinstance(message, RemoveMessage) and message.id == REMOVE_ALL_MESSAGES:
+            return add_messages([], right_messages[index + 1 :])
+    return add_messages(left, right)
+
+
+class AgentState(TypedDict):
+    """
+    State of a conversation thread, which is persisted by the checkpointer between turns.
+    Services and other per-table dependencies are provided in the `configurable` of the run config instead,
+    so they are not copied into each checkpoint.
+    """
+
+    messages: Annotated[list[AnyMessage], update_messages]
     final_response: LLMResponse | None
 
 
-def get_agent_graph(model_name: str, api_key: str | None = None) -> StateGraph:
+def get_compaction_update(messages: list[AnyMessage], stats: MemoryStats, config: RunnableConfig) -> dict[str, Any]:
+    """Get the state update which replaces the message history with its compacted messages, if it was compacted"""
+    if (memory_stats := config["configurable"].get("memory_stats")) is not None:
+        memory_stats.append(stats)
+    if stats.tokens_after == stats.tokens_before and stats.messages_after == stats.messages_before:
+        return {}
+    return {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), *messages]}
+
+
+# Graph node functions which apply the memory policy to the message history before each turn
+async def acompact_messages(state: AgentState, config: RunnableConfig):
+    memory: MemoryPolicy | None = config["configurable"].get("memory")
+    if memory is None:
+        return {}
+    messages, stats = await memory.compact(state["messages"], LangchainMessageAdapter())
+    return get_compaction_update(messages, stats, config)
+
+
+def compact_messages(state: AgentState, config: RunnableConfig):
+    memory: MemoryPolicy | None = config["configurable"].get("memory")
+    if memory is None:
+        return {}
+    messages, stats = memory.compact_sync(state["messages"], LangchainMessageAdapter())
+    return get_compaction_update(messages, stats, config)
+
+
+def get_last_ai_message(state: AgentState) -> AIMessage:
+    """Get the latest model response, which may be followed by the results of its tool calls"""
+    for message in reversed(state["messages"]):
+        if isinstance(message, AIMessage):
+            return message
+    raise ValueError("No AI message in state")
+
+
+def split_tool_calls(message: AIMessage) -> tuple[ToolCall | None, list[ToolCall]]:
+    """Split the tool calls of a model response into the structured response tool call (if any) and the others"""
+    response_tool_call = None
+    tool_calls = []
+    for tool_call in message.tool_calls:
+        if tool_call["name"] == STRUCTURED_RESPONSE_TOOL_NAME:
+            response_tool_call = tool_call
+        else:
+            tool_calls.append(tool_call)
+    return response_tool_call, tool_calls
+
+
+def get_tool_node_input(state: AgentState) -> dict[str, list[AnyMessage]]:
+    """Get the input of the ToolNode, which runs the tool calls of the latest model response except the response"""
+    message = get_last_ai_message(state)
+    _, tool_calls = split_tool_calls(message)
+    return {"messages": [message.model_copy(update={"tool_calls": tool_calls})]}
+
+
+def should_continue(state: AgentState) -> Literal["tools", "respond"]:
+    """
+    Graph edge function that determines whether to run tool calls, or to respond to the user with a structured response
+    """
+    _, tool_calls = split_tool_calls(get_last_ai_message(state))
+    # If the response tool is called alongside other tools, they are run first then the response is given
+    # (without making another model request)
+    return "tools" if tool_calls else "respond"
+
+
+def has_response(message: AIMessage, native_structured_output: bool) -> bool:
+    """Whether a model response includes the structured response to the user"""
+    if native_structured_output:
+        return get_response_content(message) is not None
+    response_tool_call, _ = split_tool_calls(message)
+    return response_tool_call is not None
+
+
+def after_tools(state: AgentState, native_structured_output: bool = False) -> Literal["agent", "respond"]:
+    """Graph edge function that determines whether to respond to the user once the tool calls have been run"""
+    return "respond" if has_response(get_last_ai_message(state), native_structured_output) else "agent"
+
+
+# Graph node functions that build the final structured response to the user
+# This is done automatically by model.with_structured_output(), but that can't be used with other tools
+def respond_with_tool_call(state: AgentState):
+    # Construct the final answer from the arguments of the structured response tool call
+    structured_response_tool_call, _ = split_tool_calls(get_last_ai_message(state))
+    if structured_response_tool_call is None:
+        raise ValueError(f"Model responded without calling the {STRUCTURED_RESPONSE_TOOL_NAME} tool")
+    response = LLMResponse(**structured_response_tool_call["args"])
+    # Since we're using tool calling to return structured output,
+    # we need to add  a tool message corresponding to the LLMResult tool call,
+    # This is due to LLM providers' requirement that AI messages with tool calls
+    # need to be followed by a tool message for each tool call
+    tool_message = {
+        "type": "tool",
+        "content": "*message displayed to user*",
+        "tool_call_id": structured_response_tool_call["id"],
+        "name": STRUCTURED_RESPONSE_TOOL_NAME,  # Gemini (and maybe others) causes error if name is not set
+    }
+    # We return the final answer
+    return {"final_response": response, "messages": [tool_message]}
+
+
+def respond_with_content(state: AgentState):
+    # With native structured output, the content of the model response is the final answer
+    # (which is already in the message history, so no tool message is needed)
+    content = get_response_content(get_last_ai_message(state))
+    if content is None:
+        raise ValueError("Model responded without content")
+    return {"final_response": LLMResponse.model_validate_json(content)}
+
+
+def get_agent_graph(
+    model_name: str,
+    api_key: str | None = None,
+    response_cache: ResponseCache | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    structured_output: Literal["native", "tool"] = "tool",
+    model_routes: ModelRoutes | None = None,
+    resilience: ResilienceConfig | None = None,
+) -> StateGraph:
     """
     Build an agent graph that handles the cycle of LLM invocation and tool calling,
     as well as returning a structured response to the user
     """
-    model = build_model_from_name_and_api_key(
-        model_name=model_name,
-        api_key=api_key,
-    )
-    structured_response_tool = StructuredResponseTool()
+    model: BaseChatModel
+    if model_routes is None:
+        model = get_shared_model(
+            model_name=model_name,
+            api_key=api_key,
+            http_pool=http_pool,
+            resilience=resilience,
+        )
+    else:
+        # Requests are routed between several models, which are identified by the routes in cache keys and prompts
+        model = build_routing_model(model_routes, api_key=api_key, http_pool=http_pool, resilience=resilience)
+        model_name = model_routes.name
+    if response_cache is not None:
+        model = ResponseCachingChatModel(model=model, model_name=model_name, response_cache=response_cache)
+    native_structured_output = structured_output == "native"
 
-    # Register the StructuredResponseTool tool to enable structured output
-    tools = [get_menu, create_order, structured_response_tool]
+    tools = [get_menu, search_menu, create_order]
+    # The tool calls of each model response are run concurrently (in a thread pool for sync runs),
+    # with the tool messages returned in the order of the calls
+    tool_node = ToolNode(tools)
 
-    model_with_tools = model.bind_tools(tools, tool_choice=True)
+    # In the tool mode, register the StructuredResponseTool tool to enable structured output
+    model_with_tools = bind_tools_with_structured_output(
+        model, tools if native_structured_output else [*tools, StructuredResponseTool()], structured_output
+    )
     # Define a custom prompt template that will be used to insert the dynamic system prompt before passing to the LLM
     prompt = ChatPromptTemplate.from_messages(
         [
-            ("system", PROMPT_TEMPLATE),
+            get_system_message_template(model_name),
             ("placeholder", "{messages}"),
         ]
     )
@@ -49,108 +231,225 @@ def get_agent_graph(model_name: str, api_key: str | None = None) -> StateGraph:
     # Create a chain with the prompt pre-processor and the model with tools
     model_with_prompt = prompt | model_with_tools
 
-    # Define the grpah node function for calling the model
-    def call_model(state: AgentState):
-        # print("calling model with state: ", state)
-        response = model_with_prompt.invoke(state)  # type: ignore[arg-type]
+    def get_prompt_input(state: AgentState, config: RunnableConfig) -> dict[str, Any]:
+        return {
+            "messages": state["messages"],
+            "restaurant_name": get_configurable(config, "restaurant_name"),
+            "table_number": get_configurable(config, "table_number"),
+        }
+
+    # Define the graph node functions for calling the model (with sync and async implementations)
+    def call_model(state: AgentState, config: RunnableConfig):
+        response = model_with_prompt.invoke(get_prompt_input(state, config), config)
         # Return response as a message list to be appended to the message history
         return {"messages": [response]}
 
-    # Define the graph node function that builds the final structured response to the user
-    # This is done automatically by model.with_structured_output(), but that can't be used with other tools
-    def respond(state: AgentState):
-        # Construct the final answer from the arguments of the last tool call
-        llm_response_message = state["messages"][-1]
-        assert isinstance(llm_response_message, AIMessage)
-
-        structured_response_tool_call = llm_response_message.tool_calls[0]
-        response = LLMResponse(**structured_response_tool_call["args"])
-        # Since we're using tool calling to return structured output,
-        # we need to add  a tool message corresponding to the LLMResult tool call,
-        # This is due to LLM providers' requirement that AI messages with tool calls
-        # need to be followed by a tool message for each tool call
-        tool_message = {
-            "type": "tool",
-            "content": "*message displayed to user*",
-            "tool_call_id": structured_response_tool_call["id"],
-            "name": structured_response_tool.name,  # Gemini (and maybe others) causes error if name is not set
-        }
-        # We return the final answer
-        return {"final_response": response, "messages": [tool_message]}
-
-    # Define the graph edge function that determines whether to continue processing tool calls,
-    # or to respond to the user with a structured response
-    def should_continue(state: AgentState):
-        last_message = state["messages"][-1]
-        assert isinstance(last_message, AIMessage)
-
-        # If there is only one tool call and it is the response tool call we respond to the user
-        if len(last_message.tool_calls) == 1 and last_message.tool_calls[0]["name"] == structured_response_tool.name:
-            return "respond"
-        # Otherwise we will use the tool node again
-        else:
-            return "continue"
+    async def acall_model(state: AgentState, config: RunnableConfig):
+        response = await model_with_prompt.ainvoke(get_prompt_input(state, config), config)
+        return {"messages": [response]}
+
+    # Define the graph node functions which run the tool calls other than the structured response
+    def call_tools(state: AgentState, config: RunnableConfig):
+        return tool_node.invoke(get_tool_node_input(state), config)
+
+    async def acall_tools(state: AgentState, config: RunnableConfig):
+        return await tool_node.ainvoke(get_tool_node_input(state), config)
 
     # Define a new graph
     workflow = StateGraph(AgentState)
 
-    # Define the two nodes we will cycle between
-    workflow.add_node("agent", call_model)
-    workflow.add_node("respond", respond)
-    workflow.add_node("tools", ToolNode(tools))
+    # Define the nodes, with the memory node run once at the start of each turn,
+    # then cycling between the agent and tools nodes
+    workflow.add_node("memory", RunnableLambda(compact_messages, afunc=acompact_messages))
+    workflow.add_node("agent", RunnableLambda(call_model, afunc=acall_model))
+    workflow.add_node("respond", respond_with_content if native_structured_output else respond_with_tool_call)
+    workflow.add_node("tools", RunnableLambda(call_tools, afunc=acall_tools))
 
-    # Set the entrypoint as `agent`
+    # Set the entrypoint as `memory`
     # This means that this node is the first one called
-    workflow.set_entry_point("agent")
+    workflow.set_entry_point("memory")
+    workflow.add_edge("memory", "agent")
 
     # We now add a conditional edge
+    workflow.add_conditional_edges("agent", should_continue)
     workflow.add_conditional_edges(
-        "agent",
-        should_continue,
-        {
-            "continue": "tools",
-            "respond": "respond",
-        },
+        "tools", partial(after_tools, native_structured_output=native_structured_output), ["agent", "respond"]
     )
-
-    workflow.add_edge("tools", "agent")
     workflow.add_edge("respond", END)
 
     return workflow
 
 
-def run_langgraph_agent(args: argparse.Namespace):
-    agent_graph = get_agent_graph(model_name=args.model, api_key=args.api_key).compile()
+@cache
+def get_checkpointer(checkpoint_db: str | None = None) -> BaseCheckpointSaver:
+    """
+    Get the checkpointer which stores the state of each conversation thread, shared by all graphs in the process.
+    Conversations are stored in memory, or in a SQLite database if a path is provided.
+    """
+    if checkpoint_db is None:
+        return MemorySaver()
+
+    import sqlite3
+
+    # Requires the langgraph-checkpoint-sqlite package
+    from ai_framework_demo.langchain.sqlite_checkpoint import ThreadedSqliteSaver
+
+    connection = sqlite3.connect(checkpoint_db, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return ThreadedSqliteSaver(connection)
 
-    # Initialize services
-    menu_service = MenuService()
-    order_service = OrderService()
 
-    # Initialise graph state
-    state = AgentState(
-        menu_service=menu_service,
-        order_service=order_service,
-        restaurant_name=args.restaurant_name,
-        table_number=args.table_number,
-        messages=[HumanMessage(content="*Greet the customer*")],
-        final_response=None,
+@cache
+def get_compiled_agent_graph(
+    model_name: str,
+    api_key: str | None = None,
+    response_cache: ResponseCache | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    checkpoint_db: str | None = None,
+    structured_output: Literal["native", "tool"] = "tool",
+    model_routes: ModelRoutes | None = None,
+    resilience: ResilienceConfig | None = None,
+) -> CompiledStateGraph:
+    """
+    Get the agent graph compiled with a checkpointer, which is shared by all conversations in the process
+    (each conversation is stored by the checkpointer in its own thread)
+    """
+    agent_graph = get_agent_graph(
+        model_name, api_key, response_cache, http_pool, structured_output, model_routes, resilience
     )
+    return agent_graph.compile(checkpointer=get_checkpointer(checkpoint_db))
+
+
+class LangGraphAgentRunner(AgentRunner):
+    """
+    Runs the LangGraph agent, with the conversation history of each table stored in its own checkpointer thread,
+    so only the new user message needs to be sent with each turn
+    """
+
+    agent_graph: CompiledStateGraph
+    config: RunnableConfig
+    memory: MemoryPolicy
+    memory_stats: list[MemoryStats]
+
+    def __init__(self, menu_service: MenuService, order_service: OrderService, args: argparse.Namespace):
+        checkpoint_db = getattr(args, "checkpoint_db", None)
+        self.structured_output = build_structured_output_mode(args)
+        self.agent_graph = get_compiled_agent_graph(
+            model_name=args.model,
+            api_key=args.api_key,
+            response_cache=build_response_cache(args),
+            http_pool=build_http_pool_config(args),
+            checkpoint_db=checkpoint_db,
+            structured_output=self.structured_output,
+            model_routes=build_model_routes(args),
+            resilience=build_resilience_config(args),
+        )
+        self.memory = build_memory_policy(
+            args,
+            summariser=LangchainSummariser(
+                get_shared_model(
+                    model_name=args.model,
+                    api_key=args.api_key,
+                    http_pool=build_http_pool_config(args),
+                    resilience=build_resilience_config(args),
+                )
+            ),
+        )
+        self.memory_stats = []
+        self.turn_usage = []
+        self.history_tracker = HistoryTracker(LangchainMessageAdapter())
+        # Resume an existing conversation if a thread ID is provided, otherwise start a new one for the table
+        self.thread_id = getattr(args, "thread_id", None) or f"table-{args.table_number}-{uuid.uuid4().hex[:8]}"
+        self.checkpoint_db = checkpoint_db
+        self.config = {
+            "configurable": {
+                "thread_id": self.thread_id,
+                "menu_service": menu_service,
+                "order_service": order_service,
+                "restaurant_name": args.restaurant_name,
+                "table_number": args.table_number,
+                "memory": self.memory,
+                "memory_stats": self.memory_stats,
+            }
+        }
+
+    def _get_turn_input(self, user_message: str) -> dict[str, Any]:
+        # Only the new message is sent, the rest of the state is loaded from the checkpointer
+        return {"messages": [HumanMessage(content=user_message)]}
+
+    def _get_turn_config(self) -> tuple[RunnableConfig, TurnUsageCallbackHandler]:
+        """Get the config for a request, with a callback handler which records the usage of the turn"""
+        usage_handler = TurnUsageCallbackHandler()
+        callbacks: list[BaseCallbackHandler] = [usage_handler]
+        if (trace := current_turn_trace()) is not None:
+            callbacks.append(TracingCallbackHandler(trace))
+        return self.config | {"callbacks": callbacks}, usage_handler
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        config, usage_handler = self._get_turn_config()
+        state = self.agent_graph.invoke(self._get_turn_input(user_message), config)
+        self.turn_usage.append(usage_handler.usage)
+        return state["final_response"]
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        config, usage_handler = self._get_turn_config()
+        state = await self.agent_graph.ainvoke(self._get_turn_input(user_message), config)
+        self.turn_usage.append(usage_handler.usage)
+        return state["final_response"]
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        config, usage_handler = self._get_turn_config()
+        state = await stream_structured_response_message(
+            self.agent_graph.astream_events(self._get_turn_input(user_message), config, version="v2"),
+            on_message,
+            native_structured_output=self.structured_output == "native",
+        )
+        self.turn_usage.append(usage_handler.usage)
+        # end_conversation is only resolved once the whole response has been generated
+        response: LLMResponse = state["final_response"]
+        on_message(response.message)
+        return response
+
+    def record_turn(self, user_message: str, response: LLMResponse) -> None:
+        # Recorded as an update by the respond node, so the next turn starts from the entry point as usual
+        self.agent_graph.update_state(
+            self.config,
+            {
+                "messages": [HumanMessage(content=user_message), AIMessage(content=response.model_dump_json())],
+                "final_response": response,
+            },
+            as_node="respond",
+        )
 
-    while True:
-        response_state = agent_graph.invoke(state)
-        print(response_state["messages"])
-        final_response: LLMResponse = response_state["final_response"]
-        print("AI Waiter:", final_response.message)
+    def add_tool_results(self, tool_calls: list[PrefetchedToolCall]) -> None:
+        self.agent_graph.update_state(
+            self.config, {"messages": to_prefetched_tool_messages(tool_calls)}, as_node="respond"
+        )
 
-        if final_response.end_conversation:
-            break
+    def dump_history(self) -> tuple[bool, bytes]:
+        return self.history_tracker.dump(self.agent_graph.get_state(self.config).values.get("messages", []))
 
-        user_message = input("You: ")
+    def load_history(self, chunks: list[bytes]) -> None:
+        messages = self.history_tracker.load(chunks)
+        self.agent_graph.update_state(
+            self.config, {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), *messages]}, as_node="respond"
+        )
 
-        # Add user message to the message history
-        state["messages"] = response_state["messages"] + [HumanMessage(content=user_message)]
-        print(state["messages"])
+    def discard_failed_turn(self, user_message: str) -> None:
+        # The messages of a failed turn which were checkpointed before it failed (e.g. a tool call without its result)
+        # are removed, from the turn's user message onwards
+        messages = self.agent_graph.get_state(self.config).values.get("messages", [])
+        for index in range(len(messages) - 1, -1, -1):
+            if isinstance(messages[index], HumanMessage) and messages[index].content == user_message:
+                self.agent_graph.update_state(
+                    self.config,
+                    {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), *messages[:index]]},
+                    as_node="respond",
+                )
+                return
 
-    # Show orders
-    if orders := order_service.get_orders():
-        print("Order placed: ", orders)
+    def close(self) -> None:
+        # Conversations stored in memory can't be resumed, so are deleted when the session ends
+        if self.checkpoint_db is None:
+            assert isinstance(self.agent_graph.checkpointer, BaseCheckpointSaver)
+            self.agent_graph.checkpointer.delete_thread(self.thread_id)
@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AnyMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from pydantic import TypeAdapter
+
+from ai_framework_demo.llm import parse_partial_message
+from ai_framework_demo.memory import SUMMARY_PREFIX, MessageAdapter, Summariser
+
+# Serialises messages with their type, so they are loaded as the right message classes
+MESSAGES_TYPE_ADAPTER = TypeAdapter(list[AnyMessage])
+
+
+class LangchainMessageAdapter(MessageAdapter[BaseMessage]):
+    def message_text(self, message: BaseMessage) -> str:
+        text = message.content if isinstance(message.content, str) else json.dumps(message.content)
+        if isinstance(message, AIMessage) and message.tool_calls:
+            text += json.dumps(message.tool_calls)
+        return text
+
+    def is_turn_start(self, message: BaseMessage) -> bool:
+        return isinstance(message, HumanMessage)
+
+    def split_pinned(self, messages: list[BaseMessage]) -> tuple[list[BaseMessage], list[BaseMessage]]:
+        # The system prompt is part of the prompt template rather than the history,
+        # so only a summary of earlier conversation needs to be pinned
+        pinned_count = 0
+        while pinned_count < len(messages) and isinstance(messages[pinned_count], SystemMessage):
+            pinned_count += 1
+        return messages[:pinned_count], messages[pinned_count:]
+
+    def join_pinned(self, pinned: list[BaseMessage], messages: list[BaseMessage]) -> list[BaseMessage]:
+        return [*pinned, *messages]
+
+    def tool_return_names(self, message: BaseMessage) -> list[str]:
+        if isinstance(message, ToolMessage) and message.name:
+            return [message.name]
+        return []
+
+    def replace_tool_returns(self, message: BaseMessage, tool_names: set[str], content: str) -> BaseMessage:
+        if not isinstance(message, ToolMessage) or message.name not in tool_names:
+            return message
+        return message.model_copy(update={"content": content})
+
+    def get_summary(self, pinned: list[BaseMessage]) -> str | None:
+        for message in pinned:
+            if isinstance(message.content, str) and message.content.startswith(SUMMARY_PREFIX):
+                return message.content.removeprefix(SUMMARY_PREFIX)
+        return None
+
+    def set_summary(self, pinned: list[BaseMessage], summary: str) -> list[BaseMessage]:
+        pinned = [
+            message
+            for message in pinned
+            if not (isinstance(message.content, str) and message.content.startswith(SUMMARY_PREFIX))
+        ]
+        return [*pinned, SystemMessage(content=summary)]
+
+    def format_transcript(self, messages: list[BaseMessage]) -> str:
+        lines: list[str] = []
+        for message in messages:
+            if isinstance(message, HumanMessage):
+                lines.append(f"Customer: {message.content}")
+            elif isinstance(message, AIMessage):
+                if isinstance(message.content, str) and message.content:
+                    # The legacy agent stores the serialised structured response as the message content
+                    lines.append(f"Waiter: {parse_partial_message(message.content) or message.content}")
+                for tool_call in message.tool_calls:
+                    if "message" in tool_call["args"]:
+                        lines.append(f"Waiter: {tool_call['args']['message']}")
+                    else:
+                        lines.append(f"Waiter called tool {tool_call['name']}({json.dumps(tool_call['args'])})")
+        return "\n".join(lines)
+
+    def dump_messages(self, messages: list[BaseMessage]) -> bytes:
+        return MESSAGES_TYPE_ADAPTER.dump_json(messages)
+
+    def load_messages(self, data: bytes) -> list[BaseMessage]:
+        return list(MESSAGES_TYPE_ADAPTER.validate_json(data))
+
+
+class LangchainSummariser(Summariser):
+    """Summarises conversation transcripts using the given model"""
+
+    def __init__(self, model: BaseChatModel):
+        self.model = model
+
+    async def summarise(self, prompt: str) -> str:
+        # Use the sync client in a thread, since provider SDKs may cache async clients bound to another event loop
+        return await asyncio.to_thread(self.summarise_sync, prompt)
+
+    def summarise_sync(self, prompt: str) -> str:
+        return self.model.invoke(prompt).text()
@@ -1,13 +1,67 @@
+from functools import cache
+
 from langchain.chat_models import init_chat_model
 from langchain_core.language_models import BaseChatModel
 
+from ai_framework_demo.http_clients import DEFAULT_HTTP_POOL, HttpPoolConfig, get_async_http_client, get_http_client
+from ai_framework_demo.resilience import ResilienceConfig, ResilientCaller
+
+
+def build_model_from_name_and_api_key(
+    model_name: str,
+    api_key: str | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    max_retries: int | None = None,
+) -> BaseChatModel:
+    """
+    Build a chat model from its name, with `max_retries` overriding the number of retries made by the provider SDK
+    (where the SDK retries requests itself)
+    """
+    provider, model = model_name.split(":", 1)
+    if provider == "scripted":
+        # Deterministic stand-in model which replays a scripted conversation, for running without a provider
+        from ai_framework_demo.langchain.scripted_model import ScriptedChatModel
+        from ai_framework_demo.scripted import parse_scripted_model_name
+
+        conversation, latency = parse_scripted_model_name(model)
+        return ScriptedChatModel(conversation=conversation, latency=latency)
 
-def build_model_from_name_and_api_key(model_name: str, api_key: str | None = None) -> BaseChatModel:
-    provider, model = model_name.split(":")
     api_key_arg_mapping = {
         "openai": "api_key",
         "anthropic": "api_key",
         "google-genai": "google_api_key",
     }
     init_kwargs = {api_key_arg_mapping[provider]: api_key} if api_key and provider in api_key_arg_mapping else {}
+    if provider == "openai":
+        # Include token usage (including cached prompt tokens) in streamed responses
+        init_kwargs["stream_usage"] = True
+        # Share keep-alive connections between model clients
+        # (Anthropic clients already share process-wide HTTP clients internally)
+        init_kwargs["http_client"] = get_http_client(http_pool)
+        init_kwargs["http_async_client"] = get_async_http_client(http_pool)
+    if max_retries is not None and provider in ("openai", "anthropic"):
+        init_kwargs["max_retries"] = max_retries
     return init_chat_model(model=model, model_provider=provider, **init_kwargs)  # type: ignore[call-overload]
+
+
+@cache
+def get_shared_model(
+    model_name: str,
+    api_key: str | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    resilience: ResilienceConfig | None = None,
+) -> BaseChatModel:
+    """
+    Get a chat model instance which is shared by all agents in the process using the same model name and API key,
+    so that concurrent sessions re-use the same client instead of each building their own.
+    With a resilience policy, requests are retried by the policy instead of the provider SDK.
+    """
+    if resilience is None:
+        return build_model_from_name_and_api_key(model_name=model_name, api_key=api_key, http_pool=http_pool)
+
+    from ai_framework_demo.langchain.resilience import ResilientChatModel
+
+    model = build_model_from_name_and_api_key(
+        model_name=model_name, api_key=api_key, http_pool=http_pool, max_retries=0
+    )
+    return ResilientChatModel(model=model, caller=ResilientCaller(model_name, api_key, resilience))
@@ -0,0 +1,21 @@
+from typing import Any
+
+from ai_framework_demo.llm import PROMPT_TEMPLATE, TABLE_PROMPT_TEMPLATE
+
+
+def get_system_message_template(model_name: str) -> tuple[str, Any]:
+    """
+    Get the system message template for a ChatPromptTemplate, with the static part of the prompt first
+    so that the prompt prefix can be cached by the model provider.
+    OpenAI caches prompt prefixes automatically, whereas Anthropic requires a cache breakpoint.
+    """
+    if model_name.startswith("anthropic:"):
+        return (
+            "system",
+            [
+                # Anthropic caches the prompt up to and including this block (tool definitions come before system)
+                {"type": "text", "text": PROMPT_TEMPLATE, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": TABLE_PROMPT_TEMPLATE},
+            ],
+        )
+    return "system", PROMPT_TEMPLATE + TABLE_PROMPT_TEMPLATE
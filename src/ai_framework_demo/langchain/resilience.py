@@ -0,0 +1,94 @@
+from collections.abc import AsyncIterator, Iterator, Sequence
+from typing import Any
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult, LLMResult
+from langchain_core.runnables import Runnable
+
+from ai_framework_demo.langchain.usage import turn_usage_from_llm_result
+from ai_framework_demo.resilience import ResilientCaller
+
+
+class ResilientChatModel(BaseChatModel):
+    """Chat model whose requests are made with a deadline and retried on transient errors by a ResilientCaller"""
+
+    model: BaseChatModel
+    caller: ResilientCaller
+
+    @property
+    def _llm_type(self) -> str:
+        return f"resilient-{self.model._llm_type}"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> Runnable[LanguageModelInput, BaseMessage]:
+        # Let the wrapped model format the tools for its provider, then pass them through to its requests
+        bound_model = self.model.bind_tools(tools, **kwargs)
+        return self.bind(**getattr(bound_model, "kwargs", {}))
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return self.caller.call_sync(
+            lambda: self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs),
+            lambda result: turn_usage_from_llm_result(LLMResult(generations=[result.generations])),
+        )
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await self.caller.call(
+            lambda: self.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs),
+            lambda result: turn_usage_from_llm_result(LLMResult(generations=[result.generations])),
+        )
+
+    # Only starting a stream (up to its first chunk) is retried and subject to the request deadline,
+    # since the chunks are passed on as they arrive
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        def start_stream() -> tuple[Iterator[ChatGenerationChunk], ChatGenerationChunk | None]:
+            chunks = self.model._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            return chunks, next(chunks, None)
+
+        chunks, response = self.caller.call_sync(start_stream)
+        if response is None:
+            return
+        yield response
+        for chunk in chunks:
+            response += chunk
+            yield chunk
+        self.caller.record_usage(turn_usage_from_llm_result(LLMResult(generations=[[response]])))
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        async def start_stream() -> tuple[AsyncIterator[ChatGenerationChunk], ChatGenerationChunk | None]:
+            chunks = self.model._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            return chunks, await anext(chunks, None)
+
+        chunks, response = await self.caller.call(start_stream)
+        if response is None:
+            return
+        yield response
+        async for chunk in chunks:
+            response += chunk
+            yield chunk
+        self.caller.record_usage(turn_usage_from_llm_result(LLMResult(generations=[[response]])))
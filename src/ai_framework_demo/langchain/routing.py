@@ -0,0 +1,164 @@
+import time
+from collections.abc import AsyncIterator, Iterator, Sequence
+from typing import Any
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult, LLMResult
+from langchain_core.runnables import Runnable
+
+from ai_framework_demo.http_clients import DEFAULT_HTTP_POOL, HttpPoolConfig
+from ai_framework_demo.langchain.cache import LangchainResponseCacheAdapter
+from ai_framework_demo.langchain.model import get_shared_model
+from ai_framework_demo.langchain.usage import turn_usage_from_llm_result
+from ai_framework_demo.model_routing import ModelRouter, ModelRoutes, get_model_router
+from ai_framework_demo.resilience import ResilienceConfig
+from ai_framework_demo.usage import TurnUsage
+
+
+class RoutingChatModel(BaseChatModel):
+    """Chat model which routes each request between several chat models with a ModelRouter"""
+
+    models: dict[str, BaseChatModel]
+    router: ModelRouter
+    adapter: LangchainResponseCacheAdapter = LangchainResponseCacheAdapter()
+
+    @property
+    def _llm_type(self) -> str:
+        return "routing"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> Runnable[LanguageModelInput, BaseMessage]:
+        # Each model formats the tools for its own provider, so the arguments bound by each are passed to its requests
+        return self.bind(
+            routed_kwargs={
+                model_name: getattr(model.bind_tools(tools, **kwargs), "kwargs", {})
+                for model_name, model in self.models.items()
+            }
+        )
+
+    def _get_user_message(self, messages: list[BaseMessage]) -> str | None:
+        return next(
+            (text for message in reversed(messages) if (text := self.adapter.user_message_text(message)) is not None),
+            None,
+        )
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        routed_kwargs: dict[str, dict[str, Any]] | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return self.router.run_sync(
+            self._get_user_message(messages),
+            lambda model_name: self.models[model_name]._generate(
+                messages, stop=stop, run_manager=run_manager, **(routed_kwargs or {}).get(model_name, {}), **kwargs
+            ),
+            lambda result: _get_usage(result.generations),
+        )
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        routed_kwargs: dict[str, dict[str, Any]] | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await self.router.run(
+            self._get_user_message(messages),
+            lambda model_name: self.models[model_name]._agenerate(
+                messages, stop=stop, run_manager=run_manager, **(routed_kwargs or {}).get(model_name, {}), **kwargs
+            ),
+            lambda result: _get_usage(result.generations),
+        )
+
+    # Streamed requests fall back to the next model if no chunk is received, but are not hedged,
+    # since the chunks are passed on as they arrive
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        routed_kwargs: dict[str, dict[str, Any]] | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        candidates = self.router.route(self._get_user_message(messages))
+        for index, model_name in enumerate(candidates):
+            start = time.perf_counter()
+            chunks = self.models[model_name]._stream(
+                messages, stop=stop, run_manager=run_manager, **(routed_kwargs or {}).get(model_name, {}), **kwargs
+            )
+            try:
+                response = next(chunks)
+            except StopIteration:
+                return
+            except Exception as e:
+                self.router.record_failure(model_name, e)
+                if index == len(candidates) - 1:
+                    raise
+                self.router.record_fallback()
+                continue
+            yield response
+            for chunk in chunks:
+                response += chunk
+                yield chunk
+            self.router.record_success(model_name, time.perf_counter() - start, _get_usage([response]))
+            return
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        routed_kwargs: dict[str, dict[str, Any]] | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        candidates = self.router.route(self._get_user_message(messages))
+        for index, model_name in enumerate(candidates):
+            start = time.perf_counter()
+            chunks = self.models[model_name]._astream(
+                messages, stop=stop, run_manager=run_manager, **(routed_kwargs or {}).get(model_name, {}), **kwargs
+            )
+            try:
+                response = await anext(chunks)
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                self.router.record_failure(model_name, e)
+                if index == len(candidates) - 1:
+                    raise
+                self.router.record_fallback()
+                continue
+            yield response
+            async for chunk in chunks:
+                response += chunk
+                yield chunk
+            self.router.record_success(model_name, time.perf_counter() - start, _get_usage([response]))
+            return
+
+
+def _get_usage(generations: Sequence[ChatGeneration]) -> TurnUsage:
+    return turn_usage_from_llm_result(LLMResult(generations=[list(generations)]))
+
+
+def build_routing_model(
+    routes: ModelRoutes,
+    api_key: str | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    resilience: ResilienceConfig | None = None,
+) -> RoutingChatModel:
+    """Build a chat model which routes requests between the shared instances of the routed models"""
+    models = {
+        model_name: get_shared_model(
+            model_name=model_name,
+            api_key=routes.get_api_key(model_name, api_key),
+            http_pool=http_pool,
+            resilience=resilience,
+        )
+        for model_name in routes.model_names
+    }
+    return RoutingChatModel(models=models, router=get_model_router(routes))
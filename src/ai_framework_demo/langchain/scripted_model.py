@@ -0,0 +1,154 @@
+import asyncio
+import json
+import time
+from collections.abc import AsyncIterator, Iterator, Sequence
+from typing import Any
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolCall
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+
+from ai_framework_demo.llm import PREFETCHED_TOOL_CALL_ID_PREFIX
+from ai_framework_demo.scripted import RESPOND_TOOL_NAME, ScriptedConversation, ScriptedToolCall
+
+# Size of the chunks which streamed tool call arguments are split into
+STREAM_CHUNK_SIZE = 8
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Chat model which replays a scripted conversation, with `latency` seconds injected into each request.
+    Tool binding is a no-op, since the tool calls to make are determined by the script, except that if a response
+    format is bound the scripted responses to the user are returned as JSON content (native structured output)
+    instead of tool calls.
+    """
+
+    conversation: ScriptedConversation
+    latency: float = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> Runnable[LanguageModelInput, BaseMessage]:
+        if "response_format" in kwargs:
+            return self.bind(response_format=kwargs["response_format"])
+        return self
+
+    def _get_tool_calls(self, messages: list[BaseMessage]) -> list[ToolCall]:
+        # Determine the step from the latest user message, and the number of model responses to it so far
+        step = 0
+        for position in range(len(messages) - 1, -1, -1):
+            message = messages[position]
+            if isinstance(message, AIMessage):
+                step += 1
+            elif isinstance(message, HumanMessage):
+                assert isinstance(message.content, str)
+                prefetched = _get_prefetched_tool_calls(messages[:position])
+                return [
+                    ToolCall(name=tool_call.name, args=tool_call.args, id=f"call_{step}_{index}")
+                    for index, tool_call in enumerate(self.conversation.get_step(message.content, step, prefetched))
+                ]
+        raise ValueError("No user message found in messages")
+
+    def _get_response(self, messages: list[BaseMessage], native_structured_output: bool) -> tuple[str, list[ToolCall]]:
+        """Get the content and tool calls of the response to the messages"""
+        tool_calls = self._get_tool_calls(messages)
+        if not native_structured_output:
+            return "", tool_calls
+        content = ""
+        for tool_call in tool_calls:
+            if tool_call["name"] == RESPOND_TOOL_NAME:
+                content = json.dumps(tool_call["args"])
+        return content, [tool_call for tool_call in tool_calls if tool_call["name"] != RESPOND_TOOL_NAME]
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.latency)
+        content, tool_calls = self._get_response(messages, "response_format" in kwargs)
+        message = AIMessage(content=content, tool_calls=tool_calls)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        content, tool_calls = self._get_response(messages, "response_format" in kwargs)
+        message = AIMessage(content=content, tool_calls=tool_calls)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _iter_chunks(
+        self, messages: list[BaseMessage], native_structured_output: bool
+    ) -> Iterator[ChatGenerationChunk]:
+        content, tool_calls = self._get_response(messages, native_structured_output)
+        for index, tool_call in enumerate(tool_calls):
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(
+                    content="",
+                    tool_call_chunks=[{"name": tool_call["name"], "args": "", "id": tool_call["id"], "index": index}],
+                )
+            )
+            args_json = json.dumps(tool_call["args"])
+            for chunk_start in range(0, len(args_json), STREAM_CHUNK_SIZE):
+                args_chunk = args_json[chunk_start : chunk_start + STREAM_CHUNK_SIZE]
+                yield ChatGenerationChunk(
+                    message=AIMessageChunk(
+                        content="", tool_call_chunks=[{"name": None, "args": args_chunk, "id": None, "index": index}]
+                    )
+                )
+        for chunk_start in range(0, len(content), STREAM_CHUNK_SIZE):
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(content=content[chunk_start : chunk_start + STREAM_CHUNK_SIZE])
+            )
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for chunk in self._iter_chunks(messages, "response_format" in kwargs):
+            if run_manager:
+                run_manager.on_llm_new_token("", chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        for chunk in self._iter_chunks(messages, "response_format" in kwargs):
+            if run_manager:
+                await run_manager.on_llm_new_token("", chunk=chunk)
+            yield chunk
+
+
+def _get_prefetched_tool_calls(messages: list[BaseMessage]) -> list[ScriptedToolCall]:
+    """Get the tool calls which were prefetched since the previous user message"""
+    prefetched = []
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            break
+        if isinstance(message, AIMessage):
+            prefetched.extend(
+                ScriptedToolCall(tool_call["name"], tool_call["args"])
+                for tool_call in message.tool_calls
+                if (tool_call["id"] or "").startswith(PREFETCHED_TOOL_CALL_ID_PREFIX)
+            )
+    return prefetched
@@ -0,0 +1,46 @@
+from collections.abc import AsyncIterator, Callable
+from typing import Any
+
+from langchain_core.messages import AIMessageChunk
+from langchain_core.runnables.schema import StreamEvent
+
+from ai_framework_demo.langchain.tools import STRUCTURED_RESPONSE_TOOL_NAME
+from ai_framework_demo.llm import parse_partial_message
+
+
+async def stream_structured_response_message(
+    events: AsyncIterator[StreamEvent], on_message: Callable[[str], None], native_structured_output: bool = False
+) -> Any:
+    """
+    Consume the events of `astream_events()` for an agent which uses the StructuredResponseTool, calling
+    `on_message` with the response message content generated so far as the tool call arguments are streamed.
+    With native structured output, the response is streamed as the content of the model response instead.
+
+    Returns the output of the top-level runnable once it has finished.
+    """
+    output = None
+    # Partial JSON arguments of the structured response tool call, for the current model invocation
+    response_tool_call_args: dict[int, str] = {}
+    response_content = ""
+    async for event in events:
+        match event["event"]:
+            case "on_chat_model_start":
+                response_tool_call_args = {}
+                response_content = ""
+            case "on_chat_model_stream":
+                chunk = event["data"]["chunk"]
+                assert isinstance(chunk, AIMessageChunk)
+                if native_structured_output and isinstance(chunk.content, str) and chunk.content:
+                    response_content += chunk.content
+                    on_message(parse_partial_message(response_content))
+                for tool_call_chunk in chunk.tool_call_chunks:
+                    index = tool_call_chunk["index"] or 0
+                    # The tool name is only provided in the first chunk of each tool call
+                    if tool_call_chunk["name"] == STRUCTURED_RESPONSE_TOOL_NAME:
+                        response_tool_call_args[index] = ""
+                    if index in response_tool_call_args and tool_call_chunk["args"]:
+                        response_tool_call_args[index] += tool_call_chunk["args"]
+                        on_message(parse_partial_message(response_tool_call_args[index]))
+            case "on_chain_end" if not event["parent_ids"]:
+                output = event["data"].get("output")
+    return output
@@ -0,0 +1,102 @@
+import argparse
+from collections.abc import Sequence
+from typing import Any, Literal
+
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from ai_framework_demo.llm import LLMResponse
+from ai_framework_demo.model_routing import build_model_routes
+
+# How the structured response to the user is obtained from the model:
+# - native: the model responds with content in a JSON schema response format, alongside any tool calls
+# - tool: the model is forced to call a tool, and the response is the arguments of the StructuredResponseTool
+# - auto: native if the model's provider supports a response format together with tool calling, otherwise tool
+StructuredOutputMode = Literal["auto", "native", "tool"]
+STRUCTURED_OUTPUT_MODES: tuple[StructuredOutputMode, ...] = ("auto", "native", "tool")
+
+# Providers which support a JSON schema response format in requests with tools
+# (Anthropic and Gemini models only support structured output with tools by tool calling)
+NATIVE_STRUCTURED_OUTPUT_PROVIDERS = ("openai", "scripted")
+
+
+def to_strict_json_schema(schema: dict[str, Any]) -> dict[str, Any]:
+    """
+    Convert a JSON schema to the subset supported by strict structured outputs, in which every property is required
+    and no additional properties are allowed. Optional properties of the tool schemas are all nullable already.
+    """
+    schema = {key: value for key, value in schema.items() if key != "default"}
+    if "properties" in schema:
+        schema["properties"] = {name: to_strict_json_schema(value) for name, value in schema["properties"].items()}
+        schema["required"] = list(schema["properties"])
+        schema["additionalProperties"] = False
+    if "items" in schema:
+        schema["items"] = to_strict_json_schema(schema["items"])
+    if "anyOf" in schema:
+        schema["anyOf"] = [to_strict_json_schema(value) for value in schema["anyOf"]]
+    if "$defs" in schema:
+        schema["$defs"] = {name: to_strict_json_schema(value) for name, value in schema["$defs"].items()}
+    return schema
+
+
+def to_strict_tool(tool: BaseTool) -> dict[str, Any]:
+    """Convert a tool to an OpenAI tool definition with strict arguments, as required alongside a response format"""
+    openai_tool = convert_to_openai_tool(tool)
+    openai_tool["function"]["parameters"] = to_strict_json_schema(openai_tool["function"]["parameters"])
+    openai_tool["function"]["strict"] = True
+    return openai_tool
+
+
+LLM_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": LLMResponse.__name__,
+        "description": "Response to the user. The `end_conversation` flag should be set to True if the conversation "
+        "should end after this response, which must not be set if the message contains a question.",
+        "schema": to_strict_json_schema(LLMResponse.model_json_schema()),
+        "strict": True,
+    },
+}
+
+
+def resolve_structured_output_mode(model_name: str, mode: StructuredOutputMode) -> Literal["native", "tool"]:
+    """Get the structured output mode to use with a model, resolving `auto` by the model's provider"""
+    provider = model_name.split(":", 1)[0]
+    supports_native = provider in NATIVE_STRUCTURED_OUTPUT_PROVIDERS
+    if mode == "auto":
+        return "native" if supports_native else "tool"
+    if mode == "native" and not supports_native:
+        raise ValueError(f"Native structured output is not supported for {provider} models, use the tool mode")
+    return mode
+
+
+def build_structured_output_mode(args: argparse.Namespace) -> Literal["native", "tool"]:
+    mode = getattr(args, "structured_output", "auto")
+    # When requests are routed between several models, all of them must support the native mode for it to be used
+    model_routes = build_model_routes(args)
+    model_names = model_routes.model_names if model_routes is not None else (args.model,)
+    modes = {resolve_structured_output_mode(model_name, mode) for model_name in model_names}
+    return "native" if modes == {"native"} else "tool"
+
+
+def bind_tools_with_structured_output(
+    model: BaseChatModel, tools: Sequence[BaseTool], mode: Literal["native", "tool"]
+) -> Runnable[LanguageModelInput, BaseMessage]:
+    """
+    Bind the tools to a model, so that it responds with tool calls and/or the structured response to the user.
+    In the tool mode, the StructuredResponseTool must be included in the tools.
+    """
+    if mode == "tool":
+        return model.bind_tools(tools, tool_choice=True)
+    # Tool calls are optional, since the model can respond to the user directly
+    return model.bind_tools(
+        [to_strict_tool(tool) for tool in tools], tool_choice="auto", response_format=LLM_RESPONSE_FORMAT
+    )
+
+
+def get_response_content(message: BaseMessage) -> str | None:
+    """Get the structured response to the user from the content of a model response in the native mode, if any"""
+    return message.content if isinstance(message.content, str) and message.content else None
@@ -1,11 +1,20 @@
-from typing import Annotated
+import json
+from contextvars import ContextVar
+from typing import Annotated, Any
 
-from langchain_core.tools import BaseTool, tool
-from langgraph.prebuilt import InjectedState
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import BaseTool, InjectedToolCallId, StructuredTool, tool
 from pydantic import BaseModel
 
-from ai_framework_demo.llm import LLMResponse
-from ai_framework_demo.services import MenuService, OrderService
+from ai_framework_demo.llm import LLMResponse, PrefetchedToolCall
+from ai_framework_demo.services import DietaryTag, MenuService, OrderService
+
+STRUCTURED_RESPONSE_TOOL_NAME = "respond_to_user"
+
+# ID of the tool call being run by the legacy AgentExecutor, which doesn't pass it to the tools it calls
+# (set by ParallelToolsAgentExecutor)
+current_tool_call_id: ContextVar[str | None] = ContextVar("current_tool_call_id", default=None)
 
 
 # Define class-based tools to enable use of dependencies with legacy LangChain agents
@@ -22,6 +31,36 @@ class GetMenuTool(BaseTool):
         return self.menu_service.get_menu()
 
 
+SEARCH_MENU_DESCRIPTION = (
+    "Search the menu for items matching dietary requirements, category and/or text. "
+    'Items which can be prepared to satisfy a dietary requirement on request are marked as an "option".'
+)
+
+
+class SearchMenuInputSchema(BaseModel):
+    dietary_tags: Annotated[
+        list[DietaryTag] | None, "Dietary requirements items must satisfy: V (vegetarian), VG (vegan), GF (gluten-free)"
+    ] = None
+    category: Annotated[str | None, "Menu category, e.g. Appetizers, Main Courses or Desserts"] = None
+    text: Annotated[str | None, "Text which the item name must contain"] = None
+
+
+class SearchMenuTool(BaseTool):
+    """
+    Tool that can be used by the LLM to search the menu, instead of getting the full menu.
+    """
+
+    name: str = "search_menu"
+    description: str = SEARCH_MENU_DESCRIPTION
+    args_schema: type[BaseModel] = SearchMenuInputSchema
+    menu_service: MenuService
+
+    def _run(
+        self, dietary_tags: list[DietaryTag] | None = None, category: str | None = None, text: str | None = None
+    ) -> dict[str, list[str]]:
+        return self.menu_service.search_menu(tags=dietary_tags or (), category=category, text=text)
+
+
 class CreateOrderInputSchema(BaseModel):
     table_number: int
     order_items: Annotated[list[str], "List of food menu items to order"]
@@ -36,9 +75,21 @@ class CreateOrderTool(BaseTool):
     description: str = "Create an order for the table"
     args_schema: type[BaseModel] = CreateOrderInputSchema
     order_service: OrderService
+    table_number: int
+
+    def _get_idempotency_key(self) -> str | None:
+        # Use the tool call ID as idempotency key, so re-executing the same tool call does not create a duplicate order
+        tool_call_id = current_tool_call_id.get()
+        return f"{self.table_number}:{tool_call_id}" if tool_call_id is not None else None
 
     def _run(self, table_number: int, order_items: list[str]) -> str:
-        self.order_service.create_order(table_number, order_items)
+        self.order_service.create_order(table_number, order_items, idempotency_key=self._get_idempotency_key())
+        return "Order placed"
+
+    async def _arun(self, table_number: int, order_items: list[str]) -> str:
+        await self.order_service.create_order_async(
+            table_number, order_items, idempotency_key=self._get_idempotency_key()
+        )
         return "Order placed"
 
 
@@ -48,7 +99,7 @@ class StructuredResponseTool(BaseTool):
     Does not have any associated functionality, it is just a way to enable structured output from the LLM.
     """
 
-    name: str = "respond_to_user"
+    name: str = STRUCTURED_RESPONSE_TOOL_NAME
     description: str = (
         "ALWAYS use this tool to provide a response to the user, INSTEAD OF responding directly. "
         "The `message` content should be what you would normally respond with in a conversation. "
@@ -64,19 +115,84 @@ class StructuredResponseTool(BaseTool):
         return LLMResponse(message=message, end_conversation=end_conversation).model_dump_json()
 
 
-# Function-based tools with dependency injection using InjectedState with Langgraph
+# Function-based tools for the LangGraph agent, with services injected from the `configurable` of the run config
+def get_configurable(config: RunnableConfig, key: str) -> Any:
+    try:
+        return config["configurable"][key]
+    except KeyError:
+        raise ValueError(f"{key!r} must be provided in the configurable of the run config") from None
+
+
 @tool
-def get_menu(menu_service: Annotated[MenuService, InjectedState("menu_service")]) -> dict[str, list[str]]:
+def get_menu(config: RunnableConfig) -> dict[str, list[str]]:
     """Get the full menu for the restaurant"""
+    menu_service: MenuService = get_configurable(config, "menu_service")
     return menu_service.get_menu()
 
 
-@tool
-def create_order(
-    order_service: Annotated[OrderService, InjectedState("order_service")],
+@tool(description=SEARCH_MENU_DESCRIPTION)
+def search_menu(
+    config: RunnableConfig,
+    dietary_tags: Annotated[
+        list[DietaryTag] | None, "Dietary requirements items must satisfy: V (vegetarian), VG (vegan), GF (gluten-free)"
+    ] = None,
+    category: Annotated[str | None, "Menu category, e.g. Appetizers, Main Courses or Desserts"] = None,
+    text: Annotated[str | None, "Text which the item name must contain"] = None,
+) -> dict[str, list[str]]:
+    menu_service: MenuService = get_configurable(config, "menu_service")
+    return menu_service.search_menu(tags=dietary_tags or (), category=category, text=text)
+
+
+def _create_order(
+    config: RunnableConfig,
+    tool_call_id: Annotated[str, InjectedToolCallId],
     table_number: int,
     order_items: Annotated[list[str], "List of food menu items to order"],
 ) -> str:
-    """Create an order for the table"""
-    order_service.create_order(table_number, order_items)
+    order_service: OrderService = get_configurable(config, "order_service")
+    # Use the tool call ID as idempotency key, so re-executing the same tool call does not create a duplicate order
+    idempotency_key = f"{get_configurable(config, 'table_number')}:{tool_call_id}"
+    order_service.create_order(table_number, order_items, idempotency_key=idempotency_key)
     return "Order placed"
+
+
+async def _create_order_async(
+    config: RunnableConfig,
+    tool_call_id: Annotated[str, InjectedToolCallId],
+    table_number: int,
+    order_items: Annotated[list[str], "List of food menu items to order"],
+) -> str:
+    order_service: OrderService = get_configurable(config, "order_service")
+    idempotency_key = f"{get_configurable(config, 'table_number')}:{tool_call_id}"
+    await order_service.create_order_async(table_number, order_items, idempotency_key=idempotency_key)
+    return "Order placed"
+
+
+# Provide both sync and async implementations, so async graph runs can use batched order writes
+create_order = StructuredTool.from_function(
+    func=_create_order,
+    coroutine=_create_order_async,
+    name="create_order",
+    description="Create an order for the table",
+)
+
+
+def to_prefetched_tool_messages(tool_calls: list[PrefetchedToolCall]) -> list[BaseMessage]:
+    """Messages of tool calls made ahead of the model, in the same form as if the model had made them"""
+    return [
+        AIMessage(
+            content="",
+            tool_calls=[
+                {"name": tool_call.tool_name, "args": tool_call.args, "id": tool_call.tool_call_id}
+                for tool_call in tool_calls
+            ],
+        ),
+        *(
+            ToolMessage(
+                content=json.dumps(tool_call.result, ensure_ascii=False),
+                tool_call_id=tool_call.tool_call_id,
+                name=tool_call.tool_name,
+            )
+            for tool_call in tool_calls
+        ),
+    ]
@@ -0,0 +1,73 @@
+from typing import Any
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+
+from ai_framework_demo.langchain.usage import turn_usage_from_llm_result
+from ai_framework_demo.tracing import Span, SpanKind, TurnTrace
+
+# Runnables which are recorded as spans, by name
+CHAIN_SPAN_KINDS: dict[str, SpanKind] = {
+    "ChatPromptTemplate": "prompt",
+    "ToolsAgentOutputParser": "parse",
+    # Nodes of the LangGraph agent
+    "memory": "memory",
+    "respond": "parse",
+}
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Callback handler which records spans of model requests, tool calls and other steps of a turn in its trace"""
+
+    # Run synchronously in async runs as well, so span timings are not delayed
+    run_inline: bool = True
+
+    def __init__(self, trace: TurnTrace):
+        self.trace = trace
+        # Spans which have been started but not finished yet, by run ID
+        self.spans: dict[UUID, Span] = {}
+
+    def _start_span(self, run_id: UUID, kind: SpanKind, name: str) -> None:
+        self.spans[run_id] = self.trace.start_span(kind, name)
+
+    def _finish_span(self, run_id: UUID, error: BaseException | None = None) -> Span | None:
+        if (span := self.spans.pop(run_id, None)) is not None:
+            span.finish(**({"error": repr(error)} if error is not None else {}))
+        return span
+
+    def on_chat_model_start(
+        self, serialized: dict[str, Any], messages: list[list[BaseMessage]], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        name = kwargs.get("name") or (serialized or {}).get("name") or "chat_model"
+        self._start_span(run_id, "model", name)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        if (span := self._finish_span(run_id)) is not None:
+            span.set_usage(turn_usage_from_llm_result(response))
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish_span(run_id, error)
+
+    def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start_span(run_id, "tool", kwargs.get("name") or (serialized or {}).get("name") or "tool")
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish_span(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish_span(run_id, error)
+
+    def on_chain_start(
+        self, serialized: dict[str, Any], inputs: dict[str, Any], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        name = kwargs.get("name") or (serialized or {}).get("name")
+        if name in CHAIN_SPAN_KINDS:
+            self._start_span(run_id, CHAIN_SPAN_KINDS[name], name)
+
+    def on_chain_end(self, outputs: dict[str, Any], *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish_span(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish_span(run_id, error)
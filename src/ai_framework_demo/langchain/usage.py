@@ -0,0 +1,39 @@
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+
+from ai_framework_demo.usage import TurnUsage
+
+
+def turn_usage_from_llm_result(response: LLMResult) -> TurnUsage:
+    """Get the token usage of a single chat model request from its result"""
+    usage = TurnUsage(requests=1)
+    for generations in response.generations:
+        for generation in generations:
+            if not isinstance(generation, ChatGeneration) or not isinstance(generation.message, AIMessage):
+                continue
+            if (usage_metadata := generation.message.usage_metadata) is None:
+                continue
+            input_token_details = usage_metadata.get("input_token_details", {})
+            usage.input_tokens += usage_metadata["input_tokens"]
+            usage.output_tokens += usage_metadata["output_tokens"]
+            usage.cache_read_tokens += input_token_details.get("cache_read", 0)
+            usage.cache_write_tokens += input_token_details.get("cache_creation", 0)
+    return usage
+
+
+class TurnUsageCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler which accumulates the token usage of all chat model requests made while it is attached
+    """
+
+    # Run synchronously in async runs as well, since it only updates counters
+    run_inline: bool = True
+
+    def __init__(self):
+        self.usage = TurnUsage()
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        self.usage += turn_usage_from_llm_result(response)
@@ -1,19 +1,38 @@
-from typing import Annotated
+from dataclasses import dataclass
+from functools import cache
+from typing import Annotated, Any
 
 from pydantic import BaseModel
+from pydantic_core import from_json
 
+# Static part of the system prompt which is the same for every table of the restaurant.
+# This should come first in the prompt (after tool definitions), so it can be cached by the model provider.
 PROMPT_TEMPLATE = """
 You are playing the role of an incredibly eccentric and entertaining waiter in a fine dining restaurant
-called "{restaurant_name}" taking orders for table number {table_number}.
+called "{restaurant_name}".
 You must:
 * Greet the customer, ask if they have any dietary restrictions
-* Tell them about appropriate menu items using the *get_menu()* tool.
+* Tell them about appropriate menu items using the *search_menu()* tool (or *get_menu()* for the full menu).
 * Take their order, and confirm it with them.
 * When confirmed, use the *create_order()* tool to create an order for the customer.
 * Only set the *end_conversation* flag to True in your final response after you have finished the conversation,
 meaning that your message DOES NOT contain a question.
 """
 
+# Part of the system prompt which is specific to each table, placed after the cacheable static prefix
+TABLE_PROMPT_TEMPLATE = """
+You are taking orders for table number {table_number}.
+"""
+
+# Prefix of the IDs of tool calls which were made ahead of the model and added to its context
+PREFETCHED_TOOL_CALL_ID_PREFIX = "prefetched_"
+
+
+@cache
+def format_static_prompt(restaurant_name: str) -> str:
+    """Format the static part of the system prompt, which only needs to be done once per restaurant"""
+    return PROMPT_TEMPLATE.format(restaurant_name=restaurant_name)
+
 
 class LLMResponse(BaseModel):
     """
@@ -25,3 +44,28 @@ class LLMResponse(BaseModel):
         bool,
         "True if the conversation should end after this response. DO NOT set if the message contains a question.",
     ]
+
+
+def parse_partial_message(response_json: str) -> str:
+    """
+    Extract the `message` content generated so far from a partial LLMResponse JSON string, so it can be displayed
+    while the rest of the response is still being generated
+    """
+    if not response_json:
+        return ""
+    try:
+        response_data = from_json(response_json, allow_partial="trailing-strings")
+    except ValueError:
+        return ""
+    message = response_data.get("message", "") if isinstance(response_data, dict) else ""
+    return message if isinstance(message, str) else ""
+
+
+@dataclass
+class PrefetchedToolCall:
+    """A tool call made ahead of the model (e.g. speculatively), with its result to add to the model's context"""
+
+    tool_call_id: str
+    tool_name: str
+    args: dict[str, Any]
+    result: Any
@@ -0,0 +1,274 @@
+import argparse
+from abc import ABC, abstractmethod
+from collections.abc import Sequence
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Generic, TypeVar
+
+MessageT = TypeVar("MessageT")
+
+SUMMARY_PREFIX = "Summary of the earlier conversation with the customer:\n"
+STALE_TOOL_RESULT_PLACEHOLDER = "*Result omitted, the tool was called again later in the conversation*"
+
+# Token limit of the conversation history in the current turn, which is applied after the memory policy,
+# e.g. while the conversation is over its token budget
+history_token_limit: ContextVar[int | None] = ContextVar("history_token_limit", default=None)
+
+SUMMARY_PROMPT = """
+Summarise the following conversation between a restaurant waiter and a customer in a few sentences.
+Keep any dietary requirements, preferences, menu items discussed and orders placed or confirmed.
+
+{transcript}
+"""
+
+
+class Summariser(ABC):
+    """Summarises transcripts of conversation messages with an LLM, from async or sync code"""
+
+    @abstractmethod
+    async def summarise(self, prompt: str) -> str: ...
+
+    @abstractmethod
+    def summarise_sync(self, prompt: str) -> str:
+        """Summarise without an event loop, for agents' sync requests"""
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap provider-agnostic token estimate (roughly 4 characters per token for English text)"""
+    return (len(text) + 3) // 4
+
+
+@dataclass
+class MemoryStats:
+    """Size of the conversation history before and after it was compacted by a memory policy"""
+
+    tokens_before: int
+    tokens_after: int
+    messages_before: int
+    messages_after: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+class MessageAdapter(ABC, Generic[MessageT]):
+    """
+    Provides the framework-specific message operations required by memory policies,
+    so the same policies can be used by each agent implementation.
+    """
+
+    @abstractmethod
+    def message_text(self, message: MessageT) -> str:
+        """Text content of the message as it would be sent to the model"""
+
+    @abstractmethod
+    def is_turn_start(self, message: MessageT) -> bool:
+        """Whether the message is a user message which starts a new conversation turn"""
+
+    @abstractmethod
+    def split_pinned(self, messages: list[MessageT]) -> tuple[list[MessageT], list[MessageT]]:
+        """Split off leading messages which must always be kept (e.g. system prompt), from the rest"""
+
+    @abstractmethod
+    def join_pinned(self, pinned: list[MessageT], messages: list[MessageT]) -> list[MessageT]:
+        """Inverse of `split_pinned()`"""
+
+    @abstractmethod
+    def tool_return_names(self, message: MessageT) -> list[str]:
+        """Names of the tools for which the message contains a result"""
+
+    @abstractmethod
+    def replace_tool_returns(self, message: MessageT, tool_names: set[str], content: str) -> MessageT:
+        """Copy of the message with the results of the given tools replaced with `content`"""
+
+    @abstractmethod
+    def get_summary(self, pinned: list[MessageT]) -> str | None:
+        """Get the summary of earlier conversation from the pinned messages, if there is one"""
+
+    @abstractmethod
+    def set_summary(self, pinned: list[MessageT], summary: str) -> list[MessageT]:
+        """Add or replace the summary of earlier conversation in the pinned messages"""
+
+    @abstractmethod
+    def format_transcript(self, messages: list[MessageT]) -> str:
+        """Format the messages as a human-readable transcript, used for summarisation"""
+
+    @abstractmethod
+    def dump_messages(self, messages: list[MessageT]) -> bytes:
+        """Serialise the messages as JSON, e.g. for a snapshot of the session"""
+
+    @abstractmethod
+    def load_messages(self, data: bytes) -> list[MessageT]:
+        """Inverse of `dump_messages()`"""
+
+    def count_tokens(self, messages: Sequence[MessageT]) -> int:
+        return sum(estimate_tokens(self.message_text(message)) for message in messages)
+
+
+class MemoryPolicy(ABC):
+    """
+    Policy for compacting the conversation history before it is sent with each request to the model.
+    """
+
+    async def compact(
+        self, messages: list[MessageT], adapter: MessageAdapter[MessageT]
+    ) -> tuple[list[MessageT], MemoryStats]:
+        """Compact the conversation history, returning the new history and stats about how much was saved"""
+        compacted = await self._compact(messages, adapter)
+        if (max_tokens := history_token_limit.get()) is not None:
+            compacted = await TokenWindowMemory(max_tokens)._compact(compacted, adapter)
+        return compacted, get_memory_stats(messages, compacted, adapter)
+
+    def compact_sync(
+        self, messages: list[MessageT], adapter: MessageAdapter[MessageT]
+    ) -> tuple[list[MessageT], MemoryStats]:
+        """Same as `compact()`, without an event loop (e.g. for sync requests, which may be made in a running loop)"""
+        compacted = self._compact_sync(messages, adapter)
+        if (max_tokens := history_token_limit.get()) is not None:
+            compacted = TokenWindowMemory(max_tokens)._compact_sync(compacted, adapter)
+        return compacted, get_memory_stats(messages, compacted, adapter)
+
+    async def _compact(self, messages: list[MessageT], adapter: MessageAdapter[MessageT]) -> list[MessageT]:
+        # Only policies which call the model (to summarise) need to compact asynchronously
+        return self._compact_sync(messages, adapter)
+
+    @abstractmethod
+    def _compact_sync(self, messages: list[MessageT], adapter: MessageAdapter[MessageT]) -> list[MessageT]: ...
+
+
+def get_memory_stats(
+    messages: list[MessageT], compacted: list[MessageT], adapter: MessageAdapter[MessageT]
+) -> MemoryStats:
+    return MemoryStats(
+        tokens_before=adapter.count_tokens(messages),
+        tokens_after=adapter.count_tokens(compacted),
+        messages_before=len(messages),
+        messages_after=len(compacted),
+    )
+
+
+class UnboundedMemory(MemoryPolicy):
+    """Keeps the entire conversation history"""
+
+    def _compact_sync(self, messages: list[MessageT], adapter: MessageAdapter[MessageT]) -> list[MessageT]:
+        return messages
+
+
+class StaleToolResultMemory(MemoryPolicy):
+    """
+    Replaces the results of tool calls which were called again later in the conversation with a short placeholder,
+    e.g. so that the full menu is only included in the history once.
+    """
+
+    def __init__(self, tool_names: set[str] | None = None):
+        # Only compact results of these tools, or all tools if not set
+        self.tool_names = tool_names
+
+    def _compact_sync(self, messages: list[MessageT], adapter: MessageAdapter[MessageT]) -> list[MessageT]:
+        compacted: list[MessageT] = []
+        seen_tool_names: set[str] = set()
+        # Iterate from the most recent message, so that only the latest result of each tool is kept
+        for message in reversed(messages):
+            if tool_names := adapter.tool_return_names(message):
+                stale_tool_names = seen_tool_names.intersection(tool_names)
+                if self.tool_names is not None:
+                    stale_tool_names &= self.tool_names
+                if stale_tool_names:
+                    message = adapter.replace_tool_returns(message, stale_tool_names, STALE_TOOL_RESULT_PLACEHOLDER)
+                seen_tool_names.update(tool_names)
+            compacted.append(message)
+        compacted.reverse()
+        return compacted
+
+
+class TokenWindowMemory(MemoryPolicy):
+    """
+    Keeps the most recent conversation turns which fit within a token budget, always keeping the system prompt
+    and the latest turn. Dropped turns are optionally summarised with an LLM, and the summary is kept in place of them
+    (and rolled into the next summary when more turns are dropped).
+    """
+
+    def __init__(self, max_tokens: int, summariser: Summariser | None = None):
+        self.max_tokens = max_tokens
+        self.summariser = summariser
+
+    def _split(
+        self, messages: list[MessageT], adapter: MessageAdapter[MessageT]
+    ) -> tuple[list[MessageT], list[MessageT], list[MessageT]]:
+        """Split the messages into the pinned messages, the turns to drop and the turns to keep"""
+        pinned, rest = adapter.split_pinned(messages)
+        # Group messages into turns, so tool calls are never separated from their results
+        turns: list[list[MessageT]] = []
+        for message in rest:
+            if not turns or adapter.is_turn_start(message):
+                turns.append([])
+            turns[-1].append(message)
+
+        budget = self.max_tokens - adapter.count_tokens(pinned)
+        kept_turns = 0
+        for turn in reversed(turns):
+            budget -= adapter.count_tokens(turn)
+            if budget < 0 and kept_turns > 0:
+                break
+            kept_turns += 1
+
+        dropped = [message for turn in turns[: len(turns) - kept_turns] for message in turn]
+        kept = [message for turn in turns[len(turns) - kept_turns :] for message in turn]
+        return pinned, dropped, kept
+
+    def _get_summary_prompt(
+        self, pinned: list[MessageT], dropped: list[MessageT], adapter: MessageAdapter[MessageT]
+    ) -> str:
+        transcript = adapter.format_transcript(dropped)
+        if previous_summary := adapter.get_summary(pinned):
+            transcript = f"{previous_summary}\n\n{transcript}"
+        return SUMMARY_PROMPT.format(transcript=transcript)
+
+    async def _compact(self, messages: list[MessageT], adapter: MessageAdapter[MessageT]) -> list[MessageT]:
+        if adapter.count_tokens(messages) <= self.max_tokens:
+            return messages
+        pinned, dropped, kept = self._split(messages, adapter)
+        if dropped and self.summariser is not None:
+            summary = await self.summariser.summarise(self._get_summary_prompt(pinned, dropped, adapter))
+            pinned = adapter.set_summary(pinned, SUMMARY_PREFIX + summary)
+        return adapter.join_pinned(pinned, kept)
+
+    def _compact_sync(self, messages: list[MessageT], adapter: MessageAdapter[MessageT]) -> list[MessageT]:
+        if adapter.count_tokens(messages) <= self.max_tokens:
+            return messages
+        pinned, dropped, kept = self._split(messages, adapter)
+        if dropped and self.summariser is not None:
+            summary = self.summariser.summarise_sync(self._get_summary_prompt(pinned, dropped, adapter))
+            pinned = adapter.set_summary(pinned, SUMMARY_PREFIX + summary)
+        return adapter.join_pinned(pinned, kept)
+
+
+class CompositeMemory(MemoryPolicy):
+    """Applies multiple memory policies in order"""
+
+    def __init__(self, policies: Sequence[MemoryPolicy]):
+        self.policies = policies
+
+    async def _compact(self, messages: list[MessageT], adapter: MessageAdapter[MessageT]) -> list[MessageT]:
+        for policy in self.policies:
+            messages = await policy._compact(messages, adapter)
+        return messages
+
+    def _compact_sync(self, messages: list[MessageT], adapter: MessageAdapter[MessageT]) -> list[MessageT]:
+        for policy in self.policies:
+            messages = policy._compact_sync(messages, adapter)
+        return messages
+
+
+def build_memory_policy(args: argparse.Namespace, summariser: Summariser | None = None) -> MemoryPolicy:
+    """
+    Build the memory policy configured by the CLI arguments, which keeps the entire history unless policies are enabled.
+    `summariser` is only used if rolling summarisation is enabled.
+    """
+    policies: list[MemoryPolicy] = []
+    if getattr(args, "memory_drop_stale_tool_results", False):
+        policies.append(StaleToolResultMemory())
+    if max_tokens := getattr(args, "memory_max_tokens", None):
+        policies.append(TokenWindowMemory(max_tokens, summariser if getattr(args, "memory_summarise", False) else None))
+    return CompositeMemory(policies) if policies else UnboundedMemory()
@@ -0,0 +1,59 @@
+# Snapshot of the model names supported by PydanticAI (`pydantic_ai.models.KnownModelName`), for the CLI help text
+# without importing PydanticAI. Checked against the installed version by `python -m ai_framework_demo.bench.startup`
+KNOWN_MODEL_NAMES: tuple[str, ...] = (
+    "openai:gpt-4o",
+    "openai:gpt-4o-mini",
+    "openai:gpt-4-turbo",
+    "openai:gpt-4",
+    "openai:o1-preview",
+    "openai:o1-mini",
+    "openai:o1",
+    "openai:gpt-3.5-turbo",
+    "groq:llama-3.3-70b-versatile",
+    "groq:llama-3.1-70b-versatile",
+    "groq:llama3-groq-70b-8192-tool-use-preview",
+    "groq:llama3-groq-8b-8192-tool-use-preview",
+    "groq:llama-3.1-70b-specdec",
+    "groq:llama-3.1-8b-instant",
+    "groq:llama-3.2-1b-preview",
+    "groq:llama-3.2-3b-preview",
+    "groq:llama-3.2-11b-vision-preview",
+    "groq:llama-3.2-90b-vision-preview",
+    "groq:llama3-70b-8192",
+    "groq:llama3-8b-8192",
+    "groq:mixtral-8x7b-32768",
+    "groq:gemma2-9b-it",
+    "groq:gemma-7b-it",
+    "google-gla:gemini-1.5-flash",
+    "google-gla:gemini-1.5-pro",
+    "google-gla:gemini-2.0-flash-exp",
+    "google-vertex:gemini-1.5-flash",
+    "google-vertex:gemini-1.5-pro",
+    "google-vertex:gemini-2.0-flash-exp",
+    "mistral:mistral-small-latest",
+    "mistral:mistral-large-latest",
+    "mistral:codestral-latest",
+    "mistral:mistral-moderation-latest",
+    "ollama:codellama",
+    "ollama:gemma",
+    "ollama:gemma2",
+    "ollama:llama3",
+    "ollama:llama3.1",
+    "ollama:llama3.2",
+    "ollama:llama3.2-vision",
+    "ollama:llama3.3",
+    "ollama:mistral",
+    "ollama:mistral-nemo",
+    "ollama:mixtral",
+    "ollama:phi3",
+    "ollama:phi4",
+    "ollama:qwq",
+    "ollama:qwen",
+    "ollama:qwen2",
+    "ollama:qwen2.5",
+    "ollama:starcoder2",
+    "anthropic:claude-3-5-haiku-latest",
+    "anthropic:claude-3-5-sonnet-latest",
+    "anthropic:claude-3-opus-latest",
+    "test",
+)
@@ -0,0 +1,379 @@
+import argparse
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, replace
+from functools import cache
+from typing import Generic, Literal, TypeVar
+
+from rich.table import Table
+
+from ai_framework_demo.intents import AFFIRMATIVE_MESSAGES, ORDER_PATTERN, normalise_message
+from ai_framework_demo.llm import LLMResponse
+from ai_framework_demo.pricing import estimate_cost
+from ai_framework_demo.run_agent import AgentRunner, AgentRunnerWrapper
+from ai_framework_demo.services import DEFAULT_MENU, MenuIndex, MenuService
+from ai_framework_demo.tracing import AttributeValue, current_turn_trace
+from ai_framework_demo.usage import TurnUsage, turn_model_usage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# How demanding a turn is of the model:
+# - simple: greetings, questions and browsing the menu, which can be handled by a cheap model
+# - order: turns which order something or confirm an order, which are sent to the stronger models
+TurnComplexity = Literal["simple", "order"]
+
+# Set for the turns of a conversation which are sent to the cheap model (if any) whatever their complexity,
+# e.g. while the conversation is over its cost budget
+prefer_cheap_model: ContextVar[bool] = ContextVar("prefer_cheap_model", default=False)
+
+# Set to the menu of the conversation whose turn is being routed, since the router and the agents' models are shared by
+# the conversations of every restaurant in the process
+routed_menu_index: ContextVar[MenuIndex | None] = ContextVar("routed_menu_index", default=None)
+
+# Requests are only hedged once enough requests to a model have been measured to estimate its p95 latency
+MIN_LATENCY_SAMPLES = 20
+HEDGE_PERCENTILE = 0.95
+
+
+@cache
+def get_default_menu_index() -> MenuIndex:
+    return MenuIndex.build(DEFAULT_MENU)
+
+
+def classify_turn(user_message: str | None, menu_index: MenuIndex | None = None) -> TurnComplexity:
+    """
+    Classify the complexity of a turn from its user message, erring on the side of the stronger models.
+    A message which names an item of the menu (the default menu if none is given) is taken to order it.
+    """
+    if user_message is None:
+        return "order"
+    text = normalise_message(user_message)
+    menu_item_words = (menu_index or get_default_menu_index()).item_name_words
+    if text in AFFIRMATIVE_MESSAGES or ORDER_PATTERN.search(text) or menu_item_words.intersection(text.split()):
+        return "order"
+    return "simple"
+
+
+@dataclass(frozen=True)
+class ModelRoutes:
+    """Models which the requests of an agent are routed between, in order of preference"""
+
+    primary: str
+    fallbacks: tuple[str, ...] = ()
+    # Model for simple turns, which falls back to the primary and fallback models
+    cheap: str | None = None
+    # Also send a request to the next model if the first hasn't responded within its p95 latency
+    hedge: bool = False
+    # Seconds for which a model is tried last after a failed request
+    cooldown: float = 30.0
+
+    @property
+    def model_names(self) -> tuple[str, ...]:
+        return tuple(dict.fromkeys((self.primary, *self.fallbacks, *((self.cheap,) if self.cheap else ()))))
+
+    @property
+    def name(self) -> str:
+        return "routed:" + ",".join(self.model_names)
+
+    def get_api_key(self, model_name: str, api_key: str | None) -> str | None:
+        """
+        The API key is for the primary model's provider, so models of other providers use the API key from their
+        provider's environment variable instead (e.g. ANTHROPIC_API_KEY)
+        """
+        return api_key if model_name.split(":", 1)[0] == self.primary.split(":", 1)[0] else None
+
+
+def build_model_routes(args: argparse.Namespace) -> ModelRoutes | None:
+    """Get the model routes configured by the CLI arguments, or None if requests are not routed"""
+    fallbacks = tuple(getattr(args, "fallback_models", None) or ())
+    cheap = getattr(args, "cheap_model", None)
+    if not fallbacks and cheap is None:
+        return None
+    return ModelRoutes(
+        primary=args.model,
+        fallbacks=fallbacks,
+        cheap=cheap,
+        hedge=getattr(args, "hedge_requests", False),
+        cooldown=getattr(args, "model_cooldown", 30.0),
+    )
+
+
+@dataclass
+class ModelStats:
+    """Rolling latency and error rate of a model over its most recent requests, with its total cost"""
+
+    window: int = 100
+    latencies: deque[float] = field(init=False)
+    failed: deque[bool] = field(init=False)
+    requests: int = 0
+    failures: int = 0
+    cost: float = 0
+    # Monotonic time until which the model is tried last, after a failed request
+    unavailable_until: float = 0
+
+    def __post_init__(self):
+        self.latencies = deque(maxlen=self.window)
+        self.failed = deque(maxlen=self.window)
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.failed) / len(self.failed) if self.failed else 0
+
+    @property
+    def is_available(self) -> bool:
+        return time.monotonic() >= self.unavailable_until
+
+    def latency_percentile(self, percentile: float) -> float | None:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(percentile * len(latencies)))]
+
+
+@dataclass
+class ModelRoutingMetrics:
+    """Routing decisions of a model router, and the cost they saved"""
+
+    # Requests by turn complexity
+    routed: Counter[str] = field(default_factory=Counter)
+    # Successful requests by model
+    responses: Counter[str] = field(default_factory=Counter)
+    # Requests sent to the next model after the previous one failed
+    fallbacks: int = 0
+    # Requests also sent to the next model after exceeding the first model's p95 latency,
+    # and those which the next model answered first
+    hedges: int = 0
+    hedge_wins: int = 0
+    # Estimated cost of the responses, and the cost saved compared to sending every request to the primary model
+    # (only counted for responses whose model prices are both known)
+    cost: float = 0
+    savings: float = 0
+
+    def __str__(self) -> str:
+        routed = ", ".join(f"{complexity}={count}" for complexity, count in self.routed.items())
+        responses = ", ".join(f"{model}={count}" for model, count in self.responses.items())
+        return (
+            f"routed ({routed or 'none'}), responses ({responses or 'none'}), fallbacks={self.fallbacks} "
+            f"hedges={self.hedges} hedge_wins={self.hedge_wins} cost=${self.cost:.4f} savings=${self.savings:.4f}"
+        )
+
+
+class ModelRouter:
+    """
+    Routes the requests of agents between models: simple turns go to the cheap model (if any) and others to the
+    primary model. A request which fails is sent to the next model, and with hedging, a request which is slower
+    than the model's p95 latency is also sent to the next model, using whichever response arrives first.
+    Models which have recently failed are tried last.
+    Shared by all agents in the process with the same routes, so they all benefit from its measurements.
+    """
+
+    def __init__(self, routes: ModelRoutes):
+        self.routes = routes
+        self.stats = {name: ModelStats() for name in routes.model_names}
+        self.metrics = ModelRoutingMetrics()
+
+    def route(self, user_message: str | None) -> list[str]:
+        """Get the models to try for a request, in order"""
+        complexity = "simple" if prefer_cheap_model.get() else classify_turn(user_message, routed_menu_index.get())
+        preferred = [self.routes.primary, *self.routes.fallbacks]
+        if complexity == "simple" and self.routes.cheap:
+            preferred.insert(0, self.routes.cheap)
+        # Sorting is stable, so the order of preference is kept within available and unavailable models
+        candidates = sorted(dict.fromkeys(preferred), key=lambda name: not self.stats[name].is_available)
+        self.metrics.routed[complexity] += 1
+        _annotate_turn(model_complexity=complexity)
+        logger.debug("Routing %s request to %s", complexity, candidates)
+        return candidates
+
+    def hedge_delay(self, model_name: str) -> float | None:
+        """Seconds after which a request to the model is hedged, if hedging is enabled and its p95 is known"""
+        stats = self.stats[model_name]
+        if not self.routes.hedge or len(stats.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return stats.latency_percentile(HEDGE_PERCENTILE)
+
+    def record_success(self, model_name: str, latency: float, usage: TurnUsage) -> None:
+        stats = self.stats[model_name]
+        stats.latencies.append(latency)
+        stats.failed.append(False)
+        stats.requests += 1
+        self.metrics.responses[model_name] += 1
+        if (model_usage := turn_model_usage.get()) is not None:
+            # Each successful response is a single request, which the usage of a response doesn't always count
+            model_usage[model_name] = model_usage.get(model_name, TurnUsage()) + replace(usage, requests=1)
+        if (cost := estimate_cost(model_name, usage)) is not None:
+            stats.cost += cost
+            self.metrics.cost += cost
+            if (primary_cost := estimate_cost(self.routes.primary, usage)) is not None:
+                self.metrics.savings += primary_cost - cost
+        _annotate_turn(model=model_name)
+
+    def record_failure(self, model_name: str, error: BaseException) -> None:
+        stats = self.stats[model_name]
+        stats.failed.append(True)
+        stats.requests += 1
+        stats.failures += 1
+        stats.unavailable_until = time.monotonic() + self.routes.cooldown
+        logger.warning("Request to %s failed, trying it last for %.0fs: %r", model_name, self.routes.cooldown, error)
+
+    def record_fallback(self) -> None:
+        self.metrics.fallbacks += 1
+        _annotate_turn(model_fallbacks=_get_turn_attribute("model_fallbacks") + 1)
+
+    def run_sync(self, user_message: str | None, request: Callable[[str], T], get_usage: Callable[[T], TurnUsage]) -> T:
+        """Make a request with each model in turn until one succeeds (requests are not hedged)"""
+        candidates = self.route(user_message)
+        for index, model_name in enumerate(candidates):
+            start = time.perf_counter()
+            try:
+                result = request(model_name)
+            except Exception as e:
+                self.record_failure(model_name, e)
+                if index == len(candidates) - 1:
+                    raise
+                self.record_fallback()
+                continue
+            self.record_success(model_name, time.perf_counter() - start, get_usage(result))
+            return result
+        raise AssertionError("No models to route to")
+
+    async def run(
+        self,
+        user_message: str | None,
+        request: Callable[[str], Awaitable[T]],
+        get_usage: Callable[[T], TurnUsage],
+    ) -> T:
+        """Make a request with each model in turn until one succeeds, hedging it if the first model is slow"""
+        return await _RoutedRequest(self, self.route(user_message), request, get_usage).run()
+
+
+class _RoutedRequest(Generic[T]):
+    """Request routed to the first available model, with the attempts to each model running as tasks"""
+
+    def __init__(
+        self,
+        router: ModelRouter,
+        candidates: list[str],
+        request: Callable[[str], Awaitable[T]],
+        get_usage: Callable[[T], TurnUsage],
+    ):
+        self.router = router
+        self.candidates = candidates
+        self.request = request
+        self.get_usage = get_usage
+        # Model and start time of each attempt in progress
+        self.attempts: dict[asyncio.Future, tuple[str, float]] = {}
+        self.hedged = False
+        self.error: BaseException | None = None
+
+    def _start_next(self) -> str:
+        model_name = self.candidates.pop(0)
+        self.attempts[asyncio.ensure_future(self.request(model_name))] = (model_name, time.perf_counter())
+        return model_name
+
+    async def run(self) -> T:
+        first_model = self._start_next()
+        try:
+            while True:
+                hedge_delay = None if self.hedged or not self.candidates else self.router.hedge_delay(first_model)
+                done, _ = await asyncio.wait(self.attempts, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedged = True
+                    self.router.metrics.hedges += 1
+                    _annotate_turn(model_hedged=True)
+                    self._start_next()
+                    continue
+                for attempt in done:
+                    model_name, start = self.attempts.pop(attempt)
+                    if (error := attempt.exception()) is not None:
+                        self.router.record_failure(model_name, error)
+                        self.error = error
+                        continue
+                    self.router.record_success(
+                        model_name, time.perf_counter() - start, self.get_usage(attempt.result())
+                    )
+                    if model_name != first_model and self.hedged:
+                        self.router.metrics.hedge_wins += 1
+                    return attempt.result()
+                if not self.attempts:
+                    if not self.candidates:
+                        assert self.error is not None
+                        raise self.error
+                    self.router.record_fallback()
+                    self._start_next()
+        finally:
+            for attempt, (model_name, start) in self.attempts.items():
+                attempt.cancel()
+                # The latency of a request which lost the race is at least as long as it took
+                self.router.stats[model_name].latencies.append(time.perf_counter() - start)
+
+
+class MenuRoutedAgentRunner(AgentRunnerWrapper):
+    """Wraps an agent runner whose requests are routed between models, so its turns are classified with its own menu"""
+
+    def __init__(self, runner: AgentRunner, menu_service: MenuService):
+        super().__init__(runner)
+        self.menu_service = menu_service
+
+    @contextmanager
+    def _route_with_menu(self) -> Iterator[None]:
+        token = routed_menu_index.set(self.menu_service.get_index())
+        try:
+            yield
+        finally:
+            routed_menu_index.reset(token)
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        with self._route_with_menu():
+            return self.runner.make_request(user_message)
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        with self._route_with_menu():
+            return await self.runner.make_request_async(user_message)
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        with self._route_with_menu():
+            return await self.runner.stream_request(user_message, on_message)
+
+
+@cache
+def get_model_router(routes: ModelRoutes) -> ModelRouter:
+    """Get the model router which is shared by all agents in the process with the same routes"""
+    return ModelRouter(routes)
+
+
+def _get_turn_attribute(name: str) -> int:
+    trace = current_turn_trace()
+    value = trace.root.attributes.get(name, 0) if trace is not None else 0
+    return value if isinstance(value, int) else 0
+
+
+def _annotate_turn(**attributes: AttributeValue) -> None:
+    """Record routing decisions on the trace of the current turn, if it is being traced, so they are exported"""
+    if (trace := current_turn_trace()) is not None:
+        trace.root.attributes.update(attributes)
+
+
+def build_model_routing_table(router: ModelRouter) -> Table:
+    """Build a table of the measurements of each model routed to, latencies in ms"""
+    table = Table(title="Model routing, latencies in ms")
+    for column in ("model", "requests", "failures", "error rate", "p50", "p95", "cost $"):
+        table.add_column(column, justify="right")
+    for model_name, stats in router.stats.items():
+        percentiles = (stats.latency_percentile(0.5), stats.latency_percentile(0.95))
+        table.add_row(
+            model_name,
+            str(stats.requests),
+            str(stats.failures),
+            f"{stats.error_rate:.0%}",
+            *(f"{latency * 1000:.1f}" if latency is not None else "-" for latency in percentiles),
+            f"{stats.cost:.4f}",
+        )
+    return table
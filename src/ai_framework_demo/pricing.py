@@ -0,0 +1,34 @@
+from ai_framework_demo.usage import TurnUsage
+
+# List prices of models in USD per million input and output tokens, for estimating the cost of requests.
+# Tokens read from the provider's prompt cache are charged at CACHE_READ_PRICE_RATIO of the input price
+MODEL_PRICES: dict[str, tuple[float, float]] = {
+    "openai:gpt-4o": (2.5, 10.0),
+    "openai:gpt-4o-mini": (0.15, 0.6),
+    "openai:gpt-4-turbo": (10.0, 30.0),
+    "openai:gpt-4": (30.0, 60.0),
+    "openai:gpt-3.5-turbo": (0.5, 1.5),
+    "openai:o1": (15.0, 60.0),
+    "openai:o1-mini": (3.0, 12.0),
+    "anthropic:claude-3-5-sonnet-latest": (3.0, 15.0),
+    "anthropic:claude-3-5-haiku-latest": (0.8, 4.0),
+    "anthropic:claude-3-opus-latest": (15.0, 75.0),
+    "google-gla:gemini-1.5-flash": (0.075, 0.3),
+    "google-gla:gemini-1.5-pro": (1.25, 5.0),
+    "google-genai:gemini-1.5-flash": (0.075, 0.3),
+    "google-genai:gemini-1.5-pro": (1.25, 5.0),
+    "groq:llama-3.3-70b-versatile": (0.59, 0.79),
+    "groq:llama-3.1-8b-instant": (0.05, 0.08),
+    "mistral:mistral-small-latest": (0.2, 0.6),
+    "mistral:mistral-large-latest": (2.0, 6.0),
+}
+CACHE_READ_PRICE_RATIO = 0.5
+
+
+def estimate_cost(model_name: str, usage: TurnUsage) -> float | None:
+    """Estimate the cost of token usage with a model in USD, or None if the model's price is unknown"""
+    if (prices := MODEL_PRICES.get(model_name)) is None:
+        return None
+    input_price, output_price = prices
+    input_cost = (usage.cache_miss_tokens + usage.cache_read_tokens * CACHE_READ_PRICE_RATIO) * input_price
+    return (input_cost + usage.output_tokens * output_price) / 1_000_000
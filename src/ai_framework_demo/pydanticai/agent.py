@@ -1,44 +1,140 @@
 import argparse
+import asyncio
+from collections.abc import Callable
+from functools import cache
 
 from pydantic_ai import Agent, RunContext
-from pydantic_ai.messages import ModelMessage
-from pydantic_ai.models import KnownModelName
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.models import KnownModelName, Model
 
-from ai_framework_demo.llm import PROMPT_TEMPLATE, LLMResponse
+from ai_framework_demo.cache import ResponseCache, build_response_cache
+from ai_framework_demo.http_clients import DEFAULT_HTTP_POOL, HttpPoolConfig, build_http_pool_config
+from ai_framework_demo.llm import (
+    TABLE_PROMPT_TEMPLATE,
+    LLMResponse,
+    PrefetchedToolCall,
+    format_static_prompt,
+    parse_partial_message,
+)
+from ai_framework_demo.memory import MemoryPolicy, MemoryStats, build_memory_policy
+from ai_framework_demo.model_routing import ModelRoutes, build_model_routes
+from ai_framework_demo.pydanticai.cache import ResponseCachingModel
 from ai_framework_demo.pydanticai.deps import Dependencies
-from ai_framework_demo.pydanticai.model import build_model_from_name_and_api_key
-from ai_framework_demo.pydanticai.tools import create_order, get_menu
+from ai_framework_demo.pydanticai.memory import PydanticAIMessageAdapter, PydanticAISummariser
+from ai_framework_demo.pydanticai.model import get_shared_model
+from ai_framework_demo.pydanticai.routing import build_routing_model
+from ai_framework_demo.pydanticai.tools import create_order, get_menu, search_menu
+from ai_framework_demo.pydanticai.tracing import TracingModel, TracingTool
+from ai_framework_demo.pydanticai.usage import turn_usage_from_run_usage
+from ai_framework_demo.resilience import ResilienceConfig, build_resilience_config
 from ai_framework_demo.run_agent import AgentRunner
 from ai_framework_demo.services import MenuService, OrderService
+from ai_framework_demo.snapshots import HistoryTracker
+from ai_framework_demo.tracing import build_tracer, trace_span
+from ai_framework_demo.usage import TurnUsage
 
+# Name of the tool used by the agent to return the structured LLMResponse
+RESULT_TOOL_NAME = "final_result"
 
-def get_agent(model_name: KnownModelName, api_key: str | None = None) -> Agent[Dependencies, LLMResponse]:
+
+@cache
+def get_agent(
+    model_name: KnownModelName,
+    api_key: str | None = None,
+    response_cache: ResponseCache | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    tracing: bool = False,
+    model_routes: ModelRoutes | None = None,
+    resilience: ResilienceConfig | None = None,
+) -> Agent[Dependencies, LLMResponse]:
     """
-    Construct an agent with an LLM model, tools and system prompt
+    Construct an agent with an LLM model (or several models to route requests between), tools and system prompt.
+    The agent is shared by all conversations in the process with the same configuration (whichever restaurant and
+    table they are for, which are provided by their dependencies), so its tool schemas are only built once.
     """
-    model = build_model_from_name_and_api_key(
-        model_name=model_name,
-        api_key=api_key,
-    )
+    model: Model
+    if model_routes is None:
+        model = get_shared_model(
+            model_name=model_name,
+            api_key=api_key,
+            http_pool=http_pool,
+            resilience=resilience,
+        )
+    else:
+        model = build_routing_model(model_routes, api_key=api_key, http_pool=http_pool, resilience=resilience)
+    if response_cache is not None:
+        model = ResponseCachingModel(model, response_cache)
+    tools = [get_menu, search_menu, create_order]
+    if tracing:
+        # Record spans of model requests and tool calls in the trace of each turn
+        model = TracingModel(model)
+        tools = [TracingTool(tool) for tool in tools]
     # Tools can also be registered using @agent.tool decorator, but providing them like this is more appropriate when
     # constructing the agent dynamically
-    agent = Agent(model=model, deps_type=Dependencies, tools=[get_menu, create_order], result_type=LLMResponse)
+    agent = Agent(
+        model=model,
+        deps_type=Dependencies,
+        tools=tools,
+        result_type=LLMResponse,
+        result_tool_name=RESULT_TOOL_NAME,
+        # Run tools called alongside the result tool (e.g. create_order), instead of skipping them
+        end_strategy="exhaustive",
+    )
 
-    # Define dynamic system prompt
+    # Define dynamic system prompt, with the static part first so the prompt prefix can be cached by the provider
+    # (async functions are run in the event loop, rather than in a thread like sync functions)
     @agent.system_prompt
-    def system_prompt(ctx: RunContext[Dependencies]) -> str:
-        return PROMPT_TEMPLATE.format(restaurant_name=ctx.deps.restaurant_name, table_number=ctx.deps.table_number)
+    async def system_prompt(ctx: RunContext[Dependencies]) -> str:
+        with trace_span("prompt", "system_prompt"):
+            return format_static_prompt(ctx.deps.restaurant_name)
+
+    @agent.system_prompt
+    async def table_system_prompt(ctx: RunContext[Dependencies]) -> str:
+        with trace_span("prompt", "table_system_prompt"):
+            return TABLE_PROMPT_TEMPLATE.format(table_number=ctx.deps.table_number)
 
     return agent
 
 
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Get the current thread's event loop as used by Agent.run_sync(), creating one if it has been unset
+    (e.g. by a previous call to asyncio.run())
+    """
+    try:
+        return asyncio.get_event_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+
 class PydanticAIAgentRunner(AgentRunner):
     agent: Agent[Dependencies, LLMResponse]
     deps: Dependencies
     message_history: list[ModelMessage]
+    memory: MemoryPolicy
+    memory_stats: list[MemoryStats]
+    turn_usage: list[TurnUsage]
 
     def __init__(self, menu_service: MenuService, order_service: OrderService, args: argparse.Namespace):
-        self.agent = get_agent(model_name=args.model, api_key=args.api_key)
+        self.agent = get_agent(
+            model_name=args.model,
+            api_key=args.api_key,
+            response_cache=build_response_cache(args),
+            http_pool=build_http_pool_config(args),
+            tracing=build_tracer(args) is not None,
+            model_routes=build_model_routes(args),
+            resilience=build_resilience_config(args),
+        )
         self.deps = Dependencies(
             menu_service=menu_service,
             order_service=order_service,
@@ -46,12 +142,97 @@ class PydanticAIAgentRunner(AgentRunner):
             table_number=args.table_number,
         )
         self.message_history = []
+        self.memory = build_memory_policy(args, summariser=PydanticAISummariser(self.agent.model))
+        self.memory_adapter = PydanticAIMessageAdapter()
+        self.history_tracker = HistoryTracker(self.memory_adapter)
+        self.memory_stats = []
+        self.turn_usage = []
+
+    async def _compact_message_history(self) -> list[ModelMessage]:
+        """Apply the memory policy to the message history before it is sent with the next request"""
+        with trace_span("memory", "compact_history"):
+            self.message_history, stats = await self.memory.compact(self.message_history, self.memory_adapter)
+        self.memory_stats.append(stats)
+        return self.message_history
 
     def make_request(self, user_message: str) -> LLMResponse:
+        # Agent.run_sync() (also used by the summariser) runs in the current thread's event loop, which is kept for
+        # all sync requests, so that connections opened in it can be re-used
+        _get_event_loop()
+        with trace_span("memory", "compact_history"):
+            self.message_history, stats = self.memory.compact_sync(self.message_history, self.memory_adapter)
+        self.memory_stats.append(stats)
         ai_response = self.agent.run_sync(
             user_message,
             deps=self.deps,
             message_history=self.message_history,
         )
         self.message_history = ai_response.all_messages()
+        self.turn_usage.append(turn_usage_from_run_usage(ai_response.usage()))
         return ai_response.data
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        ai_response = await self.agent.run(
+            user_message,
+            deps=self.deps,
+            message_history=await self._compact_message_history(),
+        )
+        self.message_history = ai_response.all_messages()
+        self.turn_usage.append(turn_usage_from_run_usage(ai_response.usage()))
+        return ai_response.data
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        if isinstance(self.agent.model, Model) and "anthropic:" in self.agent.model.name():
+            # PydanticAI does not support streamed responses from Anthropic models yet (including when they are one of
+            # the routed models). Checked by name rather than type, so the Anthropic SDK is only imported when used
+            return await super().stream_request(user_message, on_message)
+
+        async with self.agent.run_stream(
+            user_message,
+            deps=self.deps,
+            message_history=await self._compact_message_history(),
+        ) as ai_response:
+            async for model_response, is_last in ai_response.stream_structured(debounce_by=0.05):
+                if is_last:
+                    # Only validate the complete response, which is when the end_conversation flag is resolved
+                    with trace_span("parse", "LLMResponse"):
+                        response = await ai_response.validate_structured_result(model_response)
+                    on_message(response.message)
+                else:
+                    # Only the message content of the partial result tool call is needed for display
+                    for part in model_response.parts:
+                        if isinstance(part, ToolCallPart) and part.tool_name == RESULT_TOOL_NAME:
+                            on_message(parse_partial_message(part.args_as_json_str()))
+        self.message_history = ai_response.all_messages()
+        self.turn_usage.append(turn_usage_from_run_usage(ai_response.usage()))
+        return response
+
+    def dump_history(self) -> tuple[bool, bytes]:
+        return self.history_tracker.dump(self.message_history)
+
+    def load_history(self, chunks: list[bytes]) -> None:
+        self.message_history = self.history_tracker.load(chunks)
+
+    def record_turn(self, user_message: str, response: LLMResponse) -> None:
+        self.message_history = [
+            *self.message_history,
+            ModelRequest(parts=[UserPromptPart(content=user_message)]),
+            ModelResponse(parts=[TextPart(content=response.message)]),
+        ]
+
+    def add_tool_results(self, tool_calls: list[PrefetchedToolCall]) -> None:
+        self.message_history = [
+            *self.message_history,
+            ModelResponse(
+                parts=[
+                    ToolCallPart.from_raw_args(tool_call.tool_name, tool_call.args, tool_call.tool_call_id)
+                    for tool_call in tool_calls
+                ]
+            ),
+            ModelRequest(
+                parts=[
+                    ToolReturnPart(tool_call.tool_name, tool_call.result, tool_call.tool_call_id)
+                    for tool_call in tool_calls
+                ]
+            ),
+        ]
@@ -0,0 +1,95 @@
+import importlib.metadata
+import logging
+from dataclasses import dataclass
+from functools import cache
+
+from anthropic.types import Message as AnthropicMessage
+from anthropic.types import MessageParam, TextBlockParam
+from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, SystemPromptPart
+from pydantic_ai.models import AgentModel
+from pydantic_ai.models.anthropic import AnthropicAgentModel, AnthropicModel
+from pydantic_ai.settings import ModelSettings
+from pydantic_ai.tools import ToolDefinition
+from pydantic_ai.usage import Usage
+
+logger = logging.getLogger(__name__)
+
+# Versions of PydanticAI whose private AnthropicAgentModel methods (_messages_create(), _process_response() and
+# _map_message()) have been checked to work with the prompt caching agent model, which overrides or calls them
+PROMPT_CACHING_PYDANTIC_AI_VERSIONS = frozenset({"0.0.19"})
+
+
+@cache
+def is_prompt_caching_supported() -> bool:
+    """Whether the installed version of PydanticAI is one the prompt caching agent model works with"""
+    version = importlib.metadata.version("pydantic-ai-slim")
+    if version not in PROMPT_CACHING_PYDANTIC_AI_VERSIONS:
+        logger.warning("Anthropic prompt caching is disabled, since it doesn't support pydantic-ai %s", version)
+        return False
+    return True
+
+
+class PromptCachingAnthropicModel(AnthropicModel):
+    """
+    AnthropicModel which marks the static prefix of the prompt (tool definitions and the first system prompt part)
+    with a cache breakpoint, so it is cached by Anthropic between requests. This relies on private methods of
+    PydanticAI's AnthropicAgentModel, so with any other version than those it has been checked with, requests are made
+    by PydanticAI's own agent model instead (without prompt caching).
+    """
+
+    async def agent_model(
+        self,
+        *,
+        function_tools: list[ToolDefinition],
+        allow_text_result: bool,
+        result_tools: list[ToolDefinition],
+    ) -> AgentModel:
+        agent_model = await super().agent_model(
+            function_tools=function_tools, allow_text_result=allow_text_result, result_tools=result_tools
+        )
+        assert isinstance(agent_model, AnthropicAgentModel)
+        if not is_prompt_caching_supported():
+            return agent_model
+        return PromptCachingAnthropicAgentModel(
+            agent_model.client, agent_model.model_name, agent_model.allow_text_result, agent_model.tools
+        )
+
+
+@dataclass
+class PromptCachingAnthropicAgentModel(AnthropicAgentModel):
+    async def request(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> tuple[ModelResponse, Usage]:
+        response = await self._messages_create(messages, False, model_settings)
+        return self._process_response(response), _map_usage(response)
+
+    @staticmethod
+    def _map_message(messages: list[ModelMessage]) -> tuple[list[TextBlockParam], list[MessageParam]]:  # type: ignore[override]
+        # Keep each system prompt part as a separate block, instead of concatenating them,
+        # so the cache breakpoint can be placed after the static part of the system prompt
+        _, anthropic_messages = AnthropicAgentModel._map_message(messages)
+        system_blocks = [
+            TextBlockParam(type="text", text=part.content)
+            for message in messages
+            if isinstance(message, ModelRequest)
+            for part in message.parts
+            if isinstance(part, SystemPromptPart)
+        ]
+        if system_blocks:
+            # Anthropic caches the prompt up to and including the block with cache_control (tools come before system)
+            system_blocks[0]["cache_control"] = {"type": "ephemeral"}
+        return system_blocks, anthropic_messages
+
+
+def _map_usage(response: AnthropicMessage) -> Usage:
+    """Map usage of an Anthropic response, including prompt cache token counts"""
+    cache_read_tokens = response.usage.cache_read_input_tokens or 0
+    cache_write_tokens = response.usage.cache_creation_input_tokens or 0
+    # Anthropic's input_tokens only includes tokens which were not read from or written to the cache
+    request_tokens = response.usage.input_tokens + cache_read_tokens + cache_write_tokens
+    return Usage(
+        request_tokens=request_tokens,
+        response_tokens=response.usage.output_tokens,
+        total_tokens=request_tokens + response.usage.output_tokens,
+        details={"cache_read_tokens": cache_read_tokens, "cache_write_tokens": cache_write_tokens},
+    )
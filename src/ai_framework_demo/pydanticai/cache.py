@@ -0,0 +1,166 @@
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    ModelResponseStreamEvent,
+    RetryPromptPart,
+    SystemPromptPart,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.models import AgentModel, Model, StreamedResponse
+from pydantic_ai.settings import ModelSettings
+from pydantic_ai.tools import ToolDefinition
+from pydantic_ai.usage import Usage
+
+from ai_framework_demo.cache import ResponseCache, ResponseCacheAdapter, ResponseCacheKey
+
+
+class PydanticAIResponseCacheAdapter(ResponseCacheAdapter[ModelMessage]):
+    def message_key(self, message: ModelMessage) -> str:
+        keys: list[str] = []
+        for part in message.parts:
+            if isinstance(part, SystemPromptPart | UserPromptPart | TextPart):
+                keys.append(f"{part.part_kind}:{part.content}")
+            elif isinstance(part, ToolCallPart):
+                keys.append(f"{part.part_kind}:{part.tool_name}{part.args_as_json_str()}")
+            elif isinstance(part, ToolReturnPart):
+                keys.append(f"{part.part_kind}:{part.tool_name}{part.model_response_str()}")
+            elif isinstance(part, RetryPromptPart):
+                keys.append(f"{part.part_kind}:{part.model_response()}")
+        return "\n".join(keys)
+
+    def user_message_text(self, message: ModelMessage) -> str | None:
+        if isinstance(message, ModelRequest):
+            for part in message.parts:
+                if isinstance(part, UserPromptPart):
+                    return part.content
+        return None
+
+    def tool_call_names(self, message: ModelMessage) -> list[str]:
+        if not isinstance(message, ModelResponse):
+            return []
+        return [part.tool_name for part in message.parts if isinstance(part, ToolCallPart)]
+
+    def dump_response(self, response: ModelMessage) -> str:
+        return ModelMessagesTypeAdapter.dump_json([response]).decode()
+
+    def load_response(self, value: str) -> ModelResponse:
+        response = ModelMessagesTypeAdapter.validate_json(value)[0]
+        assert isinstance(response, ModelResponse)
+        return response
+
+
+class ResponseCachingModel(Model):
+    """Model which serves responses from a response cache when possible, instead of making a request"""
+
+    def __init__(self, model: Model, response_cache: ResponseCache):
+        self.model = model
+        self.response_cache = response_cache
+
+    async def agent_model(
+        self,
+        *,
+        function_tools: list[ToolDefinition],
+        allow_text_result: bool,
+        result_tools: list[ToolDefinition],
+    ) -> AgentModel:
+        agent_model = await self.model.agent_model(
+            function_tools=function_tools, allow_text_result=allow_text_result, result_tools=result_tools
+        )
+        return ResponseCachingAgentModel(agent_model, self.name(), self.response_cache)
+
+    def name(self) -> str:
+        return self.model.name()
+
+
+@dataclass
+class ResponseCachingAgentModel(AgentModel):
+    agent_model: AgentModel
+    model_name: str
+    response_cache: ResponseCache
+    adapter: PydanticAIResponseCacheAdapter = field(default_factory=PydanticAIResponseCacheAdapter)
+
+    async def request(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> tuple[ModelResponse, Usage]:
+        key = self.response_cache.get_key(self.model_name, messages, self.adapter)
+        if key is not None and (cached := self.response_cache.get(key)) is not None:
+            return self.adapter.load_response(cached.value), Usage()
+
+        start = time.perf_counter()
+        response, usage = await self.agent_model.request(messages, model_settings)
+        if key is not None:
+            self.response_cache.set(key, response, time.perf_counter() - start, self.adapter)
+        return response, usage
+
+    @asynccontextmanager
+    async def request_stream(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> AsyncIterator[StreamedResponse]:
+        key = self.response_cache.get_key(self.model_name, messages, self.adapter)
+        if key is not None and (cached := self.response_cache.get(key)) is not None:
+            yield CachedStreamedResponse(self.adapter.load_response(cached.value))
+            return
+
+        start = time.perf_counter()
+        async with self.agent_model.request_stream(messages, model_settings) as streamed_response:
+            yield ResponseCachingStreamedResponse(streamed_response, key, start, self.response_cache, self.adapter)
+
+
+@dataclass
+class CachedStreamedResponse(StreamedResponse):
+    """Replays a cached response as a stream"""
+
+    response: ModelResponse
+
+    async def _get_event_iterator(self) -> AsyncIterator[ModelResponseStreamEvent]:
+        for index, part in enumerate(self.response.parts):
+            if isinstance(part, TextPart):
+                yield self._parts_manager.handle_text_delta(vendor_part_id=index, content=part.content)
+            else:
+                yield self._parts_manager.handle_tool_call_part(
+                    vendor_part_id=index,
+                    tool_name=part.tool_name,
+                    args=part.args_as_json_str(),
+                    tool_call_id=part.tool_call_id,
+                )
+
+    def timestamp(self) -> datetime:
+        return self.response.timestamp
+
+
+@dataclass
+class ResponseCachingStreamedResponse(StreamedResponse):
+    """Passes through a streamed response from the model, caching the complete response when the stream ends"""
+
+    streamed_response: StreamedResponse
+    key: ResponseCacheKey | None
+    start: float
+    response_cache: ResponseCache
+    adapter: PydanticAIResponseCacheAdapter
+
+    async def _get_event_iterator(self) -> AsyncIterator[ModelResponseStreamEvent]:
+        async for event in self.streamed_response:
+            yield event
+        if self.key is not None:
+            latency = time.perf_counter() - self.start
+            self.response_cache.set(self.key, self.streamed_response.get(), latency, self.adapter)
+
+    def get(self) -> ModelResponse:
+        return self.streamed_response.get()
+
+    def usage(self) -> Usage:
+        return self.streamed_response.usage()
+
+    def timestamp(self) -> datetime:
+        return self.streamed_response.timestamp()
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from ai_framework_demo.services import MenuService, OrderService
 
@@ -9,3 +9,5 @@ class Dependencies:
     order_service: OrderService
     restaurant_name: str
     table_number: int
+    # IDs of the tool calls which have been matched to a call of their tool, see _get_tool_call_idempotency_key()
+    claimed_tool_call_ids: set[str] = field(default_factory=set)
@@ -0,0 +1,123 @@
+from dataclasses import replace
+
+from pydantic_ai import Agent
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    RetryPromptPart,
+    SystemPromptPart,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.models import Model
+
+from ai_framework_demo.memory import SUMMARY_PREFIX, MessageAdapter, Summariser
+
+
+class PydanticAIMessageAdapter(MessageAdapter[ModelMessage]):
+    def message_text(self, message: ModelMessage) -> str:
+        texts: list[str] = []
+        for part in message.parts:
+            if isinstance(part, SystemPromptPart | UserPromptPart | TextPart):
+                texts.append(part.content)
+            elif isinstance(part, ToolReturnPart):
+                texts.append(part.model_response_str())
+            elif isinstance(part, ToolCallPart):
+                texts.append(part.tool_name + part.args_as_json_str())
+            elif isinstance(part, RetryPromptPart):
+                texts.append(part.model_response())
+        return "\n".join(texts)
+
+    def is_turn_start(self, message: ModelMessage) -> bool:
+        return isinstance(message, ModelRequest) and any(isinstance(part, UserPromptPart) for part in message.parts)
+
+    def split_pinned(self, messages: list[ModelMessage]) -> tuple[list[ModelMessage], list[ModelMessage]]:
+        # The system prompt is only included in the first request of the history,
+        # so it must be split from the first user prompt of the conversation
+        if not messages or not isinstance(first := messages[0], ModelRequest):
+            return [], messages
+        system_parts = [part for part in first.parts if isinstance(part, SystemPromptPart)]
+        if not system_parts:
+            return [], messages
+        other_parts = [part for part in first.parts if not isinstance(part, SystemPromptPart)]
+        rest = messages[1:]
+        if other_parts:
+            rest = [ModelRequest(parts=other_parts), *rest]
+        return [ModelRequest(parts=system_parts)], rest
+
+    def join_pinned(self, pinned: list[ModelMessage], messages: list[ModelMessage]) -> list[ModelMessage]:
+        if pinned and messages and isinstance(messages[0], ModelRequest):
+            # Merge system prompt into the first request, as PydanticAI would have done
+            return [ModelRequest(parts=[*pinned[0].parts, *messages[0].parts]), *messages[1:]]
+        return [*pinned, *messages]
+
+    def tool_return_names(self, message: ModelMessage) -> list[str]:
+        if not isinstance(message, ModelRequest):
+            return []
+        return [part.tool_name for part in message.parts if isinstance(part, ToolReturnPart)]
+
+    def replace_tool_returns(self, message: ModelMessage, tool_names: set[str], content: str) -> ModelMessage:
+        assert isinstance(message, ModelRequest)
+        parts = [
+            replace(part, content=content)
+            if isinstance(part, ToolReturnPart) and part.tool_name in tool_names
+            else part
+            for part in message.parts
+        ]
+        return ModelRequest(parts=parts)
+
+    def get_summary(self, pinned: list[ModelMessage]) -> str | None:
+        for message in pinned:
+            for part in message.parts:
+                if isinstance(part, SystemPromptPart) and part.content.startswith(SUMMARY_PREFIX):
+                    return part.content.removeprefix(SUMMARY_PREFIX)
+        return None
+
+    def set_summary(self, pinned: list[ModelMessage], summary: str) -> list[ModelMessage]:
+        parts = [
+            part
+            for message in pinned
+            for part in message.parts
+            if not (isinstance(part, SystemPromptPart) and part.content.startswith(SUMMARY_PREFIX))
+        ]
+        return [ModelRequest(parts=[*parts, SystemPromptPart(content=summary)])]
+
+    def format_transcript(self, messages: list[ModelMessage]) -> str:
+        lines: list[str] = []
+        for message in messages:
+            for part in message.parts:
+                if isinstance(part, UserPromptPart):
+                    lines.append(f"Customer: {part.content}")
+                elif isinstance(part, TextPart):
+                    lines.append(f"Waiter: {part.content}")
+                elif isinstance(part, ToolCallPart):
+                    # The structured response is returned by a tool call
+                    args = part.args_as_dict()
+                    if "message" in args:
+                        lines.append(f"Waiter: {args['message']}")
+                    else:
+                        lines.append(f"Waiter called tool {part.tool_name}({part.args_as_json_str()})")
+        return "\n".join(lines)
+
+    def dump_messages(self, messages: list[ModelMessage]) -> bytes:
+        return ModelMessagesTypeAdapter.dump_json(messages)
+
+    def load_messages(self, data: bytes) -> list[ModelMessage]:
+        return ModelMessagesTypeAdapter.validate_json(data)
+
+
+class PydanticAISummariser(Summariser):
+    """Summarises conversation transcripts using the given model"""
+
+    def __init__(self, model: Model):
+        self.summary_agent = Agent(model=model, result_type=str)
+
+    async def summarise(self, prompt: str) -> str:
+        result = await self.summary_agent.run(prompt)
+        return result.data
+
+    def summarise_sync(self, prompt: str) -> str:
+        return self.summary_agent.run_sync(prompt).data
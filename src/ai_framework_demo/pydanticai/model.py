@@ -1,38 +1,93 @@
+from functools import cache
 from typing import cast
 
 from pydantic_ai.models import KnownModelName, Model
 
+from ai_framework_demo.http_clients import DEFAULT_HTTP_POOL, HttpPoolConfig, get_async_http_client
+from ai_framework_demo.resilience import ResilienceConfig, ResilientCaller
 
-def build_model_from_name_and_api_key(model_name: KnownModelName, api_key: str | None = None) -> Model:
+
+def build_model_from_name_and_api_key(
+    model_name: KnownModelName,
+    api_key: str | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    max_retries: int | None = None,
+) -> Model:
+    """
+    Build a model from its name, with `max_retries` overriding the number of retries made by the provider SDK
+    (where the SDK retries requests itself)
+    """
+    # Model clients share keep-alive connections to each provider
+    http_client = get_async_http_client(http_pool)
     if model_name.startswith("openai:"):
         from pydantic_ai.models.openai import OpenAIModel
 
-        return OpenAIModel(model_name[7:], api_key=api_key)
+        if max_retries is not None:
+            from openai import AsyncOpenAI
+
+            client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=max_retries)
+            return OpenAIModel(model_name[7:], openai_client=client)
+        return OpenAIModel(model_name[7:], api_key=api_key, http_client=http_client)
 
     elif model_name.startswith("anthropic:"):
-        from pydantic_ai.models.anthropic import AnthropicModel
+        from ai_framework_demo.pydanticai.anthropic import PromptCachingAnthropicModel
+
+        if max_retries is not None:
+            from anthropic import AsyncAnthropic
 
-        return AnthropicModel(model_name[10:], api_key=api_key)
+            client = AsyncAnthropic(api_key=api_key, http_client=http_client, max_retries=max_retries)
+            return PromptCachingAnthropicModel(model_name[10:], anthropic_client=client)
+        return PromptCachingAnthropicModel(model_name[10:], api_key=api_key, http_client=http_client)
 
     elif model_name.startswith("google-gla:"):
         from pydantic_ai.models.gemini import GeminiModel, GeminiModelName
 
-        return GeminiModel(cast(GeminiModelName, model_name[11:]), api_key=api_key)
+        return GeminiModel(cast(GeminiModelName, model_name[11:]), api_key=api_key, http_client=http_client)
 
     elif model_name.startswith("groq:"):
         from pydantic_ai.models.groq import GroqModel, GroqModelName
 
-        return GroqModel(cast(GroqModelName, model_name[5:]), api_key=api_key)
+        return GroqModel(cast(GroqModelName, model_name[5:]), api_key=api_key, http_client=http_client)
 
     elif model_name.startswith("mistral:"):
         from pydantic_ai.models.mistral import MistralModel
 
-        return MistralModel(model_name[8:], api_key=api_key)
+        return MistralModel(model_name[8:], api_key=api_key, http_client=http_client)
 
     elif model_name.startswith("ollama:"):
         from pydantic_ai.models.ollama import OllamaModel
 
-        return OllamaModel(model_name[7:], api_key=api_key or "ollama")
+        return OllamaModel(model_name[7:], api_key=api_key or "ollama", http_client=http_client)
+
+    elif model_name.startswith("scripted:"):
+        # Deterministic stand-in model which replays a scripted conversation, for running without a provider
+        from ai_framework_demo.pydanticai.scripted_model import build_scripted_model
+        from ai_framework_demo.scripted import parse_scripted_model_name
+
+        return build_scripted_model(*parse_scripted_model_name(model_name[9:]))
 
     else:
         raise ValueError(f"Unsupported model name: {model_name}")
+
+
+@cache
+def get_shared_model(
+    model_name: KnownModelName,
+    api_key: str | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    resilience: ResilienceConfig | None = None,
+) -> Model:
+    """
+    Get a model instance which is shared by all agents in the process using the same model name and API key,
+    so that concurrent sessions re-use the same client instead of each building their own.
+    With a resilience policy, requests are retried by the policy instead of the provider SDK.
+    """
+    if resilience is None:
+        return build_model_from_name_and_api_key(model_name=model_name, api_key=api_key, http_pool=http_pool)
+
+    from ai_framework_demo.pydanticai.resilience import ResilientModel
+
+    model = build_model_from_name_and_api_key(
+        model_name=model_name, api_key=api_key, http_pool=http_pool, max_retries=0
+    )
+    return ResilientModel(model, ResilientCaller(model_name, api_key, resilience))
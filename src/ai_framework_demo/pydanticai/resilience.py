@@ -0,0 +1,62 @@
+from collections.abc import AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
+
+from pydantic_ai.messages import ModelMessage, ModelResponse
+from pydantic_ai.models import AgentModel, Model, StreamedResponse
+from pydantic_ai.settings import ModelSettings
+from pydantic_ai.tools import ToolDefinition
+from pydantic_ai.usage import Usage
+
+from ai_framework_demo.pydanticai.usage import turn_usage_from_run_usage
+from ai_framework_demo.resilience import ResilientCaller
+
+
+class ResilientModel(Model):
+    """Model whose requests are made with a deadline and retried on transient errors by a ResilientCaller"""
+
+    def __init__(self, model: Model, caller: ResilientCaller):
+        self.model = model
+        self.caller = caller
+
+    async def agent_model(
+        self,
+        *,
+        function_tools: list[ToolDefinition],
+        allow_text_result: bool,
+        result_tools: list[ToolDefinition],
+    ) -> AgentModel:
+        agent_model = await self.model.agent_model(
+            function_tools=function_tools, allow_text_result=allow_text_result, result_tools=result_tools
+        )
+        return ResilientAgentModel(agent_model, self.caller)
+
+    def name(self) -> str:
+        return self.model.name()
+
+
+@dataclass
+class ResilientAgentModel(AgentModel):
+    agent_model: AgentModel
+    caller: ResilientCaller
+
+    async def request(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> tuple[ModelResponse, Usage]:
+        return await self.caller.call(
+            lambda: self.agent_model.request(messages, model_settings),
+            lambda result: turn_usage_from_run_usage(result[1]),
+        )
+
+    @asynccontextmanager
+    async def request_stream(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> AsyncIterator[StreamedResponse]:
+        # Only starting the stream (which includes receiving its first chunk) is retried and subject to the request
+        # deadline, since the agent consumes the stream as it arrives
+        async with AsyncExitStack() as stack:
+            streamed_response = await self.caller.call(
+                lambda: stack.enter_async_context(self.agent_model.request_stream(messages, model_settings))
+            )
+            yield streamed_response
+        self.caller.record_usage(turn_usage_from_run_usage(streamed_response.usage()))
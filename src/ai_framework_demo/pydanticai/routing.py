@@ -0,0 +1,112 @@
+import time
+from collections.abc import AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass, field
+from typing import cast
+
+from pydantic_ai.messages import ModelMessage, ModelResponse
+from pydantic_ai.models import AgentModel, KnownModelName, Model, StreamedResponse
+from pydantic_ai.settings import ModelSettings
+from pydantic_ai.tools import ToolDefinition
+from pydantic_ai.usage import Usage
+
+from ai_framework_demo.http_clients import DEFAULT_HTTP_POOL, HttpPoolConfig
+from ai_framework_demo.model_routing import ModelRouter, ModelRoutes, get_model_router
+from ai_framework_demo.pydanticai.cache import PydanticAIResponseCacheAdapter
+from ai_framework_demo.pydanticai.model import get_shared_model
+from ai_framework_demo.pydanticai.usage import turn_usage_from_run_usage
+from ai_framework_demo.resilience import ResilienceConfig
+
+
+class RoutingModel(Model):
+    """Model which routes each request between several models with a ModelRouter"""
+
+    def __init__(self, models: dict[str, Model], router: ModelRouter):
+        self.models = models
+        self.router = router
+
+    async def agent_model(
+        self,
+        *,
+        function_tools: list[ToolDefinition],
+        allow_text_result: bool,
+        result_tools: list[ToolDefinition],
+    ) -> AgentModel:
+        agent_models = {
+            model_name: await model.agent_model(
+                function_tools=function_tools, allow_text_result=allow_text_result, result_tools=result_tools
+            )
+            for model_name, model in self.models.items()
+        }
+        return RoutingAgentModel(agent_models, self.router)
+
+    def name(self) -> str:
+        return self.router.routes.name
+
+
+@dataclass
+class RoutingAgentModel(AgentModel):
+    agent_models: dict[str, AgentModel]
+    router: ModelRouter
+    adapter: PydanticAIResponseCacheAdapter = field(default_factory=PydanticAIResponseCacheAdapter)
+
+    def _get_user_message(self, messages: list[ModelMessage]) -> str | None:
+        return next(
+            (text for message in reversed(messages) if (text := self.adapter.user_message_text(message)) is not None),
+            None,
+        )
+
+    async def request(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> tuple[ModelResponse, Usage]:
+        return await self.router.run(
+            self._get_user_message(messages),
+            lambda model_name: self.agent_models[model_name].request(messages, model_settings),
+            lambda result: turn_usage_from_run_usage(result[1]),
+        )
+
+    @asynccontextmanager
+    async def request_stream(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> AsyncIterator[StreamedResponse]:
+        # Streamed requests fall back to the next model if the stream can't be started (which includes receiving its
+        # first chunk), but are not hedged, since the agent consumes the stream as it arrives
+        candidates = self.router.route(self._get_user_message(messages))
+        for index, model_name in enumerate(candidates):
+            start = time.perf_counter()
+            stack = AsyncExitStack()
+            try:
+                streamed_response = await stack.enter_async_context(
+                    self.agent_models[model_name].request_stream(messages, model_settings)
+                )
+            except Exception as e:
+                await stack.aclose()
+                self.router.record_failure(model_name, e)
+                if index == len(candidates) - 1:
+                    raise
+                self.router.record_fallback()
+                continue
+            async with stack:
+                yield streamed_response
+            latency = time.perf_counter() - start
+            self.router.record_success(model_name, latency, turn_usage_from_run_usage(streamed_response.usage()))
+            return
+
+
+def build_routing_model(
+    routes: ModelRoutes,
+    api_key: str | None = None,
+    http_pool: HttpPoolConfig = DEFAULT_HTTP_POOL,
+    resilience: ResilienceConfig | None = None,
+) -> RoutingModel:
+    """Build a model which routes requests between the shared instances of the routed models"""
+    models = {
+        model_name: get_shared_model(
+            model_name=cast(KnownModelName, model_name),
+            api_key=routes.get_api_key(model_name, api_key),
+            http_pool=http_pool,
+            resilience=resilience,
+        )
+        for model_name in routes.model_names
+    }
+    return RoutingModel(models, get_model_router(routes))
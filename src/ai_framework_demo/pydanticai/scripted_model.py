@@ -0,0 +1,78 @@
+import asyncio
+import json
+from collections.abc import AsyncIterator
+
+from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, ToolCallPart, UserPromptPart
+from pydantic_ai.models.function import AgentInfo, DeltaToolCall, DeltaToolCalls, FunctionModel
+
+from ai_framework_demo.llm import PREFETCHED_TOOL_CALL_ID_PREFIX
+from ai_framework_demo.scripted import RESPOND_TOOL_NAME, ScriptedConversation, ScriptedToolCall
+
+# Size of the chunks which streamed tool call arguments are split into
+STREAM_CHUNK_SIZE = 8
+
+
+def build_scripted_model(conversation: ScriptedConversation, latency: float = 0) -> FunctionModel:
+    """
+    Build a model which replays a scripted conversation, with `latency` seconds injected into each request
+    """
+
+    def get_tool_calls(messages: list[ModelMessage], info: AgentInfo) -> list[ToolCallPart]:
+        user_message, step, prefetched = _get_current_step(messages)
+        result_tool_name = info.result_tools[0].name if info.result_tools else RESPOND_TOOL_NAME
+        return [
+            _to_tool_call_part(tool_call, result_tool_name, index)
+            for index, tool_call in enumerate(conversation.get_step(user_message, step, prefetched))
+        ]
+
+    async def request(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        await asyncio.sleep(latency)
+        return ModelResponse(parts=list(get_tool_calls(messages, info)))
+
+    async def request_stream(messages: list[ModelMessage], info: AgentInfo) -> AsyncIterator[DeltaToolCalls]:
+        await asyncio.sleep(latency)
+        for index, tool_call in enumerate(get_tool_calls(messages, info)):
+            args_json = tool_call.args_as_json_str()
+            yield {index: DeltaToolCall(name=tool_call.tool_name)}
+            for chunk_start in range(0, len(args_json), STREAM_CHUNK_SIZE):
+                yield {index: DeltaToolCall(json_args=args_json[chunk_start : chunk_start + STREAM_CHUNK_SIZE])}
+
+    return FunctionModel(request, stream_function=request_stream)
+
+
+def _get_current_step(messages: list[ModelMessage]) -> tuple[str, int, list[ScriptedToolCall]]:
+    """
+    Get the latest user message, the number of model responses to it so far, and the tool calls which were prefetched
+    before it
+    """
+    step = 0
+    for index in range(len(messages) - 1, -1, -1):
+        message = messages[index]
+        if isinstance(message, ModelResponse):
+            step += 1
+        elif isinstance(message, ModelRequest):
+            for part in message.parts:
+                if isinstance(part, UserPromptPart):
+                    return part.content, step, _get_prefetched_tool_calls(messages[:index])
+    raise ValueError("No user message found in messages")
+
+
+def _get_prefetched_tool_calls(messages: list[ModelMessage]) -> list[ScriptedToolCall]:
+    """Get the tool calls which were prefetched since the previous user message"""
+    prefetched = []
+    for message in reversed(messages):
+        if isinstance(message, ModelRequest) and any(isinstance(part, UserPromptPart) for part in message.parts):
+            break
+        if isinstance(message, ModelResponse):
+            prefetched.extend(
+                ScriptedToolCall(part.tool_name, part.args_as_dict())
+                for part in message.parts
+                if isinstance(part, ToolCallPart)
+                and (part.tool_call_id or "").startswith(PREFETCHED_TOOL_CALL_ID_PREFIX)
+            )
+    return prefetched
+
+
+def _to_tool_call_part(tool_call: ScriptedToolCall, result_tool_name: str, index: int) -> ToolCallPart:
+    tool_name = result_tool_name if tool_call.name == RESPOND_TOOL_NAME else tool_call.name
+    return ToolCallPart.from_raw_args(tool_name, json.dumps(tool_call.args), tool_call_id=f"call_{index}")
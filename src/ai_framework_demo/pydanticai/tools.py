@@ -1,20 +1,70 @@
 from typing import Annotated
 
 from pydantic_ai import RunContext
+from pydantic_ai.messages import ModelResponse, ToolCallPart
 
 from ai_framework_demo.pydanticai.deps import Dependencies
+from ai_framework_demo.services import DietaryTag
 
 
-def create_order(
+async def create_order(
     ctx: RunContext[Dependencies],
     table_number: int,
     order_items: Annotated[list[str], "List of food menu items to order"],
 ) -> str:
     """Create an order for the table"""
-    ctx.deps.order_service.create_order(table_number, order_items)
+    await ctx.deps.order_service.create_order_async(
+        table_number, order_items, idempotency_key=_get_tool_call_idempotency_key(ctx, table_number, order_items)
+    )
     return "Order placed"
 
 
+def _get_tool_call_idempotency_key(
+    ctx: RunContext[Dependencies], table_number: int, order_items: list[str]
+) -> str | None:
+    """
+    Get an idempotency key for the current tool call based on its ID, so that re-executing the same tool call
+    does not have any additional side effects.
+    The tool call ID is not provided by the RunContext, so it is found from the latest model response: the first call
+    with the same arguments which hasn't been claimed by another call yet, so identical calls in the same response get
+    their own keys (re-executed calls get the first one's). Calls claim their ID before they first await, so concurrent
+    calls can't claim the same one.
+    """
+    tool_call_ids: list[str] = []
+    for message in reversed(ctx.messages):
+        if isinstance(message, ModelResponse):
+            tool_call_ids = [
+                part.tool_call_id
+                for part in message.parts
+                if isinstance(part, ToolCallPart)
+                and part.tool_name == ctx.tool_name
+                and part.tool_call_id is not None
+                and part.args_as_dict() == {"table_number": table_number, "order_items": order_items}
+            ]
+            break
+    if not tool_call_ids:
+        return None
+    claimed = ctx.deps.claimed_tool_call_ids
+    tool_call_id = next(
+        (tool_call_id for tool_call_id in tool_call_ids if tool_call_id not in claimed), tool_call_ids[0]
+    )
+    claimed.add(tool_call_id)
+    return f"{ctx.deps.table_number}:{tool_call_id}"
+
+
 def get_menu(ctx: RunContext[Dependencies]) -> dict[str, list[str]]:
     """Get the full menu for the restaurant"""
     return ctx.deps.menu_service.get_menu()
+
+
+def search_menu(
+    ctx: RunContext[Dependencies],
+    dietary_tags: Annotated[
+        list[DietaryTag] | None, "Dietary requirements items must satisfy: V (vegetarian), VG (vegan), GF (gluten-free)"
+    ] = None,
+    category: Annotated[str | None, "Menu category, e.g. Appetizers, Main Courses or Desserts"] = None,
+    text: Annotated[str | None, "Text which the item name must contain"] = None,
+) -> dict[str, list[str]]:
+    """Search the menu for items matching dietary requirements, category and/or text.
+    Items which can be prepared to satisfy a dietary requirement on request are marked as an "option"."""
+    return ctx.deps.menu_service.search_menu(tags=dietary_tags or (), category=category, text=text)
@@ -0,0 +1,70 @@
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from pydantic_ai import Tool
+from pydantic_ai.messages import ModelMessage, ModelRequestPart, ModelResponse, ToolCallPart
+from pydantic_ai.models import AgentModel, Model, StreamedResponse
+from pydantic_ai.settings import ModelSettings
+from pydantic_ai.tools import AgentDeps, RunContext, ToolDefinition
+from pydantic_ai.usage import Usage
+
+from ai_framework_demo.pydanticai.usage import turn_usage_from_run_usage
+from ai_framework_demo.tracing import trace_span
+
+
+class TracingModel(Model):
+    """Model which records a span of each request in the trace of the current turn, if it is being traced"""
+
+    def __init__(self, model: Model):
+        self.model = model
+
+    async def agent_model(
+        self,
+        *,
+        function_tools: list[ToolDefinition],
+        allow_text_result: bool,
+        result_tools: list[ToolDefinition],
+    ) -> AgentModel:
+        agent_model = await self.model.agent_model(
+            function_tools=function_tools, allow_text_result=allow_text_result, result_tools=result_tools
+        )
+        return TracingAgentModel(agent_model, self.name())
+
+    def name(self) -> str:
+        return self.model.name()
+
+
+@dataclass
+class TracingAgentModel(AgentModel):
+    agent_model: AgentModel
+    model_name: str
+
+    async def request(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> tuple[ModelResponse, Usage]:
+        with trace_span("model", self.model_name) as span:
+            response, usage = await self.agent_model.request(messages, model_settings)
+            if span is not None:
+                span.set_usage(turn_usage_from_run_usage(usage))
+        return response, usage
+
+    @asynccontextmanager
+    async def request_stream(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> AsyncIterator[StreamedResponse]:
+        # The span lasts until the agent has finished consuming the stream
+        with trace_span("model", self.model_name, streamed=True) as span:
+            async with self.agent_model.request_stream(messages, model_settings) as streamed_response:
+                yield streamed_response
+            if span is not None:
+                span.set_usage(turn_usage_from_run_usage(streamed_response.usage()))
+
+
+class TracingTool(Tool[AgentDeps]):
+    """Tool which records a span of each call in the trace of the current turn, if it is being traced"""
+
+    async def run(self, message: ToolCallPart, run_context: RunContext[AgentDeps]) -> ModelRequestPart:
+        # Run in the agent's event loop (sync tool functions are then run in a thread), so the current trace is known
+        with trace_span("tool", message.tool_name):
+            return await super().run(message, run_context)
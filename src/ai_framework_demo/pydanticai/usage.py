@@ -0,0 +1,16 @@
+from pydantic_ai.usage import Usage
+
+from ai_framework_demo.usage import TurnUsage
+
+
+def turn_usage_from_run_usage(usage: Usage) -> TurnUsage:
+    """Convert the usage of a PydanticAI agent run into a TurnUsage"""
+    details = usage.details or {}
+    return TurnUsage(
+        requests=usage.requests,
+        input_tokens=usage.request_tokens or 0,
+        output_tokens=usage.response_tokens or 0,
+        # OpenAI reports tokens read from its automatic prompt cache as `cached_tokens`
+        cache_read_tokens=details.get("cache_read_tokens", details.get("cached_tokens", 0)),
+        cache_write_tokens=details.get("cache_write_tokens", 0),
+    )
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+
+@dataclass
+class TokenBucket:
+    """Bucket which refills continuously up to `per_minute`, and can go into debt when more is consumed than it holds"""
+
+    per_minute: float
+    level: float = field(init=False)
+    updated: float = field(init=False, default_factory=time.monotonic)
+
+    def __post_init__(self):
+        self.level = self.per_minute
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` can be consumed (amounts larger than the bucket only need it to be full)"""
+        self.refill()
+        missing = min(amount, self.per_minute) - self.level
+        return max(0.0, missing * 60 / self.per_minute)
+
+    def consume(self, amount: float) -> None:
+        self.refill()
+        self.level -= amount
+
+
+class RateLimiter:
+    """
+    Limits the rate of model requests and tokens (e.g. to a provider's rate limits) with token buckets.
+    Since the tokens used by a request are only known once it has completed, an estimate can be acquired up front
+    and the difference settled afterwards with `adjust()`.
+    """
+
+    def __init__(self, requests_per_minute: float | None = None, tokens_per_minute: float | None = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def _buckets(self, requests: float, tokens: float) -> list[tuple[TokenBucket, float]]:
+        return [
+            (bucket, amount)
+            for bucket, amount in ((self.requests, requests), (self.tokens, tokens))
+            if bucket is not None
+        ]
+
+    def _delay(self, requests: float, tokens: float) -> float:
+        return max((bucket.delay(amount) for bucket, amount in self._buckets(requests, tokens)), default=0)
+
+    async def acquire(self, requests: float = 1, tokens: float = 0) -> None:
+        """Wait until the requests and tokens are available, then consume them"""
+        while (delay := self._delay(requests, tokens)) > 0:
+            await asyncio.sleep(delay)
+        self.adjust(requests, tokens)
+
+    def acquire_sync(self, requests: float = 1, tokens: float = 0) -> None:
+        """Block until the requests and tokens are available, then consume them"""
+        while (delay := self._delay(requests, tokens)) > 0:
+            time.sleep(delay)
+        self.adjust(requests, tokens)
+
+    def adjust(self, requests: float = 0, tokens: float = 0) -> None:
+        """Consume (or return, if negative) requests and tokens without waiting"""
+        for bucket, amount in self._buckets(requests, tokens):
+            bucket.consume(amount)
+
+
+class ConcurrencyLimiter:
+    """
+    Limits the number of requests in flight, whichever thread or event loop they are made from (unlike an asyncio
+    semaphore, which is bound to a single event loop). Waiting requests are admitted in order, each being handed the
+    slot of a request which has finished.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        # Callbacks which wake up each waiting request once it has been handed a slot
+        self._waiters: deque[Callable[[], None]] = deque()
+
+    def _acquire_or_wait(self, wake: Callable[[], None]) -> bool:
+        """Take a slot if one is free, otherwise queue `wake` to be called once a slot is handed over"""
+        with self._lock:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return True
+            self._waiters.append(wake)
+            return False
+
+    async def acquire(self) -> None:
+        """Wait until a slot is free, then take it"""
+        loop = asyncio.get_running_loop()
+        slot: asyncio.Future[None] = loop.create_future()
+
+        def hand_over() -> None:
+            # A request which was cancelled after being handed a slot passes it on
+            if slot.cancelled():
+                self.release()
+            else:
+                slot.set_result(None)
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(hand_over)
+
+        if self._acquire_or_wait(wake):
+            return
+        try:
+            await slot
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiting := wake in self._waiters:
+                    self._waiters.remove(wake)
+            if not waiting and slot.done() and not slot.cancelled():
+                self.release()
+            raise
+
+    def acquire_sync(self) -> None:
+        """Block until a slot is free, then take it"""
+        handed_over = threading.Event()
+        if not self._acquire_or_wait(handed_over.set):
+            handed_over.wait()
+
+    def release(self) -> None:
+        with self._lock:
+            if not self._waiters:
+                self.in_flight -= 1
+                return
+            wake = self._waiters.popleft()
+        # The slot stays in flight, since it is handed over to the next waiting request
+        wake()
@@ -0,0 +1,335 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import threading
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from functools import cache
+from typing import TypeVar
+
+from ai_framework_demo.rate_limit import ConcurrencyLimiter, RateLimiter
+from ai_framework_demo.usage import TurnUsage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# HTTP status codes of provider errors which are worth retrying: timeouts, conflicts, rate limits and server errors
+# (529 is Anthropic's overloaded status)
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504, 529})
+# Names of provider SDK exceptions which are worth retrying, so the SDKs needn't be imported to check for them
+# (the OpenAI, Anthropic and Groq SDKs all raise APIConnectionError, which APITimeoutError is a subclass of)
+RETRYABLE_ERROR_NAMES = frozenset({"APIConnectionError"})
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request to a provider which has failed repeatedly, until it is tried again"""
+
+
+@dataclass(frozen=True)
+class ResilienceConfig:
+    """Policy for handling slow and failing model requests, and the rate limits of providers"""
+
+    # Deadlines in seconds of each model request, and of each conversation turn including any retries
+    # (None to wait indefinitely)
+    call_timeout: float | None = 60
+    turn_timeout: float | None = 180
+    # Retries of model requests which failed with a transient error, with exponential backoff and full jitter
+    max_retries: int = 2
+    retry_backoff: float = 0.5
+    max_retry_backoff: float = 8
+    # Retries of turns which failed with a transient error, which are only made if the turn didn't create an order
+    turn_retries: int = 1
+    # Consecutive failed requests to a provider API key after which its requests fail fast,
+    # until a single request is tried again after `circuit_reset` seconds
+    circuit_failures: int = 5
+    circuit_reset: float = 30
+    # Rate limits of each provider API key
+    requests_per_minute: float | None = None
+    tokens_per_minute: float | None = None
+    # Requests in flight with each provider API key in the process, whichever model of the provider they are for
+    # (None for no limit)
+    max_concurrent_requests: int | None = None
+
+    def get_backoff(self, attempt: int, error: BaseException) -> float:
+        """Seconds to wait before retrying a request, preferring the delay requested by the provider"""
+        if (retry_after := get_retry_after(error)) is not None:
+            return min(retry_after, self.max_retry_backoff)
+        return random.uniform(0, min(self.max_retry_backoff, self.retry_backoff * 2**attempt))
+
+
+DEFAULT_RESILIENCE = ResilienceConfig()
+
+
+def build_resilience_config(args: argparse.Namespace) -> ResilienceConfig:
+    """Build the resilience policy from the CLI arguments (timeouts of 0 disable them)"""
+    return ResilienceConfig(
+        call_timeout=getattr(args, "call_timeout", DEFAULT_RESILIENCE.call_timeout) or None,
+        turn_timeout=getattr(args, "turn_timeout", DEFAULT_RESILIENCE.turn_timeout) or None,
+        max_retries=getattr(args, "max_retries", DEFAULT_RESILIENCE.max_retries),
+        turn_retries=getattr(args, "turn_retries", DEFAULT_RESILIENCE.turn_retries),
+        circuit_failures=getattr(args, "circuit_breaker_failures", DEFAULT_RESILIENCE.circuit_failures),
+        circuit_reset=getattr(args, "circuit_breaker_reset", DEFAULT_RESILIENCE.circuit_reset),
+        requests_per_minute=getattr(args, "requests_per_minute", None),
+        tokens_per_minute=getattr(args, "tokens_per_minute", None),
+        max_concurrent_requests=getattr(args, "max_concurrent_requests_per_provider", None),
+    )
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an error is transient, so the request which raised it is worth retrying"""
+    if isinstance(error, TimeoutError | ConnectionError):
+        return True
+    if getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES:
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def get_retry_after(error: BaseException) -> float | None:
+    """Seconds to wait before retrying, from the Retry-After header of a provider's error response (if any)"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    try:
+        return float(headers["retry-after"]) if headers and "retry-after" in headers else None
+    except ValueError:
+        return None
+
+
+@dataclass
+class ResilienceStats:
+    """Outcomes of the resilience policy of all model requests and turns in the process"""
+
+    retries: int = 0
+    timeouts: int = 0
+    # Requests which failed fast since their provider's circuit was open
+    circuit_rejections: int = 0
+    # Seconds spent waiting for provider rate limits
+    rate_limit_wait: float = 0
+    turn_retries: int = 0
+    turn_timeouts: int = 0
+    sessions_queued: int = 0
+    sessions_shed: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"retries={self.retries} timeouts={self.timeouts} circuit_rejections={self.circuit_rejections} "
+            f"rate_limit_wait={self.rate_limit_wait:.2f}s turn_retries={self.turn_retries} "
+            f"turn_timeouts={self.turn_timeouts} sessions_queued={self.sessions_queued} "
+            f"sessions_shed={self.sessions_shed}"
+        )
+
+
+@cache
+def get_resilience_stats() -> ResilienceStats:
+    return ResilienceStats()
+
+
+class CircuitBreaker:
+    """
+    Fails requests fast once `failures` consecutive requests have failed, until `reset` seconds have passed.
+    A single trial request is then let through, which closes the circuit if it succeeds or re-opens it if it fails.
+    """
+
+    def __init__(self, name: str, failures: int, reset: float):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self.trial_in_progress = False
+        # Requests are made from the event loop and from threads (for sync runs)
+        self._lock = threading.Lock()
+
+    def before_request(self) -> bool:
+        """Check that a request can be made, returning whether it is the trial request of the open circuit"""
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.opened_at + self.reset - time.monotonic()
+            if self.trial_in_progress or remaining > 0:
+                get_resilience_stats().circuit_rejections += 1
+                raise CircuitOpenError(f"Requests to {self.name} are failing, trying again in {max(remaining, 0):.1f}s")
+            self.trial_in_progress = True
+            return True
+
+    def end_trial(self) -> None:
+        """
+        End the trial request once it has finished. If its outcome wasn't recorded (e.g. it failed with an error which
+        isn't transient, or was cancelled), the trial failed and the circuit is opened again.
+        """
+        with self._lock:
+            if self.trial_in_progress:
+                self.trial_in_progress = False
+                self.opened_at = time.monotonic()
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            self.trial_in_progress = False
+            if self.consecutive_failures >= self.failures:
+                if self.opened_at is None:
+                    logger.warning("Opening circuit of %s after %d failures", self.name, self.consecutive_failures)
+                self.opened_at = time.monotonic()
+
+
+class ProviderGuard:
+    """
+    Circuit breaker, rate limiter and concurrency limiter of a provider API key, shared by all requests with it in the
+    process
+    """
+
+    def __init__(self, name: str, config: ResilienceConfig):
+        self.circuit_breaker = CircuitBreaker(name, config.circuit_failures, config.circuit_reset)
+        self.rate_limiter = (
+            RateLimiter(config.requests_per_minute, config.tokens_per_minute)
+            if config.requests_per_minute or config.tokens_per_minute
+            else None
+        )
+        self.concurrency_limiter = (
+            ConcurrencyLimiter(config.max_concurrent_requests) if config.max_concurrent_requests else None
+        )
+        # Moving average of the tokens used per request, which are acquired from the rate limiter up front
+        self.estimated_tokens = 0.0
+
+    def record_usage(self, usage: TurnUsage) -> None:
+        tokens = usage.input_tokens + usage.output_tokens
+        if self.rate_limiter is not None:
+            self.rate_limiter.adjust(requests=0, tokens=tokens)
+        self.estimated_tokens += (tokens - self.estimated_tokens) * 0.1
+
+
+@cache
+def get_provider_guard(provider: str, api_key: str | None, config: ResilienceConfig) -> ProviderGuard:
+    """Get the guard which is shared by all models in the process using the same provider and API key"""
+    return ProviderGuard(provider, config)
+
+
+class ResilientCaller:
+    """
+    Makes the requests of a model with a deadline, and retries those which fail with a transient error.
+    Requests are subject to the circuit breaker, rate limits and concurrency limit of the model's provider API key.
+    Since a failed request has no effect, model requests can always be retried (unlike turns).
+    """
+
+    def __init__(self, model_name: str, api_key: str | None, config: ResilienceConfig):
+        self.model_name = model_name
+        self.config = config
+        self.guard = get_provider_guard(model_name.split(":", 1)[0], api_key, config)
+        self.stats = get_resilience_stats()
+
+    def record_usage(self, usage: TurnUsage) -> None:
+        """Settle the token usage of a streamed request once the stream has ended"""
+        self.guard.record_usage(usage)
+
+    def _before_request(self) -> tuple[bool, float]:
+        """
+        Check the circuit breaker, returning whether the request is its trial request and the tokens to acquire from the
+        rate limiter
+        """
+        return self.guard.circuit_breaker.before_request(), self.guard.estimated_tokens
+
+    @asynccontextmanager
+    async def _request_slot(self) -> AsyncIterator[None]:
+        """Hold one of the provider's slots for requests in flight (if they are limited) while making a request"""
+        if (limiter := self.guard.concurrency_limiter) is None:
+            yield
+            return
+        await limiter.acquire()
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    @contextmanager
+    def _request_slot_sync(self) -> Iterator[None]:
+        if (limiter := self.guard.concurrency_limiter) is None:
+            yield
+            return
+        limiter.acquire_sync()
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    def _after_success(self, reserved_tokens: float, usage: TurnUsage | None) -> None:
+        self.guard.circuit_breaker.record_success()
+        if self.guard.rate_limiter is not None:
+            # Return the reserved tokens, the actual usage is consumed instead
+            self.guard.rate_limiter.adjust(requests=0, tokens=-reserved_tokens)
+        if usage is not None:
+            self.guard.record_usage(usage)
+
+    def _should_retry(self, error: Exception, attempt: int, reserved_tokens: float) -> bool:
+        if self.guard.rate_limiter is not None:
+            self.guard.rate_limiter.adjust(requests=0, tokens=-reserved_tokens)
+        if isinstance(error, TimeoutError):
+            self.stats.timeouts += 1
+        if not is_retryable(error):
+            return False
+        self.guard.circuit_breaker.record_failure()
+        if attempt >= self.config.max_retries:
+            return False
+        self.stats.retries += 1
+        logger.info("Retrying request to %s after %r (retry %d)", self.model_name, error, attempt + 1)
+        return True
+
+    async def call(self, request: Callable[[], Awaitable[T]], get_usage: Callable[[T], TurnUsage] | None = None) -> T:
+        """Make a request, with `get_usage` getting its token usage for the rate limiter if it is known by then"""
+        for attempt in itertools.count():
+            trial, reserved_tokens = self._before_request()
+            try:
+                if self.guard.rate_limiter is not None:
+                    start = time.perf_counter()
+                    await self.guard.rate_limiter.acquire(requests=1, tokens=reserved_tokens)
+                    self.stats.rate_limit_wait += time.perf_counter() - start
+                async with self._request_slot(), asyncio.timeout(self.config.call_timeout):
+                    result = await request()
+            except Exception as e:
+                if not self._should_retry(e, attempt, reserved_tokens):
+                    raise
+                backoff = self.config.get_backoff(attempt, e)
+            else:
+                self._after_success(reserved_tokens, get_usage(result) if get_usage is not None else None)
+                return result
+            finally:
+                if trial:
+                    self.guard.circuit_breaker.end_trial()
+            await asyncio.sleep(backoff)
+        raise AssertionError("unreachable")
+
+    def call_sync(self, request: Callable[[], T], get_usage: Callable[[T], TurnUsage] | None = None) -> T:
+        """
+        Make a request from a sync run. Its deadline is enforced by the timeout of the model client's HTTP client,
+        which is set to the request deadline by build_http_pool_config()
+        """
+        for attempt in itertools.count():
+            trial, reserved_tokens = self._before_request()
+            try:
+                if self.guard.rate_limiter is not None:
+                    start = time.perf_counter()
+                    self.guard.rate_limiter.acquire_sync(requests=1, tokens=reserved_tokens)
+                    self.stats.rate_limit_wait += time.perf_counter() - start
+                with self._request_slot_sync():
+                    result = request()
+            except Exception as e:
+                if not self._should_retry(e, attempt, reserved_tokens):
+                    raise
+                backoff = self.config.get_backoff(attempt, e)
+            else:
+                self._after_success(reserved_tokens, get_usage(result) if get_usage is not None else None)
+                return result
+            finally:
+                if trial:
+                    self.guard.circuit_breaker.end_trial()
+            time.sleep(backoff)
+        raise AssertionError("unreachable")
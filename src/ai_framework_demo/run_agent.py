@@ -1,12 +1,33 @@
 import argparse
+import asyncio
+import itertools
+import logging
+import time
 from abc import ABC, abstractmethod
+from collections.abc import Awaitable, Callable
+from datetime import UTC, datetime
 
 from rich.console import Console
 from rich.live import Live
 from rich.prompt import Prompt
 
-from ai_framework_demo.llm import LLMResponse
-from ai_framework_demo.services import MenuService, OrderService
+from ai_framework_demo.cache import build_response_cache
+from ai_framework_demo.events import get_order_event_bus, serve_order_events
+from ai_framework_demo.http_clients import build_http_pool_config, warm_up_connections
+from ai_framework_demo.llm import LLMResponse, PrefetchedToolCall
+from ai_framework_demo.resilience import (
+    ResilienceConfig,
+    ResilienceStats,
+    build_resilience_config,
+    get_resilience_stats,
+    is_retryable,
+)
+from ai_framework_demo.services import MenuService, OrderService, build_order_service
+from ai_framework_demo.tenants import build_tenant_menu_service
+from ai_framework_demo.tracing import Tracer, TurnTrace, build_profile_table, build_tracer
+from ai_framework_demo.usage import TurnUsage
+
+logger = logging.getLogger(__name__)
 
 
 class AgentRunner(ABC):
@@ -15,33 +36,352 @@ class AgentRunner(ABC):
     requests to an agent.
     """
 
+    # Token usage of each conversation turn
+    turn_usage: list[TurnUsage]
+
     @abstractmethod
     def __init__(self, menu_service: MenuService, order_service: OrderService, args: argparse.Namespace): ...
 
     @abstractmethod
     def make_request(self, user_message: str) -> LLMResponse: ...
 
+    @abstractmethod
+    async def make_request_async(self, user_message: str) -> LLMResponse: ...
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        """
+        Make a request to the agent, calling `on_message` with the response message content generated so far
+        as it is streamed. The complete response (including `end_conversation`) is returned at the end.
+        Runners which don't support streaming just call `on_message` once with the complete message.
+        """
+        response = await self.make_request_async(user_message)
+        on_message(response.message)
+        return response
+
+    @abstractmethod
+    def record_turn(self, user_message: str, response: LLMResponse) -> None:
+        """Add a turn which was answered without the agent (e.g. by the intent router) to the conversation history"""
+
+    @abstractmethod
+    def add_tool_results(self, tool_calls: list[PrefetchedToolCall]) -> None:
+        """
+        Add tool calls which were made ahead of the model (e.g. speculatively) and their results to the conversation
+        history, so the model can use them in the next turn without calling the tools itself
+        """
+
+    def discard_failed_turn(self, user_message: str) -> None:
+        """
+        Remove any part of a turn which failed from the conversation history, so it can be retried
+        (runners which only update the history when a turn succeeds have nothing to remove)
+        """
+        return None
+
+    @abstractmethod
+    def dump_history(self) -> tuple[bool, bytes]:
+        """
+        Serialise the messages added to the conversation history since it was last dumped or loaded, for appending to
+        a snapshot of the session. If the history has been rewritten since (e.g. compacted), all of it is serialised
+        and True is returned.
+        """
+
+    @abstractmethod
+    def load_history(self, chunks: list[bytes]) -> None:
+        """Replace the conversation history with the messages serialised by `dump_history()`"""
+
+    def close(self) -> None:
+        """Release any resources held for the conversation, when it has ended"""
+        return None
+
+
+class AgentRunnerWrapper(AgentRunner):
+    """
+    Base class of runners which wrap another agent runner to add to its turns,
+    delegating everything they don't override to the wrapped runner
+    """
+
+    def __init__(self, runner: AgentRunner):
+        self.runner = runner
+
+    @property
+    def turn_usage(self) -> list[TurnUsage]:  # type: ignore[override]
+        return self.runner.turn_usage
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        return self.runner.make_request(user_message)
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        return await self.runner.make_request_async(user_message)
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        return await self.runner.stream_request(user_message, on_message)
+
+    def record_turn(self, user_message: str, response: LLMResponse) -> None:
+        self.runner.record_turn(user_message, response)
+
+    def add_tool_results(self, tool_calls: list[PrefetchedToolCall]) -> None:
+        self.runner.add_tool_results(tool_calls)
+
+    def discard_failed_turn(self, user_message: str) -> None:
+        self.runner.discard_failed_turn(user_message)
+
+    def dump_history(self) -> tuple[bool, bytes]:
+        return self.runner.dump_history()
+
+    def load_history(self, chunks: list[bytes]) -> None:
+        self.runner.load_history(chunks)
+
+    def close(self) -> None:
+        self.runner.close()
+
+
+class TracedAgentRunner(AgentRunnerWrapper):
+    """
+    Wraps an agent runner to record a trace of each turn, with spans recorded by the framework-specific
+    instrumentation of the wrapped runner (model requests, tool calls etc.) while the turn is being traced
+    """
+
+    def __init__(self, runner: AgentRunner, tracer: Tracer, conversation: str):
+        super().__init__(runner)
+        self.tracer = tracer
+        self.conversation = conversation
+        self.traces: list[TurnTrace] = []
+
+    def _record_usage(self, trace: TurnTrace, turns_before: int) -> None:
+        if len(self.runner.turn_usage) > turns_before:
+            trace.usage = self.runner.turn_usage[-1]
+        self.traces.append(trace)
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        turns_before = len(self.runner.turn_usage)
+        with self.tracer.trace_turn(self.conversation, len(self.traces) + 1, user_message) as trace:
+            try:
+                return self.runner.make_request(user_message)
+            finally:
+                self._record_usage(trace, turns_before)
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        turns_before = len(self.runner.turn_usage)
+        with self.tracer.trace_turn(self.conversation, len(self.traces) + 1, user_message) as trace:
+            try:
+                return await self.runner.make_request_async(user_message)
+            finally:
+                self._record_usage(trace, turns_before)
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        turns_before = len(self.runner.turn_usage)
+        with self.tracer.trace_turn(self.conversation, len(self.traces) + 1, user_message) as trace:
+            try:
+                return await self.runner.stream_request(user_message, on_message)
+            finally:
+                self._record_usage(trace, turns_before)
+
+
+class ResilientAgentRunner(AgentRunnerWrapper):
+    """
+    Wraps an agent runner to give each turn a deadline, and to retry turns which failed with a transient error
+    once the retries of their model requests have been exhausted. Creating an order is the only side effect of a turn,
+    so a failed turn is only retried if it didn't create an order for the table.
+    """
+
+    def __init__(self, runner: AgentRunner, order_service: OrderService, table_number: int, config: ResilienceConfig):
+        super().__init__(runner)
+        self.order_service = order_service
+        self.table_number = table_number
+        self.config = config
+        self.stats = get_resilience_stats()
+
+    def _count_orders(self) -> int:
+        return len(self.order_service.get_orders(table_number=self.table_number))
+
+    def _handle_failure(self, user_message: str, orders_before: int) -> bool:
+        """Discard a failed turn from the history if it had no side effect, returning whether it was discarded"""
+        if self._count_orders() != orders_before:
+            return False
+        self.runner.discard_failed_turn(user_message)
+        return True
+
+    def _should_retry(self, user_message: str, error: Exception, attempt: int, orders_before: int) -> bool:
+        if not self._handle_failure(user_message, orders_before):
+            return False
+        if not is_retryable(error) or attempt >= self.config.turn_retries:
+            return False
+        self.stats.turn_retries += 1
+        logger.info("Retrying turn of table %d after %r", self.table_number, error)
+        return True
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        # Sync turns can't be interrupted, so are only bounded by the deadlines of their model requests
+        orders_before = self._count_orders()
+        for attempt in itertools.count():
+            try:
+                return self.runner.make_request(user_message)
+            except Exception as e:
+                if not self._should_retry(user_message, e, attempt, orders_before):
+                    raise
+                time.sleep(self.config.get_backoff(attempt, e))
+        raise AssertionError("unreachable")
+
+    async def _run_turn(self, user_message: str, request: Callable[[], Awaitable[LLMResponse]]) -> LLMResponse:
+        orders_before = self._count_orders()
+        deadline = asyncio.timeout(self.config.turn_timeout)
+        try:
+            async with deadline:
+                for attempt in itertools.count():
+                    try:
+                        return await request()
+                    except Exception as e:
+                        if not self._should_retry(user_message, e, attempt, orders_before):
+                            raise
+                        await asyncio.sleep(self.config.get_backoff(attempt, e))
+        except TimeoutError:
+            if deadline.expired():
+                self.stats.turn_timeouts += 1
+                self._handle_failure(user_message, orders_before)
+            raise
+        raise AssertionError("unreachable")
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        return await self._run_turn(user_message, lambda: self.runner.make_request_async(user_message))
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        return await self._run_turn(user_message, lambda: self.runner.stream_request(user_message, on_message))
+
+
+def build_agent_runner(
+    runner_class: type[AgentRunner],
+    menu_service: MenuService,
+    order_service: OrderService,
+    args: argparse.Namespace,
+    conversation: str | None = None,
+) -> AgentRunner:
+    """
+    Construct an agent runner, wrapped with the turn resilience policy, and session snapshots, the menu for model
+    routing, speculative tool calls, usage budgets, the intent router and tracing if they are enabled by the arguments
+    """
+    runner_menu_service = menu_service
+    if speculate := getattr(args, "speculate", False):
+        # Imported here since it depends on this module
+        from ai_framework_demo.speculation import RecordingMenuService, SpeculativeAgentRunner, build_speculation_policy
+
+        # The tool calls made by the model are recorded, to learn which are likely and which were speculated in vain
+        runner_menu_service = RecordingMenuService(menu_service)
+    if getattr(args, "snapshot_dir", None):
+        # Imported here since it depends on this module
+        from ai_framework_demo.snapshots import build_snapshotting_runner
+
+        runner = build_snapshotting_runner(runner_class, runner_menu_service, order_service, args)
+    else:
+        runner = runner_class(runner_menu_service, order_service, args)
+    # Imported here since it depends on this module (through the intent rules)
+    from ai_framework_demo.model_routing import MenuRoutedAgentRunner, build_model_routes
+
+    if build_model_routes(args):
+        runner = MenuRoutedAgentRunner(runner, menu_service)
+    resilience = build_resilience_config(args)
+    if resilience.turn_timeout or resilience.turn_retries:
+        runner = ResilientAgentRunner(runner, order_service, args.table_number, resilience)
+    if speculate:
+        assert isinstance(runner_menu_service, RecordingMenuService)
+        runner = SpeculativeAgentRunner(runner, menu_service, runner_menu_service, build_speculation_policy(args))
+    # Imported here since it depends on this module
+    from ai_framework_demo.budgets import build_budgeted_runner
+
+    runner = build_budgeted_runner(runner, args)
+    if getattr(args, "intent_router", False):
+        # Imported here since it depends on this module
+        from ai_framework_demo.intents import IntentRoutingAgentRunner
+
+        runner = IntentRoutingAgentRunner(runner, menu_service, table_number=args.table_number)
+    if tracer := build_tracer(args):
+        runner = TracedAgentRunner(runner, tracer, conversation=conversation or f"table-{args.table_number}")
+    return runner
+
 
 def run_agent(runner_class: type[AgentRunner], args: argparse.Namespace):
     """Initialise services and run agent conversation loop."""
-    menu_service = MenuService()
-    order_service = OrderService()
+    asyncio.run(run_agent_async(runner_class, args))
+
+
+async def run_agent_async(runner_class: type[AgentRunner], args: argparse.Namespace):
+    args, menu_service = build_tenant_menu_service(args)
+    event_bus = order_events_server = None
+    if order_events_socket := getattr(args, "order_events_socket", None):
+        event_bus = get_order_event_bus()
+        order_events_server = await serve_order_events(event_bus, order_events_socket)
+    order_service = build_order_service(getattr(args, "orders_db", None), event_bus)
+    conversation_start = datetime.now(UTC)
 
-    agent_runner = runner_class(menu_service, order_service, args)
+    agent_runner = build_agent_runner(runner_class, menu_service, order_service, args)
     user_message = "*Greet the customer*"
     console = Console()
+    if agent_runner.turn_usage:
+        # The conversation was restored from a snapshot, so continues with the customer's next message
+        console.print(f"[dim]Resumed the conversation of table {args.table_number}[/dim]")
+        user_message = await asyncio.to_thread(Prompt.ask, "You")
+    if getattr(args, "warm_up", False) and not await warm_up_connections(args.model, build_http_pool_config(args)):
+        console.print(f"[dim]Could not warm up connections for {args.model}[/dim]")
     while True:
         with Live(console=console) as live_console:
             live_console.update("AI Waiter: ...")
-            response = agent_runner.make_request(user_message)
+            response = await agent_runner.stream_request(
+                user_message, on_message=lambda message: live_console.update(f"AI Waiter: {message or '...'}")
+            )
             live_console.update(f"AI Waiter: {response.message}")
 
+        if getattr(args, "debug", False) and agent_runner.turn_usage:
+            console.print(f"[dim]Usage: {agent_runner.turn_usage[-1]}[/dim]")
+
         # Exit if LLM indicates conversation is over
         if response.end_conversation:
             break
 
-        user_message = Prompt.ask("You")
+        # Prompt in a thread so the event loop (and any HTTP clients bound to it) are not blocked
+        user_message = await asyncio.to_thread(Prompt.ask, "You")
+
+    agent_runner.close()
+    if order_events_server is not None:
+        order_events_server.close()
+    print_conversation_stats(console, agent_runner, args)
 
     # Show orders
-    if orders := order_service.get_orders():
+    if orders := order_service.get_orders(table_number=args.table_number, since=conversation_start):
         console.print(f"Order placed: {orders}")
+    await order_service.aclose()
+
+
+def print_conversation_stats(console: Console, agent_runner: AgentRunner, args: argparse.Namespace) -> None:
+    """Print the statistics of the optimisations enabled by the arguments, at the end of the conversation"""
+    if isinstance(agent_runner, TracedAgentRunner):
+        if getattr(args, "profile", False):
+            console.print(build_profile_table(agent_runner.traces, title=f"Turn profile ({args.model})"))
+        agent_runner.tracer.shutdown()
+
+    if response_cache := build_response_cache(args):
+        console.print(f"[dim]Response cache: {response_cache.stats}[/dim]")
+
+    # Imported here since it depends on this module (through the intent rules)
+    from ai_framework_demo.model_routing import build_model_routes, build_model_routing_table, get_model_router
+
+    if model_routes := build_model_routes(args):
+        model_router = get_model_router(model_routes)
+        console.print(build_model_routing_table(model_router))
+        console.print(f"[dim]Model routing: {model_router.metrics}[/dim]")
+
+    if (resilience_stats := get_resilience_stats()) != ResilienceStats():
+        console.print(f"[dim]Resilience: {resilience_stats}[/dim]")
+
+    if getattr(args, "speculate", False):
+        from ai_framework_demo.speculation import get_speculation_stats
+
+        console.print(f"[dim]Speculative tool calls: {get_speculation_stats()}[/dim]")
+
+    from ai_framework_demo.budgets import build_usage_table, get_budget_stats, get_usage_accountant
+
+    if (usage_accountant := get_usage_accountant()).conversations:
+        console.print(build_usage_table(usage_accountant))
+        console.print(f"[dim]Turns degraded by budgets: {get_budget_stats()}[/dim]")
+
+    if getattr(args, "intent_router", False):
+        from ai_framework_demo.intents import get_intent_router_stats
+
+        console.print(f"[dim]Intent router: {get_intent_router_stats()}[/dim]")
@@ -0,0 +1,278 @@
+import json
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from ai_framework_demo.llm import LLMResponse
+
+# Name of the tool call used in scripts for the structured response to the user,
+# which each framework maps to its own structured response mechanism
+RESPOND_TOOL_NAME = "respond_to_user"
+
+
+@dataclass
+class ScriptedToolCall:
+    name: str
+    args: dict[str, Any]
+
+
+@dataclass
+class ScriptedTurn:
+    """A user message, and the tool calls made by the model in each step of responding to it"""
+
+    user_message: str
+    steps: list[list[ScriptedToolCall]]
+
+
+@dataclass
+class ScriptedConversation:
+    """
+    Recorded conversation which is replayed by deterministic stand-in models, so agents can be run without an
+    LLM provider (e.g. for benchmarking).
+
+    Scripted models are stateless: the step of the script to respond with is determined from the conversation history
+    (the latest user message, and the number of model responses since), so a single model instance can be shared by
+    any number of concurrent conversations. User messages must therefore be unique within a conversation.
+    """
+
+    name: str
+    turns: list[ScriptedTurn]
+    _turns_by_user_message: dict[str, ScriptedTurn] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._turns_by_user_message = {turn.user_message: turn for turn in self.turns}
+
+    @property
+    def user_messages(self) -> list[str]:
+        """User messages after the first (greeting) turn, as provided by a guest"""
+        return [turn.user_message for turn in self.turns[1:]]
+
+    def get_step(
+        self, user_message: str, step: int, prefetched: Sequence[ScriptedToolCall] = ()
+    ) -> list[ScriptedToolCall]:
+        """
+        Get the tool calls for a step of the response to a user message.
+        Leading steps whose tool calls were all `prefetched` (made ahead of the model, with their results added to its
+        context before the user message) are skipped, like a model which uses the results instead of calling again.
+        """
+        try:
+            turn = self._turns_by_user_message[user_message]
+        except KeyError:
+            raise ValueError(f"User message not in scripted conversation {self.name!r}: {user_message!r}") from None
+        skipped = 0
+        while skipped < len(turn.steps) - 1 and all(tool_call in prefetched for tool_call in turn.steps[skipped]):
+            skipped += 1
+        step += skipped
+        if step >= len(turn.steps):
+            raise ValueError(f"Scripted conversation {self.name!r} has no step {step} for message {user_message!r}")
+        return turn.steps[step]
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "ScriptedConversation":
+        return cls(
+            name=data["name"],
+            turns=[
+                ScriptedTurn(
+                    user_message=turn["user_message"],
+                    steps=[[ScriptedToolCall(**tool_call) for tool_call in step] for step in turn["steps"]],
+                )
+                for turn in data["turns"]
+            ],
+        )
+
+
+def respond(message: str, end_conversation: bool = False) -> list[ScriptedToolCall]:
+    """Step in which the model responds to the user"""
+    args = LLMResponse(message=message, end_conversation=end_conversation).model_dump()
+    return [ScriptedToolCall(name=RESPOND_TOOL_NAME, args=args)]
+
+
+GREETING_MESSAGE = "*Greet the customer*"
+
+SCRIPTED_CONVERSATIONS: dict[str, ScriptedConversation] = {
+    conversation.name: conversation
+    for conversation in [
+        ScriptedConversation(
+            name="yellow_food",
+            turns=[
+                ScriptedTurn(
+                    GREETING_MESSAGE,
+                    [respond("Bonjour! Welcome to Le Bistro! Do you have any dietary restrictions?")],
+                ),
+                ScriptedTurn(
+                    "I only eat yellow coloured food",
+                    [
+                        [ScriptedToolCall("get_menu", {})],
+                        respond(
+                            "Magnifique! We have the Quinoa Stuffed Bell Peppers, the Chickpea and Sweet Potato Curry "
+                            "and the Fresh Fruit Sorbet. What do you think?"
+                        ),
+                    ],
+                ),
+                ScriptedTurn(
+                    "I'll take the Bell Peppers and fruit sorbet thanks",
+                    [
+                        [
+                            ScriptedToolCall(
+                                "create_order",
+                                {
+                                    "table_number": 1,
+                                    "order_items": ["Quinoa Stuffed Bell Peppers", "Fresh Fruit Sorbet"],
+                                },
+                            )
+                        ],
+                        respond("Excellent choices! Your order has been placed. Au revoir!", end_conversation=True),
+                    ],
+                ),
+            ],
+        ),
+        ScriptedConversation(
+            name="vegan_dessert",
+            turns=[
+                ScriptedTurn(
+                    GREETING_MESSAGE,
+                    [respond("Good evening! Any dietary requirements I should know about?")],
+                ),
+                ScriptedTurn(
+                    "I'm vegan, and I just want dessert",
+                    [
+                        [ScriptedToolCall("search_menu", {"dietary_tags": ["VG"], "category": "Desserts"})],
+                        respond("For vegan desserts we have the Vegan Apple Crumble and the Fresh Fruit Sorbet."),
+                    ],
+                ),
+                ScriptedTurn(
+                    "What else is on the menu?",
+                    [
+                        [ScriptedToolCall("get_menu", {})],
+                        respond("Our vegan mains include the Chickpea and Sweet Potato Curry. Anything else?"),
+                    ],
+                ),
+                ScriptedTurn(
+                    "Just the apple crumble please",
+                    [
+                        [ScriptedToolCall("create_order", {"table_number": 1, "order_items": ["Vegan Apple Crumble"]})],
+                        respond("One Vegan Apple Crumble coming right up. Enjoy!", end_conversation=True),
+                    ],
+                ),
+            ],
+        ),
+        ScriptedConversation(
+            name="gluten_free_parallel",
+            turns=[
+                ScriptedTurn(
+                    GREETING_MESSAGE,
+                    [respond("Welcome to Le Bistro! Do you have any dietary requirements?")],
+                ),
+                ScriptedTurn(
+                    "I'm gluten free, which mains and desserts can I have?",
+                    [
+                        [
+                            ScriptedToolCall(
+                                "search_menu", {"dietary_tags": ["GF"], "category": "Main Courses", "text": None}
+                            ),
+                            ScriptedToolCall(
+                                "search_menu", {"dietary_tags": ["GF"], "category": "Desserts", "text": None}
+                            ),
+                        ],
+                        respond(
+                            "For mains we have the Grilled Salmon and the Chickpea and Sweet Potato Curry among "
+                            "others, and for dessert the Crème Brûlée or the Fresh Fruit Sorbet."
+                        ),
+                    ],
+                ),
+                ScriptedTurn(
+                    "The salmon and the creme brulee please",
+                    [
+                        # The order is created and the response given in the same step
+                        [
+                            ScriptedToolCall(
+                                "create_order",
+                                {
+                                    "table_number": 1,
+                                    "order_items": ["Grilled Salmon with Herb Butter", "Crème Brûlée"],
+                                },
+                            ),
+                            *respond("Wonderful, your order has been placed. Bon appétit!", end_conversation=True),
+                        ],
+                    ],
+                ),
+            ],
+        ),
+        ScriptedConversation(
+            name="menu_confirm",
+            turns=[
+                ScriptedTurn(
+                    GREETING_MESSAGE,
+                    [respond("Good evening and welcome to Le Bistro! Any dietary requirements tonight?")],
+                ),
+                ScriptedTurn(
+                    "No, can I see the menu?",
+                    [
+                        [ScriptedToolCall("get_menu", {})],
+                        respond(
+                            "Of course! Tonight we have appetizers, main courses and desserts. What takes your fancy?"
+                        ),
+                    ],
+                ),
+                ScriptedTurn(
+                    "I'd like the duck breast and the tiramisu",
+                    [
+                        respond(
+                            "Lovely choices: the Pan-Seared Duck Breast and the Classic Tiramisu. "
+                            "Shall I confirm your order?"
+                        )
+                    ],
+                ),
+                ScriptedTurn(
+                    "Yes please",
+                    [
+                        [
+                            ScriptedToolCall(
+                                "create_order",
+                                {"table_number": 1, "order_items": ["Pan-Seared Duck Breast", "Classic Tiramisu"]},
+                            )
+                        ],
+                        respond("Your order has been placed. Bon appétit!", end_conversation=True),
+                    ],
+                ),
+            ],
+        ),
+        # Every turn is answered directly, which takes a single request in both structured output modes, so the modes
+        # only differ in the overhead of the forced respond_to_user tool call
+        ScriptedConversation(
+            name="direct_answers",
+            turns=[
+                ScriptedTurn(GREETING_MESSAGE, [respond("Good evening and welcome to Le Bistro! How can I help?")]),
+                ScriptedTurn(
+                    "Are you open on Sundays?", [respond("We are, from noon until ten in the evening. Anything else?")]
+                ),
+                ScriptedTurn("Do you take card payments?", [respond("We do, all major cards are accepted.")]),
+                ScriptedTurn(
+                    "Great, see you on Sunday then",
+                    [respond("Wonderful, we look forward to seeing you. Au revoir!", end_conversation=True)],
+                ),
+            ],
+        ),
+    ]
+}
+
+
+def load_scripted_conversations(path: Path) -> None:
+    """Load additional scripted conversations from a JSON file containing a list of conversations"""
+    for data in json.loads(path.read_text()):
+        conversation = ScriptedConversation.from_dict(data)
+        SCRIPTED_CONVERSATIONS[conversation.name] = conversation
+
+
+def parse_scripted_model_name(model_name: str) -> tuple[ScriptedConversation, float]:
+    """
+    Parse the name of a scripted model, in format `<conversation name>[@<latency ms>]`
+    (after the `scripted:` provider prefix), returning the conversation and the latency to inject into each request
+    """
+    conversation_name, _, latency_ms = model_name.partition("@")
+    try:
+        conversation = SCRIPTED_CONVERSATIONS[conversation_name]
+    except KeyError:
+        raise ValueError(f"Unknown scripted conversation: {conversation_name}") from None
+    return conversation, float(latency_ms or 0) / 1000
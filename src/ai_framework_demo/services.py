@@ -1,4 +1,57 @@
-from dataclasses import dataclass
+import asyncio
+import bisect
+import functools
+import json
+import re
+import sqlite3
+import threading
+from collections.abc import Iterable, Mapping
+from dataclasses import asdict, dataclass, field
+from datetime import UTC, datetime
+from functools import cached_property
+from pathlib import Path
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, Literal
+
+if TYPE_CHECKING:
+    from ai_framework_demo.events import OrderEventBus
+
+DietaryTag = Literal["V", "VG", "GF"]
+DIETARY_TAG_DESCRIPTIONS: dict[DietaryTag, str] = {"V": "vegetarian", "VG": "vegan", "GF": "gluten-free"}
+# Tags which are implied by other tags, e.g. vegan items are also vegetarian
+IMPLIED_DIETARY_TAGS: dict[str, set[str]] = {"VG": {"V"}}
+
+# Matches the dietary tags at the end of a menu item, e.g. "Wild Mushroom Risotto (V option, GF)"
+MENU_ITEM_TAGS_PATTERN = re.compile(r"^(?P<name>.*?)\s*\((?P<tags>[^()]*)\)\s*$")
+# Words of menu item names which are too generic to identify an item
+GENERIC_ITEM_NAME_WORDS = frozenset({"with", "fresh", "style", "classic", "vegan", "gluten", "free"})
+
+DEFAULT_MENU: dict[str, list[str]] = {
+    "Appetizers": [
+        "Bruschetta with Fresh Tomatoes and Basil (V)",
+        "Crispy Calamari with Lemon Aioli",
+        "French Onion Soup (GF option)",
+        "Quinoa Stuffed Bell Peppers (VG, GF)",
+        "Beef Carpaccio with Arugula (GF)",
+    ],
+    "Main Courses": [
+        "Grilled Salmon with Herb Butter (GF)",
+        "Filet Mignon with Red Wine Reduction (GF)",
+        "Wild Mushroom Risotto (V option, GF)",
+        "Pan-Seared Duck Breast",
+        "Chickpea and Sweet Potato Curry (VG, GF)",
+        "Gluten-Free Pasta with Roasted Vegetables (VG, GF)",
+        "Beyond Meat Burger with Avocado (VG)",
+    ],
+    "Desserts": [
+        "Crème Brûlée (V, GF)",
+        "Dark Chocolate Mousse (V option)",
+        "New York Style Cheesecake",
+        "Vegan Apple Crumble (VG)",
+        "Fresh Fruit Sorbet (VG, GF)",
+        "Classic Tiramisu",
+    ],
+}
 
 
 @dataclass
@@ -7,46 +60,431 @@ class Order:
 
     menu_items: list[str]
     table_number: int
+    created_at: datetime = field(default_factory=lambda: datetime.now(UTC))
+    # Key which identifies the request that created the order, so that retried requests don't create duplicates
+    idempotency_key: str | None = field(default=None, repr=False)
+
+
+def dump_order(order: Order) -> dict[str, Any]:
+    return asdict(order) | {"created_at": order.created_at.isoformat()}
+
+
+def load_order(data: dict[str, Any]) -> Order:
+    return Order(**data | {"created_at": datetime.fromisoformat(data["created_at"])})
+
+
+@dataclass(frozen=True)
+class MenuItem:
+    """Menu item parsed from its description, e.g. 'Wild Mushroom Risotto (V option, GF)'"""
+
+    description: str
+    name: str
+    category: str
+    # Dietary tags which the item satisfies as-is
+    tags: frozenset[str] = frozenset()
+    # Dietary tags which the item can be prepared to satisfy on request
+    option_tags: frozenset[str] = frozenset()
+
+    @classmethod
+    def parse(cls, description: str, category: str) -> "MenuItem":
+        match = MENU_ITEM_TAGS_PATTERN.match(description)
+        if match is None:
+            return cls(description=description, name=description, category=category)
+        tags: set[str] = set()
+        option_tags: set[str] = set()
+        for tag in match["tags"].split(","):
+            tag, _, option = tag.strip().partition(" ")
+            target = option_tags if option == "option" else tags
+            target.add(tag)
+            target.update(IMPLIED_DIETARY_TAGS.get(tag, ()))
+        return cls(
+            description=description,
+            name=match["name"],
+            category=category,
+            tags=frozenset(tags),
+            option_tags=frozenset(option_tags - tags),
+        )
+
+
+@dataclass(frozen=True)
+class MenuIndex:
+    """Immutable index of menu items by category and dietary tag"""
+
+    # Read-only copy of the menu the index was built from
+    menu: Mapping[str, tuple[str, ...]]
+    items: tuple[MenuItem, ...]
+    by_category: Mapping[str, tuple[MenuItem, ...]]
+    by_tag: Mapping[str, frozenset[MenuItem]]
+    # Items which satisfy each tag either as-is or as an option
+    by_tag_or_option: Mapping[str, frozenset[MenuItem]]
+
+    @classmethod
+    def build(cls, menu: dict[str, list[str]]) -> "MenuIndex":
+        items = tuple(
+            MenuItem.parse(description, category)
+            for category, descriptions in menu.items()
+            for description in descriptions
+        )
+        by_tag: dict[str, set[MenuItem]] = {}
+        by_tag_or_option: dict[str, set[MenuItem]] = {}
+        for item in items:
+            for tag in item.tags:
+                by_tag.setdefault(tag, set()).add(item)
+            for tag in item.tags | item.option_tags:
+                by_tag_or_option.setdefault(tag, set()).add(item)
+        return cls(
+            menu=MappingProxyType({category: tuple(descriptions) for category, descriptions in menu.items()}),
+            items=items,
+            by_category={
+                category.lower(): tuple(item for item in items if item.category == category) for category in menu
+            },
+            by_tag={tag: frozenset(tag_items) for tag, tag_items in by_tag.items()},
+            by_tag_or_option={tag: frozenset(tag_items) for tag, tag_items in by_tag_or_option.items()},
+        )
+
+    @cached_property
+    def item_name_words(self) -> frozenset[str]:
+        """Distinctive words (in lowercase) of the item names, which indicate that a message names an item"""
+        words = {word for item in self.items for word in re.findall(r"[a-z0-9]+", item.name.lower())}
+        return frozenset(word for word in words if len(word) > 3 and word not in GENERIC_ITEM_NAME_WORDS)
+
+    def search(
+        self,
+        tags: Iterable[str] = (),
+        category: str | None = None,
+        text: str | None = None,
+        include_options: bool = True,
+    ) -> list[MenuItem]:
+        """Find menu items in the category (if provided) which satisfy all the tags and contain the text"""
+        items: Iterable[MenuItem] = self.by_category.get(category.lower(), ()) if category else self.items
+        tag_index = self.by_tag_or_option if include_options else self.by_tag
+        for tag in tags:
+            tag_items = tag_index.get(tag.upper(), frozenset())
+            items = [item for item in items if item in tag_items]
+        if text:
+            text = text.lower()
+            items = [item for item in items if text in item.name.lower()]
+        return list(items)
 
 
 class MenuService:
-    def get_menu(self) -> dict[str, list[str]]:
-        return {
-            "Appetizers": [
-                "Bruschetta with Fresh Tomatoes and Basil (V)",
-                "Crispy Calamari with Lemon Aioli",
-                "French Onion Soup (GF option)",
-                "Quinoa Stuffed Bell Peppers (VG, GF)",
-                "Beef Carpaccio with Arugula (GF)",
-            ],
-            "Main Courses": [
-                "Grilled Salmon with Herb Butter (GF)",
-                "Filet Mignon with Red Wine Reduction (GF)",
-                "Wild Mushroom Risotto (V option, GF)",
-                "Pan-Seared Duck Breast",
-                "Chickpea and Sweet Potato Curry (VG, GF)",
-                "Gluten-Free Pasta with Roasted Vegetables (VG, GF)",
-                "Beyond Meat Burger with Avocado (VG)",
-            ],
-            "Desserts": [
-                "Crème Brûlée (V, GF)",
-                "Dark Chocolate Mousse (V option)",
-                "New York Style Cheesecake",
-                "Vegan Apple Crumble (VG)",
-                "Fresh Fruit Sorbet (VG, GF)",
-                "Classic Tiramisu",
-            ],
+    """
+    Provides access to the restaurant menu, which is loaded from a JSON file (mapping category to item descriptions)
+    if a path is provided, otherwise the given menu (or the default menu) is used.
+    The menu is parsed and indexed once, and only re-loaded if the file is modified.
+    """
+
+    menu_path: Path | None
+    _menu: dict[str, list[str]]
+    _index: MenuIndex | None
+    _index_mtime_ns: int | None
+
+    def __init__(self, menu_path: Path | None = None, menu: dict[str, list[str]] | None = None):
+        self.menu_path = menu_path
+        # Copied, so the menu can't be changed by modifying the given (or default) menu
+        self._menu = {
+            category: list(descriptions) for category, descriptions in (DEFAULT_MENU if menu is None else menu).items()
         }
+        self._index = None
+        self._index_mtime_ns = None
+
+    def get_index(self) -> MenuIndex:
+        if self.menu_path is None:
+            if self._index is None:
+                self._index = MenuIndex.build(self._menu)
+            return self._index
+
+        mtime_ns = self.menu_path.stat().st_mtime_ns
+        if self._index is None or mtime_ns != self._index_mtime_ns:
+            self._index = MenuIndex.build(json.loads(self.menu_path.read_text()))
+            self._index_mtime_ns = mtime_ns
+        return self._index
+
+    def get_menu(self) -> dict[str, list[str]]:
+        """Get a copy of the menu, which can't modify the index shared by other sessions"""
+        return {category: list(descriptions) for category, descriptions in self.get_index().menu.items()}
+
+    def search_menu(
+        self,
+        tags: Iterable[str] = (),
+        category: str | None = None,
+        text: str | None = None,
+        include_options: bool = True,
+    ) -> dict[str, list[str]]:
+        """Search the menu, returning the descriptions of matching items grouped by category"""
+        results: dict[str, list[str]] = {}
+        for item in self.get_index().search(tags=tags, category=category, text=text, include_options=include_options):
+            results.setdefault(item.category, []).append(item.description)
+        return results
 
 
 class OrderService:
+    """
+    In-memory order storage, indexed by table number and idempotency key.
+    New orders are published to the event bus if one is provided (orders restored from elsewhere are not).
+    """
+
     orders: list[Order]
+    orders_by_table: dict[int, list[Order]]
+    orders_by_idempotency_key: dict[str, Order]
+    event_bus: "OrderEventBus | None"
 
-    def __init__(self):
+    def __init__(self, event_bus: "OrderEventBus | None" = None):
         self.orders = []
+        self.orders_by_table = {}
+        self.orders_by_idempotency_key = {}
+        self.event_bus = event_bus
+
+    def create_order(self, table_number: int, menu_items: list[str], idempotency_key: str | None = None) -> Order:
+        """
+        Create an order for a table. If an order was already created with the same idempotency key,
+        that order is returned instead of creating a duplicate.
+        """
+        if idempotency_key is not None and (order := self.orders_by_idempotency_key.get(idempotency_key)):
+            return order
+        order = Order(table_number=table_number, menu_items=menu_items, idempotency_key=idempotency_key)
+        self.orders.append(order)
+        self.orders_by_table.setdefault(table_number, []).append(order)
+        if idempotency_key is not None:
+            self.orders_by_idempotency_key[idempotency_key] = order
+        if self.event_bus is not None:
+            self.event_bus.publish(order)
+        return order
+
+    async def create_order_async(
+        self, table_number: int, menu_items: list[str], idempotency_key: str | None = None
+    ) -> Order:
+        if self.event_bus is not None:
+            await self.event_bus.wait_for_capacity()
+        return self.create_order(table_number, menu_items, idempotency_key)
+
+    def restore_orders(self, orders: list[Order]) -> list[Order]:
+        """
+        Add orders which were created elsewhere (e.g. restored from a session snapshot), keeping their creation times.
+        Orders which already exist with the same idempotency key are returned instead of being added again.
+        """
+        restored: list[Order] = []
+        for order in orders:
+            key = order.idempotency_key
+            if key is not None and (existing := self.orders_by_idempotency_key.get(key)):
+                restored.append(existing)
+                continue
+            bisect.insort(self.orders, order, key=lambda order: order.created_at)
+            bisect.insort(
+                self.orders_by_table.setdefault(order.table_number, []), order, key=lambda order: order.created_at
+            )
+            if key is not None:
+                self.orders_by_idempotency_key[key] = order
+            restored.append(order)
+        return restored
+
+    def get_orders(self, table_number: int | None = None, since: datetime | None = None) -> list[Order]:
+        """Get orders (optionally only for a table, and/or created since a time), in the order they were created"""
+        orders = self.orders if table_number is None else self.orders_by_table.get(table_number, [])
+        if since is not None:
+            # Orders are appended in creation order, so the ones since a time can be found with a binary search
+            orders = orders[bisect.bisect_left(orders, since, key=lambda order: order.created_at) :]
+        return orders
+
+    async def aclose(self) -> None:
+        """Write any orders which are still pending and release the storage, once no more orders will be created"""
+        return None
+
+
+class SQLiteOrderService(OrderService):
+    """
+    Order storage backed by a SQLite database in WAL mode, so orders persist between processes.
+
+    Orders created with `create_order_async()` are queued and written in batches by a background task,
+    so that many concurrent sessions share a single transaction commit.
+    """
+
+    def __init__(
+        self,
+        db_path: Path | str,
+        batch_interval: float = 0.005,
+        max_batch_size: int = 256,
+        event_bus: "OrderEventBus | None" = None,
+    ):
+        super().__init__(event_bus)
+        self.db_path = db_path
+        self.batch_interval = batch_interval
+        self.max_batch_size = max_batch_size
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._write_queue: asyncio.Queue[tuple[Order, asyncio.Future[Order]]] | None = None
+        self._writer_task: asyncio.Task[None] | None = None
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY,
+                    table_number INTEGER NOT NULL,
+                    menu_items TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    idempotency_key TEXT UNIQUE
+                );
+                CREATE INDEX IF NOT EXISTS orders_table_number_created_at ON orders (table_number, created_at);
+                CREATE INDEX IF NOT EXISTS orders_created_at ON orders (created_at);
+                """
+            )
+
+    def create_order(self, table_number: int, menu_items: list[str], idempotency_key: str | None = None) -> Order:
+        order = Order(table_number=table_number, menu_items=menu_items, idempotency_key=idempotency_key)
+        return self._insert_orders([order])[0]
+
+    async def create_order_async(
+        self, table_number: int, menu_items: list[str], idempotency_key: str | None = None
+    ) -> Order:
+        if self.event_bus is not None:
+            await self.event_bus.wait_for_capacity()
+        if self._write_queue is None or self._writer_task is None or self._writer_task.done():
+            self._write_queue = asyncio.Queue()
+            # Orders taken from the queue by the writer task which it hasn't finished writing
+            writing: list[tuple[Order, asyncio.Future[Order]]] = []
+            self._writer_task = asyncio.create_task(self._write_queued_orders(self._write_queue, writing))
+            self._writer_task.add_done_callback(
+                functools.partial(self._fail_unwritten_orders, self._write_queue, writing)
+            )
+        future = asyncio.get_running_loop().create_future()
+        order = Order(table_number=table_number, menu_items=menu_items, idempotency_key=idempotency_key)
+        self._write_queue.put_nowait((order, future))
+        return await future
+
+    async def _write_queued_orders(
+        self,
+        write_queue: asyncio.Queue[tuple[Order, asyncio.Future[Order]]],
+        writing: list[tuple[Order, asyncio.Future[Order]]],
+    ) -> None:
+        """Background task which writes queued orders to the database in batches"""
+        while True:
+            writing.append(await write_queue.get())
+            # Wait briefly so that orders from other sessions can be committed in the same transaction
+            await asyncio.sleep(self.batch_interval)
+            while len(writing) < self.max_batch_size and not write_queue.empty():
+                writing.append(write_queue.get_nowait())
+            try:
+                orders = await asyncio.to_thread(self._insert_orders, [order for order, _ in writing])
+            except Exception as e:
+                for _, future in writing:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), order in zip(writing, orders, strict=True):
+                    if not future.done():
+                        future.set_result(order)
+            for _ in writing:
+                write_queue.task_done()
+            writing.clear()
+
+    @staticmethod
+    def _fail_unwritten_orders(
+        write_queue: asyncio.Queue[tuple[Order, asyncio.Future[Order]]],
+        writing: list[tuple[Order, asyncio.Future[Order]]],
+        writer_task: asyncio.Task[None],
+    ) -> None:
+        """
+        Fail the orders which the writer task hadn't written when it ended (e.g. cancelled by `close()`), rather than
+        leaving their callers waiting. The batch being inserted when it was cancelled may still be committed.
+        """
+        while not write_queue.empty():
+            writing.append(write_queue.get_nowait())
+        error = RuntimeError("The order service was closed before the order was written")
+        for _, future in writing:
+            if not future.done():
+                future.set_exception(error)
+            write_queue.task_done()
+        writing.clear()
+
+    def restore_orders(self, orders: list[Order]) -> list[Order]:
+        return self._insert_orders(orders, publish=False)
+
+    def _insert_orders(self, orders: list[Order], publish: bool = True) -> list[Order]:
+        """
+        Insert orders in a single transaction, returning the existing order for duplicate idempotency keys.
+        New orders are published to the event bus once committed.
+        """
+        inserted: list[Order] = []
+        new_orders: list[Order] = []
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                for order in orders:
+                    cursor = self._connection.execute(
+                        "INSERT INTO orders (table_number, menu_items, created_at, idempotency_key) "
+                        "VALUES (?, ?, ?, ?) ON CONFLICT (idempotency_key) DO NOTHING",
+                        (
+                            order.table_number,
+                            json.dumps(order.menu_items),
+                            order.created_at.timestamp(),
+                            order.idempotency_key,
+                        ),
+                    )
+                    if cursor.rowcount == 0:
+                        row = self._connection.execute(
+                            "SELECT table_number, menu_items, created_at, idempotency_key FROM orders "
+                            "WHERE idempotency_key = ?",
+                            (order.idempotency_key,),
+                        ).fetchone()
+                        order = self._order_from_row(row)
+                    else:
+                        new_orders.append(order)
+                    inserted.append(order)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        if publish and self.event_bus is not None:
+            for order in new_orders:
+                self.event_bus.publish(order)
+        return inserted
+
+    def get_orders(self, table_number: int | None = None, since: datetime | None = None) -> list[Order]:
+        query = "SELECT table_number, menu_items, created_at, idempotency_key FROM orders"
+        conditions: list[str] = []
+        params: list[int | float] = []
+        if table_number is not None:
+            conditions.append("table_number = ?")
+            params.append(table_number)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since.timestamp())
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created_at, id"
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        return [self._order_from_row(row) for row in rows]
+
+    @staticmethod
+    def _order_from_row(row: tuple[int, str, float, str | None]) -> Order:
+        table_number, menu_items, created_at, idempotency_key = row
+        return Order(
+            table_number=table_number,
+            menu_items=json.loads(menu_items),
+            created_at=datetime.fromtimestamp(created_at, UTC),
+            idempotency_key=idempotency_key,
+        )
+
+    async def flush(self) -> None:
+        """Wait until the orders queued by `create_order_async()` have been written"""
+        if self._write_queue is not None and self._writer_task is not None and not self._writer_task.done():
+            await self._write_queue.join()
+
+    async def aclose(self) -> None:
+        await self.flush()
+        self.close()
+
+    def close(self) -> None:
+        """Close the database, discarding any orders which are still queued (`aclose()` writes them first)"""
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+        with self._lock:
+            self._connection.close()
 
-    def create_order(self, table_number: int, menu_items: list[str]):
-        self.orders.append(Order(table_number=table_number, menu_items=menu_items))
 
-    def get_orders(self) -> list[Order]:
-        return self.orders
+def build_order_service(orders_db: Path | str | None = None, event_bus: "OrderEventBus | None" = None) -> OrderService:
+    """Build an order service which stores orders in a SQLite database if a path is provided, otherwise in memory"""
+    return SQLiteOrderService(orders_db, event_bus=event_bus) if orders_db else OrderService(event_bus)
@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+from abc import ABC, abstractmethod
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from typing import Literal
+
+from ai_framework_demo.llm import LLMResponse
+from ai_framework_demo.resilience import get_resilience_stats
+from ai_framework_demo.run_agent import AgentRunner, build_agent_runner
+from ai_framework_demo.services import MenuService, OrderService
+from ai_framework_demo.tenants import TenantRegistry, build_tenant_registry
+
+DEFAULT_GREETING_MESSAGE = "*Greet the customer*"
+
+# Sessions are identified by their tenant (None for the restaurant of the arguments) and table number
+SessionKey = tuple[str | None, int]
+
+
+class SessionRejectedError(Exception):
+    """Raised when a new session is shed because too many turns are already in flight"""
+
+
+@dataclass
+class TableSession:
+    """State of a single table's conversation with the agent"""
+
+    table_number: int
+    runner: AgentRunner
+    tenant: str | None = None
+    # Ensures the turns of a single conversation are processed in order, since each turn depends on the history
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    turns: int = 0
+    ended: bool = False
+
+
+class BaseSessionManager(ABC):
+    """Serves the conversation turns of many tables"""
+
+    @abstractmethod
+    async def make_request(self, table_number: int, user_message: str, tenant: str | None = None) -> LLMResponse:
+        """Process a single conversation turn for a table (of a tenant's restaurant)"""
+
+    @abstractmethod
+    async def close_session(self, table_number: int, tenant: str | None = None) -> None:
+        """End the session of a table (of a tenant's restaurant), releasing its conversation history"""
+
+    async def run_conversation(
+        self,
+        table_number: int,
+        user_messages: Iterable[str],
+        greeting_message: str = DEFAULT_GREETING_MESSAGE,
+        tenant: str | None = None,
+    ) -> list[LLMResponse]:
+        """
+        Run a scripted conversation for a table, stopping early if the agent ends the conversation.
+        """
+        responses = [await self.make_request(table_number, greeting_message, tenant)]
+        for user_message in user_messages:
+            if responses[-1].end_conversation:
+                break
+            responses.append(await self.make_request(table_number, user_message, tenant))
+        return responses
+
+    async def run_conversations(
+        self, conversations: dict[int, list[str]], tenant: str | None = None
+    ) -> dict[int, list[LLMResponse]]:
+        """Run scripted conversations for many tables (of a tenant's restaurant) concurrently"""
+        results = await asyncio.gather(
+            *(
+                self.run_conversation(table_number, messages, tenant=tenant)
+                for table_number, messages in conversations.items()
+            )
+        )
+        return dict(zip(conversations, results, strict=True))
+
+
+class SessionManager(BaseSessionManager):
+    """
+    Runs many concurrent table conversations within a single event loop.
+
+    Each table gets its own agent runner (with its own dependencies and message history), while model clients are
+    shared between sessions and the number of in-flight requests to each model provider is capped. Requests routed to
+    fallback or cheap models of other providers count towards their own provider's cap.
+
+    With a tenant registry (`--tenants-dir`), the tables of many restaurants can be served by the same manager:
+    each session is given its tenant's restaurant name and shared menu service.
+
+    With `max_in_flight_requests`, new sessions are only admitted while fewer turns than that are in flight,
+    so that existing conversations are served first under load. Otherwise they are queued until a turn finishes,
+    or rejected with SessionRejectedError if `admission` is "shed".
+    """
+
+    def __init__(
+        self,
+        runner_class: type[AgentRunner],
+        args: argparse.Namespace,
+        menu_service: MenuService | None = None,
+        order_service: OrderService | None = None,
+        max_concurrent_requests_per_provider: int = 32,
+        max_in_flight_requests: int | None = None,
+        admission: Literal["queue", "shed"] = "queue",
+        tenants: TenantRegistry | None = None,
+    ):
+        self.runner_class = runner_class
+        self.args = args
+        self.menu_service = menu_service or MenuService()
+        self.order_service = order_service or OrderService()
+        self.max_concurrent_requests_per_provider = max_concurrent_requests_per_provider
+        self.max_in_flight_requests = max_in_flight_requests
+        self.admission = admission
+        self.tenants = tenants or build_tenant_registry(args)
+        self.sessions: dict[SessionKey, TableSession] = {}
+        self._in_flight_requests = 0
+        self._in_flight_changed = asyncio.Condition()
+
+    def _build_runner(self, table_number: int, tenant: str | None) -> AgentRunner:
+        args, menu_service = self.args, self.menu_service
+        if tenant is not None:
+            if self.tenants is None:
+                raise ValueError(f"Can't serve tenant {tenant!r} without a tenant registry (--tenants-dir)")
+            tenant_config = self.tenants.get(tenant)
+            args, menu_service = tenant_config.get_args(args), tenant_config.menu_service
+        # The requests in flight are capped by the resilience policy of the models, as they are made to each provider
+        table_args = vars(args) | {
+            "table_number": table_number,
+            "max_concurrent_requests_per_provider": self.max_concurrent_requests_per_provider,
+        }
+        return build_agent_runner(self.runner_class, menu_service, self.order_service, argparse.Namespace(**table_args))
+
+    def get_session(self, table_number: int, tenant: str | None = None) -> TableSession:
+        """Get the session for a table, creating it if it does not exist yet"""
+        if (session := self.sessions.get((tenant, table_number))) is None:
+            runner = self._build_runner(table_number, tenant)
+            session = self.sessions[tenant, table_number] = TableSession(
+                table_number=table_number, runner=runner, tenant=tenant
+            )
+        return session
+
+    async def close_session(self, table_number: int, tenant: str | None = None) -> None:
+        if (session := self.sessions.pop((tenant, table_number), None)) is not None:
+            session.runner.close()
+
+    def _has_capacity(self) -> bool:
+        return self.max_in_flight_requests is None or self._in_flight_requests < self.max_in_flight_requests
+
+    async def _admit(self, key: SessionKey) -> None:
+        """
+        Take an in-flight slot for a turn, waiting until a new session can be admitted (or rejecting it).
+        Turns of existing sessions are always admitted.
+        """
+        if key not in self.sessions and not self._has_capacity():
+            _, table_number = key
+            if self.admission == "shed":
+                get_resilience_stats().sessions_shed += 1
+                raise SessionRejectedError(f"Too many requests in flight to start a session for table {table_number}")
+            get_resilience_stats().sessions_queued += 1
+            async with self._in_flight_changed:
+                await self._in_flight_changed.wait_for(self._has_capacity)
+                self._in_flight_requests += 1
+                return
+        self._in_flight_requests += 1
+
+    async def _release(self) -> None:
+        self._in_flight_requests -= 1
+        async with self._in_flight_changed:
+            self._in_flight_changed.notify_all()
+
+    async def make_request(self, table_number: int, user_message: str, tenant: str | None = None) -> LLMResponse:
+        """Process a single conversation turn for a table (of a tenant's restaurant)"""
+        await self._admit((tenant, table_number))
+        try:
+            session = self.get_session(table_number, tenant)
+            async with session.lock:
+                response = await session.runner.make_request_async(user_message)
+                session.turns += 1
+                session.ended = response.end_conversation
+        finally:
+            await self._release()
+        return response
@@ -0,0 +1,254 @@
+import argparse
+import importlib.util
+import json
+import logging
+import struct
+import time
+import zlib
+from collections.abc import Callable, Iterator
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Generic
+
+from ai_framework_demo.llm import LLMResponse
+from ai_framework_demo.memory import MessageAdapter, MessageT
+from ai_framework_demo.run_agent import AgentRunner, AgentRunnerWrapper
+from ai_framework_demo.services import MenuService, Order, OrderService, dump_order, load_order
+from ai_framework_demo.tracing import trace_span
+from ai_framework_demo.usage import TurnUsage
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 1
+# Each record is prefixed with the length of its payload and the codec it is compressed with
+RECORD_PREFIX = struct.Struct("<IB")
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+# Only used if the zstandard package is installed (`pip install zstandard`), which is faster and more compact than zlib
+USE_ZSTD = importlib.util.find_spec("zstandard") is not None
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+
+
+class HistoryTracker(Generic[MessageT]):
+    """
+    Tracks the messages of a conversation history which have been written to a snapshot, so that each turn only
+    appends its new messages. The whole history is written again if it has been rewritten since, e.g. when it was
+    compacted by the memory policy.
+    """
+
+    def __init__(self, adapter: MessageAdapter[MessageT]):
+        self.adapter = adapter
+        self.written: list[MessageT] = []
+
+    def dump(self, messages: list[MessageT]) -> tuple[bool, bytes]:
+        """Serialise the messages which haven't been written yet, and whether they replace the written history"""
+        rewritten = len(messages) < len(self.written) or any(
+            written is not message and written != message
+            for written, message in zip(self.written, messages, strict=False)
+        )
+        new_messages = messages if rewritten else messages[len(self.written) :]
+        self.written = list(messages)
+        return rewritten, self.adapter.dump_messages(new_messages)
+
+    def load(self, chunks: list[bytes]) -> list[MessageT]:
+        """Load the history from the chunks written since it was last rewritten"""
+        self.written = [message for chunk in chunks for message in self.adapter.load_messages(chunk)]
+        return list(self.written)
+
+
+def encode_record(header: dict[str, Any], body: bytes = b"") -> bytes:
+    """Encode a snapshot record, which is a JSON header line followed by the (already serialised) body"""
+    payload = json.dumps(header, separators=(",", ":")).encode() + b"\n" + body
+    if USE_ZSTD:
+        import zstandard
+
+        codec, compressed = CODEC_ZSTD, zstandard.compress(payload, ZSTD_LEVEL)
+    else:
+        codec, compressed = CODEC_ZLIB, zlib.compress(payload, ZLIB_LEVEL)
+    return RECORD_PREFIX.pack(len(compressed), codec) + compressed
+
+
+def decode_records(data: bytes) -> Iterator[tuple[dict[str, Any], bytes]]:
+    """Decode the records of a snapshot, ignoring a trailing record which was only partially written"""
+    offset = 0
+    while offset + RECORD_PREFIX.size <= len(data):
+        length, codec = RECORD_PREFIX.unpack_from(data, offset)
+        offset += RECORD_PREFIX.size
+        if offset + length > len(data):
+            logger.warning("Ignoring partially written snapshot record")
+            return
+        compressed = data[offset : offset + length]
+        offset += length
+        if codec == CODEC_ZSTD:
+            import zstandard
+
+            payload = zstandard.decompress(compressed)
+        elif codec == CODEC_ZLIB:
+            payload = zlib.decompress(compressed)
+        else:
+            raise ValueError(f"Unknown snapshot record codec: {codec}")
+        header, _, body = payload.partition(b"\n")
+        yield json.loads(header), body
+
+
+@dataclass
+class SessionSnapshot:
+    """State of a table's session, restored from the records appended to its snapshot after each turn"""
+
+    table_number: int
+    restaurant_name: str
+    model: str
+    # Serialised messages of the conversation history, since it was last rewritten
+    history: list[bytes] = field(default_factory=list)
+    turn_usage: list[TurnUsage] = field(default_factory=list)
+    orders: list[Order] = field(default_factory=list)
+    turns: int = 0
+    ended: bool = False
+
+    def apply(self, header: dict[str, Any], body: bytes) -> None:
+        """Apply a turn record to the snapshot"""
+        if header["history_rewritten"]:
+            self.history = []
+        self.history.append(body)
+        if header["usage"] is not None:
+            self.turn_usage.append(TurnUsage(**header["usage"]))
+        self.orders.extend(load_order(order) for order in header["orders"])
+        self.turns += 1
+        self.ended = header["ended"]
+
+
+def read_session_snapshot(path: Path) -> SessionSnapshot | None:
+    """Read the snapshot of a session, or None if it doesn't exist"""
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    records = decode_records(data)
+    session = next(records, None)
+    if session is None:
+        return None
+    header, _ = session
+    if header.get("version") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version in {path}: {header.get('version')}")
+    snapshot = SessionSnapshot(
+        table_number=header["table_number"], restaurant_name=header["restaurant_name"], model=header["model"]
+    )
+    for header, body in records:
+        snapshot.apply(header, body)
+    return snapshot
+
+
+def get_snapshot_path(snapshot_dir: Path | str, table_number: int, tenant: str | None = None) -> Path:
+    # Tenants' snapshots are kept in a directory for each tenant, since they all have a table 1
+    tenant_dir = Path(snapshot_dir) / tenant if tenant is not None else Path(snapshot_dir)
+    return tenant_dir / f"table-{table_number}.snapshot"
+
+
+class SnapshottingAgentRunner(AgentRunnerWrapper):
+    """
+    Wraps an agent runner to append a record of each turn to a snapshot of the session: the messages added to the
+    conversation history, the turn's token usage and any orders it created. The session can be restored from the
+    snapshot by another process (e.g. after a restart), which only needs to decode the history once.
+    The snapshot is deleted when the conversation ends.
+    """
+
+    def __init__(
+        self,
+        runner: AgentRunner,
+        order_service: OrderService,
+        args: argparse.Namespace,
+        path: Path,
+        snapshot: SessionSnapshot | None = None,
+    ):
+        super().__init__(runner)
+        self.order_service = order_service
+        self.table_number = args.table_number
+        self.path = path
+        self.ended = False
+        if snapshot is None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            session = {
+                "version": SNAPSHOT_FORMAT_VERSION,
+                "table_number": args.table_number,
+                "restaurant_name": args.restaurant_name,
+                "model": args.model,
+            }
+            path.write_bytes(encode_record(session))
+        else:
+            runner.load_history(snapshot.history)
+            runner.turn_usage[:] = snapshot.turn_usage
+            order_service.restore_orders(snapshot.orders)
+        # Orders of the table created before this point are already in the snapshot (or another session's)
+        self.orders_written = len(order_service.get_orders(table_number=self.table_number))
+
+    def _write_turn(self, response: LLMResponse, usage: TurnUsage | None) -> None:
+        with trace_span("memory", "append_snapshot"):
+            history_rewritten, history = self.runner.dump_history()
+            orders = self.order_service.get_orders(table_number=self.table_number)[self.orders_written :]
+            header = {
+                "history_rewritten": history_rewritten,
+                "usage": asdict(usage) if usage is not None else None,
+                "orders": [dump_order(order) for order in orders],
+                "ended": response.end_conversation,
+            }
+            with open(self.path, "ab") as snapshot_file:
+                snapshot_file.write(encode_record(header, history))
+        self.orders_written += len(orders)
+        self.ended = response.end_conversation
+
+    def _after_turn(self, response: LLMResponse, turns_before: int) -> LLMResponse:
+        self._write_turn(response, self.runner.turn_usage[-1] if len(self.runner.turn_usage) > turns_before else None)
+        return response
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        turns_before = len(self.runner.turn_usage)
+        return self._after_turn(self.runner.make_request(user_message), turns_before)
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        turns_before = len(self.runner.turn_usage)
+        return self._after_turn(await self.runner.make_request_async(user_message), turns_before)
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        turns_before = len(self.runner.turn_usage)
+        return self._after_turn(await self.runner.stream_request(user_message, on_message), turns_before)
+
+    def record_turn(self, user_message: str, response: LLMResponse) -> None:
+        self.runner.record_turn(user_message, response)
+        self._write_turn(response, None)
+
+    def close(self) -> None:
+        self.runner.close()
+        if self.ended:
+            self.path.unlink(missing_ok=True)
+
+
+def build_snapshotting_runner(
+    runner_class: type[AgentRunner],
+    menu_service: MenuService,
+    order_service: OrderService,
+    args: argparse.Namespace,
+) -> SnapshottingAgentRunner:
+    """
+    Construct an agent runner which snapshots its session to `--snapshot-dir`, restoring the table's session from
+    its snapshot if there is one (unless its conversation had ended)
+    """
+    path = get_snapshot_path(args.snapshot_dir, args.table_number, getattr(args, "tenant", None))
+    start = time.perf_counter()
+    snapshot = read_session_snapshot(path)
+    if snapshot is not None and snapshot.ended:
+        snapshot = None
+    if snapshot is not None:
+        # The session continues with the dependencies it was started with
+        args = argparse.Namespace(**(vars(args) | {"restaurant_name": snapshot.restaurant_name}))
+    runner = SnapshottingAgentRunner(
+        runner_class(menu_service, order_service, args), order_service, args, path, snapshot
+    )
+    if snapshot is not None:
+        logger.info(
+            "Restored session of table %d after %d turns in %.1fms",
+            args.table_number,
+            snapshot.turns,
+            (time.perf_counter() - start) * 1000,
+        )
+    return runner
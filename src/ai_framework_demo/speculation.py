@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import json
+import logging
+from collections import Counter, defaultdict
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cache
+from typing import Any
+
+from ai_framework_demo.llm import PREFETCHED_TOOL_CALL_ID_PREFIX, LLMResponse, PrefetchedToolCall
+from ai_framework_demo.run_agent import AgentRunner, AgentRunnerWrapper
+from ai_framework_demo.services import MenuIndex, MenuService
+from ai_framework_demo.tracing import trace_span
+
+logger = logging.getLogger(__name__)
+
+# Tool calls are identified by the tool name and their arguments serialised as JSON
+ToolCallKey = tuple[str, str]
+
+# Tools which can be called ahead of the model, since they have no side effects (unlike create_order)
+SPECULATIVE_TOOLS: dict[str, Callable[[MenuService, dict[str, Any]], Any]] = {
+    "get_menu": lambda menu_service, _: menu_service.get_menu(),
+    "search_menu": lambda menu_service, args: menu_service.search_menu(
+        tags=args.get("dietary_tags") or (), category=args.get("category"), text=args.get("text")
+    ),
+}
+DEFAULT_SPECULATIVE_TOOLS = ["1:get_menu"]
+# Turns of a phase which must be observed, and the proportion of them in which the model must make a tool call,
+# before it is learned as a likely tool call of the phase
+MIN_OBSERVED_TURNS = 5
+MIN_CALL_PROBABILITY = 0.5
+# Maximum number of speculative tool calls run at the same time by all conversations in the process
+SPECULATION_THREAD_POOL_MAX_WORKERS = 4
+
+
+def get_tool_call_key(tool_name: str, args: dict[str, Any]) -> ToolCallKey:
+    return tool_name, json.dumps(args, sort_keys=True)
+
+
+@cache
+def get_speculation_thread_pool() -> ThreadPoolExecutor:
+    """Get the thread pool which runs the speculative tool calls of all conversations in the process"""
+    return ThreadPoolExecutor(max_workers=SPECULATION_THREAD_POOL_MAX_WORKERS, thread_name_prefix="speculation")
+
+
+class RecordingMenuService(MenuService):
+    """Menu service of a single conversation, which records the calls made to it by the model's tools"""
+
+    def __init__(self, menu_service: MenuService):
+        super().__init__(menu_service.menu_path)
+        self.menu_service = menu_service
+        self.calls: list[ToolCallKey] = []
+
+    def get_index(self) -> MenuIndex:
+        return self.menu_service.get_index()
+
+    def get_menu(self) -> dict[str, list[str]]:
+        self.calls.append(get_tool_call_key("get_menu", {}))
+        return super().get_menu()
+
+    def search_menu(
+        self,
+        tags: Iterable[str] = (),
+        category: str | None = None,
+        text: str | None = None,
+        include_options: bool = True,
+    ) -> dict[str, list[str]]:
+        args = {"dietary_tags": list(tags) or None, "category": category, "text": text}
+        self.calls.append(get_tool_call_key("search_menu", args))
+        return super().search_menu(tags, category, text, include_options)
+
+
+class SpeculationPolicy:
+    """
+    Predicts the read-only tool calls the model is likely to make in each phase of a conversation (i.e. its turn
+    number): those configured for the phase, and those it has made in at least MIN_CALL_PROBABILITY of the turns of
+    the phase observed in all conversations of the process. A speculative call which the model didn't need to make
+    again counts as made, so learned calls keep being predicted.
+    """
+
+    def __init__(self, configured: dict[int, list[ToolCallKey]]):
+        self.configured = configured
+        self.observed_turns: Counter[int] = Counter()
+        self.observed_calls: defaultdict[int, Counter[ToolCallKey]] = defaultdict(Counter)
+
+    def predict(self, phase: int) -> list[ToolCallKey]:
+        predicted = list(self.configured.get(phase, []))
+        if self.observed_turns[phase] >= MIN_OBSERVED_TURNS:
+            predicted.extend(
+                key
+                for key, count in self.observed_calls[phase].items()
+                if count / self.observed_turns[phase] >= MIN_CALL_PROBABILITY and key not in predicted
+            )
+        return predicted
+
+    def observe(self, phase: int, calls: Iterable[ToolCallKey]) -> None:
+        """Record the read-only tool calls made in a turn of a phase (including speculative ones)"""
+        self.observed_turns[phase] += 1
+        self.observed_calls[phase].update({key for key in calls if key[0] in SPECULATIVE_TOOLS})
+
+
+def parse_speculative_tools(specs: list[str]) -> dict[int, list[ToolCallKey]]:
+    """Parse the tools to call speculatively before each turn, in format `<turn number>:<tool name>`"""
+    configured: defaultdict[int, list[ToolCallKey]] = defaultdict(list)
+    for spec in specs:
+        turn, _, tool_name = spec.partition(":")
+        if not turn.isdigit() or int(turn) < 1:
+            raise ValueError(
+                f"Invalid speculative tool {spec!r}, expected <turn number>:<tool name> after the greeting"
+            )
+        if tool_name not in SPECULATIVE_TOOLS:
+            raise ValueError(
+                f"Tool {tool_name!r} can't be called speculatively, only tools without side effects can be: "
+                + ", ".join(SPECULATIVE_TOOLS)
+            )
+        configured[int(turn)].append(get_tool_call_key(tool_name, {}))
+    return dict(configured)
+
+
+@cache
+def get_speculation_policy(specs: tuple[str, ...]) -> SpeculationPolicy:
+    """Get the speculation policy which is shared by all conversations in the process with the same configuration"""
+    return SpeculationPolicy(parse_speculative_tools(list(specs)))
+
+
+def build_speculation_policy(args: argparse.Namespace) -> SpeculationPolicy:
+    return get_speculation_policy(tuple(getattr(args, "speculative_tools", None) or DEFAULT_SPECULATIVE_TOOLS))
+
+
+@dataclass
+class SpeculationStats:
+    """Outcomes of the speculative tool calls of all conversations in the process"""
+
+    speculated: int = 0
+    # Speculative tool calls whose results were added to the model's context
+    prefetched: int = 0
+    # Prefetched tool calls which the model made again anyway
+    redundant: int = 0
+    # Speculative tool calls which were not used, since the conversation ended or the turn was answered without a model
+    discarded: int = 0
+    # Read-only tool calls made by the model which weren't speculated
+    missed: int = 0
+
+    @property
+    def wasted(self) -> int:
+        return self.redundant + self.discarded
+
+    def __str__(self) -> str:
+        wasted_rate = self.wasted / self.speculated if self.speculated else 0
+        return (
+            f"speculated={self.speculated} prefetched={self.prefetched} redundant={self.redundant} "
+            f"discarded={self.discarded} wasted={wasted_rate:.0%} missed={self.missed}"
+        )
+
+
+@cache
+def get_speculation_stats() -> SpeculationStats:
+    return SpeculationStats()
+
+
+@dataclass
+class Speculation:
+    """Tool calls run ahead of a turn, while waiting for the user's message"""
+
+    keys: list[ToolCallKey]
+    results: Future[list[Any]]
+
+
+class SpeculativeAgentRunner(AgentRunnerWrapper):
+    """
+    Wraps an agent runner to run the read-only tool calls which the model is likely to make in the next turn
+    (e.g. get_menu after the greeting) as soon as a turn has finished, while the user is writing their next message.
+    Their results are added to the conversation history before the next turn, so the model can answer without
+    an extra round trip to call the tools itself. Tools with side effects (create_order) are never called ahead.
+    """
+
+    def __init__(
+        self,
+        runner: AgentRunner,
+        menu_service: MenuService,
+        recording_menu_service: RecordingMenuService,
+        policy: SpeculationPolicy,
+    ):
+        super().__init__(runner)
+        self.menu_service = menu_service
+        self.recording_menu_service = recording_menu_service
+        self.policy = policy
+        self.stats = get_speculation_stats()
+        # Includes the turns of a conversation restored from a snapshot
+        self.turns = len(runner.turn_usage)
+        self.speculation: Speculation | None = None
+        self.prefetched: list[ToolCallKey] = []
+        if self.turns:
+            self._speculate()
+
+    def _run_tools(self, keys: list[ToolCallKey]) -> list[Any]:
+        return [SPECULATIVE_TOOLS[tool_name](self.menu_service, json.loads(args)) for tool_name, args in keys]
+
+    def _speculate(self) -> None:
+        """Start the tool calls predicted for the next turn"""
+        if keys := self.policy.predict(self.turns):
+            future = get_speculation_thread_pool().submit(self._run_tools, keys)
+            self.speculation = Speculation(keys=keys, results=future)
+            self.stats.speculated += len(keys)
+
+    def _discard_speculation(self) -> None:
+        if self.speculation is not None:
+            self.speculation.results.cancel()
+            self.stats.discarded += len(self.speculation.keys)
+            self.speculation = None
+
+    def _prefetch(self, results: list[Any]) -> None:
+        """Add the results of the speculative tool calls to the conversation history, before the turn"""
+        assert self.speculation is not None
+        with trace_span("tool", "prefetched:" + ",".join(tool_name for tool_name, _ in self.speculation.keys)):
+            self.runner.add_tool_results(
+                [
+                    PrefetchedToolCall(
+                        tool_call_id=f"{PREFETCHED_TOOL_CALL_ID_PREFIX}{self.turns}_{index}",
+                        tool_name=tool_name,
+                        args=json.loads(args),
+                        result=result,
+                    )
+                    for index, ((tool_name, args), result) in enumerate(
+                        zip(self.speculation.keys, results, strict=True)
+                    )
+                ]
+            )
+        self.prefetched = self.speculation.keys
+        self.stats.prefetched += len(self.prefetched)
+        self.speculation = None
+
+    def _before_turn(self, results: list[Any] | None) -> None:
+        self.prefetched = []
+        if results is not None:
+            self._prefetch(results)
+        self.recording_menu_service.calls.clear()
+
+    def _after_turn(self, response: LLMResponse) -> LLMResponse:
+        calls = self.recording_menu_service.calls
+        self.stats.redundant += sum(key in calls for key in self.prefetched)
+        self.stats.missed += sum(key not in self.prefetched for key in calls)
+        self.policy.observe(self.turns, [*calls, *self.prefetched])
+        self.prefetched = []
+        self.turns += 1
+        if not response.end_conversation:
+            self._speculate()
+        return response
+
+    def _speculation_failed(self) -> None:
+        # The turn goes ahead without the speculative results, so the model calls the tools itself if it needs to
+        logger.warning("Speculative tool calls failed", exc_info=True)
+        self._discard_speculation()
+
+    def _wait_for_speculation(self) -> list[Any] | None:
+        if self.speculation is None:
+            return None
+        try:
+            return self.speculation.results.result()
+        except Exception:
+            self._speculation_failed()
+            return None
+
+    async def _await_speculation(self) -> list[Any] | None:
+        if self.speculation is None:
+            return None
+        try:
+            return await asyncio.wrap_future(self.speculation.results)
+        except Exception:
+            self._speculation_failed()
+            return None
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        self._before_turn(self._wait_for_speculation())
+        return self._after_turn(self.runner.make_request(user_message))
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        self._before_turn(await self._await_speculation())
+        return self._after_turn(await self.runner.make_request_async(user_message))
+
+    async def stream_request(self, user_message: str, on_message: Callable[[str], None]) -> LLMResponse:
+        self._before_turn(await self._await_speculation())
+        return self._after_turn(await self.runner.stream_request(user_message, on_message))
+
+    def record_turn(self, user_message: str, response: LLMResponse) -> None:
+        # The turn was answered without the model, so didn't need the speculative tool calls
+        self._discard_speculation()
+        self.runner.record_turn(user_message, response)
+        self.turns += 1
+        if not response.end_conversation:
+            self._speculate()
+
+    def close(self) -> None:
+        self._discard_speculation()
+        self.runner.close()
@@ -0,0 +1,105 @@
+import argparse
+import json
+import tomllib
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Any
+
+from ai_framework_demo.llm import format_static_prompt
+from ai_framework_demo.services import MenuService
+
+TENANT_FILE_SUFFIXES = (".json", ".toml")
+
+
+@dataclass(frozen=True)
+class Tenant:
+    """
+    A restaurant served by the deployment, whose menu (and its index) and static system prompt are built once
+    and shared by all of its table sessions
+    """
+
+    tenant_id: str
+    restaurant_name: str
+    menu_service: MenuService
+
+    @classmethod
+    def from_config(cls, tenant_id: str, config: dict[str, Any]) -> "Tenant":
+        try:
+            restaurant_name, menu = config["restaurant_name"], config["menu"]
+        except KeyError as e:
+            raise ValueError(f"Tenant {tenant_id!r} has no {e.args[0]}") from None
+        if not isinstance(menu, dict) or not all(isinstance(items, list) for items in menu.values()):
+            raise ValueError(f"Menu of tenant {tenant_id!r} must map categories to lists of item descriptions")
+        menu_service = MenuService(menu=menu)
+        # Parse and index the menu up front, rather than in the first turn of each worker
+        menu_service.get_index()
+        # Likewise the static system prompt, which is cached by restaurant name for the agents to use
+        format_static_prompt(restaurant_name)
+        return cls(tenant_id=tenant_id, restaurant_name=restaurant_name, menu_service=menu_service)
+
+    def get_args(self, args: argparse.Namespace) -> argparse.Namespace:
+        """Arguments for the tenant's sessions"""
+        return argparse.Namespace(**(vars(args) | {"tenant": self.tenant_id, "restaurant_name": self.restaurant_name}))
+
+
+def load_tenant_config(path: Path) -> dict[str, Any]:
+    """Load a tenant's restaurant name and menu (mapping category to item descriptions) from a JSON or TOML file"""
+    if path.suffix == ".toml":
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+class TenantRegistry:
+    """
+    Restaurants served by the deployment, each loaded from a JSON or TOML file in a directory named after its tenant ID
+    (e.g. `le-bistro.toml`). Each process loads the registry once, so tenants' artefacts are shared by all the table
+    sessions of the process, whichever restaurant they are for.
+    """
+
+    def __init__(self, tenants: dict[str, Tenant]):
+        self.tenants = tenants
+
+    @classmethod
+    def load(cls, tenants_dir: Path) -> "TenantRegistry":
+        paths = sorted(path for path in tenants_dir.iterdir() if path.suffix in TENANT_FILE_SUFFIXES)
+        if not paths:
+            raise ValueError(f"No tenant files ({', '.join(TENANT_FILE_SUFFIXES)}) found in {tenants_dir}")
+        tenants: dict[str, Tenant] = {}
+        for path in paths:
+            if path.stem in tenants:
+                raise ValueError(f"Tenant {path.stem!r} is defined by several files in {tenants_dir}")
+            tenants[path.stem] = Tenant.from_config(path.stem, load_tenant_config(path))
+        return cls(tenants)
+
+    def get(self, tenant_id: str) -> Tenant:
+        try:
+            return self.tenants[tenant_id]
+        except KeyError:
+            raise ValueError(f"Unknown tenant {tenant_id!r}, expected one of: {', '.join(self.tenants)}") from None
+
+    def __len__(self) -> int:
+        return len(self.tenants)
+
+
+@cache
+def get_tenant_registry(tenants_dir: str) -> TenantRegistry:
+    """Get the tenant registry which is shared by all sessions in the process"""
+    return TenantRegistry.load(Path(tenants_dir))
+
+
+def build_tenant_registry(args: argparse.Namespace) -> TenantRegistry | None:
+    tenants_dir = getattr(args, "tenants_dir", None)
+    return get_tenant_registry(str(tenants_dir)) if tenants_dir else None
+
+
+def build_tenant_menu_service(args: argparse.Namespace) -> tuple[argparse.Namespace, MenuService]:
+    """The arguments and menu service of the tenant chosen with `--tenant`, or the arguments and the default menu"""
+    if not getattr(args, "tenant", None):
+        return args, MenuService()
+    if (tenants := build_tenant_registry(args)) is None:
+        raise ValueError("--tenant requires a tenant registry (--tenants-dir)")
+    tenant = tenants.get(args.tenant)
+    return tenant.get_args(args), tenant.menu_service
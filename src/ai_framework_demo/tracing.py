@@ -0,0 +1,300 @@
+import argparse
+import json
+import secrets
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import cache
+from pathlib import Path
+from typing import Literal
+
+from rich.table import Table
+
+from ai_framework_demo.usage import TurnUsage
+
+# Parts of a conversation turn which are recorded as spans:
+# - memory: compaction of the conversation history (including any summarisation requests)
+# - prompt: building the prompt from the system prompt template and message history
+# - model: a single model request (round trip), with its token usage
+# - tool: a single tool call
+# - parse: parsing and validation of the structured response
+SpanKind = Literal["turn", "memory", "prompt", "model", "tool", "parse"]
+SPAN_KINDS: tuple[SpanKind, ...] = ("memory", "prompt", "model", "tool", "parse")
+
+# Span attribute values must be primitive to be exported
+AttributeValue = str | int | float | bool
+
+
+@dataclass
+class Span:
+    kind: SpanKind
+    name: str
+    # Epoch timestamps in seconds
+    start: float = field(default_factory=time.time)
+    end: float | None = None
+    attributes: dict[str, AttributeValue] = field(default_factory=dict)
+    span_id: str = field(default_factory=lambda: secrets.token_hex(8))
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def finish(self, **attributes: AttributeValue) -> None:
+        self.attributes.update(attributes)
+        self.end = time.time()
+
+    def set_usage(self, usage: TurnUsage) -> None:
+        """Record the token usage of a model request"""
+        self.attributes.update(
+            input_tokens=usage.input_tokens,
+            output_tokens=usage.output_tokens,
+            cache_read_tokens=usage.cache_read_tokens,
+            cache_write_tokens=usage.cache_write_tokens,
+        )
+
+
+@dataclass
+class TurnTrace:
+    """Spans recorded during a single conversation turn, which are all children of the turn's root span"""
+
+    conversation: str
+    turn: int
+    root: Span
+    spans: list[Span] = field(default_factory=list)
+    usage: TurnUsage | None = None
+    trace_id: str = field(default_factory=lambda: secrets.token_hex(16))
+
+    def start_span(self, kind: SpanKind, name: str, **attributes: AttributeValue) -> Span:
+        span = Span(kind=kind, name=name, attributes=attributes)
+        # Appending to a list is thread-safe, so spans can be started from tool threads
+        self.spans.append(span)
+        return span
+
+    def spans_of_kind(self, kind: SpanKind) -> list[Span]:
+        return [span for span in self.spans if span.kind == kind and span.end is not None]
+
+    def covered_duration(self, spans: list[Span]) -> float:
+        """Wall-clock time covered by the spans, counting overlapping time (e.g. of concurrent tool calls) once"""
+        covered, covered_until = 0.0, 0.0
+        for span in sorted(spans, key=lambda span: span.start):
+            assert span.end is not None
+            if span.end > covered_until:
+                covered += span.end - max(span.start, covered_until)
+                covered_until = span.end
+        return covered
+
+    @property
+    def other_duration(self) -> float:
+        """Time of the turn not covered by any recorded span, i.e. the overhead of the framework itself"""
+        return self.root.duration - self.covered_duration([span for span in self.spans if span.end is not None])
+
+
+_current_turn_trace: ContextVar[TurnTrace | None] = ContextVar("current_turn_trace", default=None)
+
+
+def current_turn_trace() -> TurnTrace | None:
+    """Get the trace of the turn currently being processed, if it is being traced"""
+    return _current_turn_trace.get()
+
+
+@contextmanager
+def trace_span(kind: SpanKind, name: str, **attributes: AttributeValue) -> Iterator[Span | None]:
+    """Record a span in the trace of the current turn, if it is being traced"""
+    if (trace := _current_turn_trace.get()) is None:
+        yield None
+        return
+    span = trace.start_span(kind, name, **attributes)
+    try:
+        yield span
+    except BaseException as e:
+        span.attributes["error"] = repr(e)
+        raise
+    finally:
+        span.finish()
+
+
+class SpanExporter(ABC):
+    @abstractmethod
+    def export(self, trace: TurnTrace) -> None: ...
+
+    def shutdown(self) -> None:
+        """Flush any buffered spans"""
+        return None
+
+
+class JsonlSpanExporter(SpanExporter):
+    """Appends each span to a JSON Lines file, with the same trace and span IDs as would be exported to OpenTelemetry"""
+
+    def __init__(self, path: Path | str):
+        self.path = path
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def export(self, trace: TurnTrace) -> None:
+        lines = [self._span_record(trace, trace.root, parent_id=None)]
+        lines += [self._span_record(trace, span, parent_id=trace.root.span_id) for span in trace.spans]
+        with self._lock:
+            self._file.write("".join(json.dumps(line) + "\n" for line in lines))
+            self._file.flush()
+
+    def _span_record(self, trace: TurnTrace, span: Span, parent_id: str | None) -> dict:
+        return {
+            "trace_id": trace.trace_id,
+            "span_id": span.span_id,
+            "parent_id": parent_id,
+            "conversation": trace.conversation,
+            "turn": trace.turn,
+            "kind": span.kind,
+            "name": span.name,
+            "start": span.start,
+            "end": span.end,
+            "duration_ms": span.duration * 1000,
+            "attributes": span.attributes,
+        }
+
+    def shutdown(self) -> None:
+        self._file.close()
+
+
+class OpenTelemetrySpanExporter(SpanExporter):
+    """Exports spans to an OpenTelemetry collector with OTLP over HTTP (e.g. http://localhost:4318/v1/traces)"""
+
+    def __init__(self, endpoint: str, service_name: str = "ai-framework-demo"):
+        # Installed with logfire
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        # A separate provider is used, so spans are not also sent wherever logfire's global provider sends them
+        self.provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+        self.provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+        self.tracer = self.provider.get_tracer("ai_framework_demo")
+
+    def export(self, trace: TurnTrace) -> None:
+        from opentelemetry.trace import set_span_in_context
+
+        # Spans are created once the turn has finished, with their recorded start and end times
+        root = self.tracer.start_span(
+            trace.root.name,
+            start_time=_to_ns(trace.root.start),
+            attributes={"conversation": trace.conversation, "turn": trace.turn, **trace.root.attributes},
+        )
+        context = set_span_in_context(root)
+        for span in trace.spans:
+            otel_span = self.tracer.start_span(
+                f"{span.kind} {span.name}",
+                context=context,
+                start_time=_to_ns(span.start),
+                attributes={"kind": span.kind, **span.attributes},
+            )
+            otel_span.end(end_time=_to_ns(span.end or span.start))
+        root.end(end_time=_to_ns(trace.root.end or trace.root.start))
+
+    def shutdown(self) -> None:
+        self.provider.shutdown()
+
+
+def _to_ns(timestamp: float) -> int:
+    return int(timestamp * 1e9)
+
+
+class Tracer:
+    """Records a trace of each conversation turn, which is exported when the turn ends"""
+
+    def __init__(self, exporters: list[SpanExporter]):
+        self.exporters = exporters
+
+    @contextmanager
+    def trace_turn(self, conversation: str, turn: int, user_message: str) -> Iterator[TurnTrace]:
+        trace = TurnTrace(
+            conversation=conversation,
+            turn=turn,
+            root=Span(kind="turn", name="turn", attributes={"user_message": user_message}),
+        )
+        token = _current_turn_trace.set(trace)
+        try:
+            yield trace
+        except BaseException as e:
+            trace.root.attributes["error"] = repr(e)
+            raise
+        finally:
+            _current_turn_trace.reset(token)
+            trace.root.finish()
+            if trace.usage is not None:
+                trace.root.set_usage(trace.usage)
+            for exporter in self.exporters:
+                exporter.export(trace)
+
+    def shutdown(self) -> None:
+        for exporter in self.exporters:
+            exporter.shutdown()
+
+
+@cache
+def get_tracer(trace_file: str | None, otlp_endpoint: str | None) -> Tracer:
+    """Get the tracer which is shared by all agents in the process with the same configuration"""
+    exporters: list[SpanExporter] = []
+    if trace_file:
+        exporters.append(JsonlSpanExporter(trace_file))
+    if otlp_endpoint:
+        exporters.append(OpenTelemetrySpanExporter(otlp_endpoint))
+    return Tracer(exporters)
+
+
+def build_tracer(args: argparse.Namespace) -> Tracer | None:
+    """Get the tracer configured by the CLI arguments, or None if tracing is disabled"""
+    trace_file = getattr(args, "trace_file", None)
+    otlp_endpoint = getattr(args, "otlp_endpoint", None)
+    if not (getattr(args, "profile", False) or trace_file or otlp_endpoint):
+        return None
+    return get_tracer(trace_file, otlp_endpoint)
+
+
+def build_profile_table(traces: list[TurnTrace], title: str = "Turn profile") -> Table:
+    """Build a table summarising where the time and tokens of each turn of a conversation went"""
+    table = Table(title=f"{title}, durations in ms")
+    for column in ("turn", "total", *SPAN_KINDS, "other", "requests", "in tok", "out tok", "cached tok"):
+        table.add_column(column, justify="right")
+
+    total_usage = TurnUsage()
+    for trace in traces:
+        usage = trace.usage or TurnUsage()
+        total_usage += usage
+        table.add_row(
+            str(trace.turn),
+            f"{trace.root.duration * 1000:.1f}",
+            *(_format_kind_duration(trace, kind) for kind in SPAN_KINDS),
+            f"{trace.other_duration * 1000:.1f}",
+            *_format_usage(usage),
+        )
+    if traces:
+        table.add_section()
+        table.add_row(
+            "total",
+            f"{sum(trace.root.duration for trace in traces) * 1000:.1f}",
+            *(
+                f"{sum(trace.covered_duration(trace.spans_of_kind(kind)) for trace in traces) * 1000:.1f}"
+                for kind in SPAN_KINDS
+            ),
+            f"{sum(trace.other_duration for trace in traces) * 1000:.1f}",
+            *_format_usage(total_usage),
+        )
+    return table
+
+
+def _format_kind_duration(trace: TurnTrace, kind: SpanKind) -> str:
+    spans = trace.spans_of_kind(kind)
+    if not spans:
+        return "-"
+    duration = f"{trace.covered_duration(spans) * 1000:.1f}"
+    # Show the number of model requests and tool calls
+    return f"{duration} ({len(spans)})" if kind in ("model", "tool") else duration
+
+
+def _format_usage(usage: TurnUsage) -> tuple[str, ...]:
+    return str(usage.requests), str(usage.input_tokens), str(usage.output_tokens), str(usage.cache_read_tokens)
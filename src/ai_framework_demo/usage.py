@@ -0,0 +1,32 @@
+from contextvars import ContextVar
+from dataclasses import dataclass, fields
+
+
+@dataclass
+class TurnUsage:
+    """Token usage of the model requests made during a single conversation turn"""
+
+    requests: int = 0
+    # Total input tokens, including those read from or written to the provider's prompt cache
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+
+    @property
+    def cache_miss_tokens(self) -> int:
+        return self.input_tokens - self.cache_read_tokens
+
+    def __add__(self, other: "TurnUsage") -> "TurnUsage":
+        return TurnUsage(**{f.name: getattr(self, f.name) + getattr(other, f.name) for f in fields(self)})
+
+    def __str__(self) -> str:
+        return (
+            f"requests={self.requests} input_tokens={self.input_tokens} output_tokens={self.output_tokens} "
+            f"cache_hit_tokens={self.cache_read_tokens} cache_miss_tokens={self.cache_miss_tokens}"
+        )
+
+
+# Usage of each model in the current turn, collected while requests are routed between models so that it can be
+# attributed to the models which were used (set by whoever accounts for the turn's usage)
+turn_model_usage: ContextVar[dict[str, TurnUsage] | None] = ContextVar("turn_model_usage", default=None)
@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import zlib
+from dataclasses import dataclass
+from multiprocessing.process import BaseProcess
+from typing import Any
+
+from ai_framework_demo.llm import LLMResponse
+from ai_framework_demo.services import build_order_service
+from ai_framework_demo.sessions import BaseSessionManager, SessionManager
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks that the workers are still alive, while waiting for their responses
+WORKER_LIVENESS_INTERVAL = 1.0
+
+
+@dataclass
+class WorkerRequest:
+    request_id: int
+    table_number: int
+    # None to close the table's session
+    user_message: str | None
+    tenant: str | None = None
+
+
+@dataclass
+class WorkerResponse:
+    request_id: int
+    response: LLMResponse | None = None
+    error: BaseException | None = None
+
+
+class WorkerError(Exception):
+    """Raised for the requests of a worker process which exited before responding to them"""
+
+
+def _picklable_error(error: BaseException) -> BaseException:
+    """The error, or a stand-in for it if it can't be sent back to the front process (e.g. some provider SDK errors)"""
+    try:
+        return pickle.loads(pickle.dumps(error))
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+async def _handle_request(manager: SessionManager, request: WorkerRequest, responses: multiprocessing.Queue) -> None:
+    result = WorkerResponse(request.request_id)
+    try:
+        if request.user_message is None:
+            await manager.close_session(request.table_number, request.tenant)
+        else:
+            result.response = await manager.make_request(request.table_number, request.user_message, request.tenant)
+    except Exception as e:
+        result.error = _picklable_error(e)
+    responses.put(result)
+
+
+async def _serve_requests(
+    args: argparse.Namespace,
+    requests: multiprocessing.Queue,
+    responses: multiprocessing.Queue,
+    max_concurrent_requests_per_provider: int,
+) -> None:
+    # Imported here since it configures the process for the chosen framework
+    from ai_framework_demo.__main__ import load_runner_class
+
+    manager = SessionManager(
+        load_runner_class(args),
+        args,
+        order_service=build_order_service(getattr(args, "orders_db", None)),
+        max_concurrent_requests_per_provider=max_concurrent_requests_per_provider,
+    )
+    responses.put(None)
+    tasks: set[asyncio.Task[None]] = set()
+    while (request := await asyncio.to_thread(requests.get)) is not None:
+        task = asyncio.create_task(_handle_request(manager, request, responses))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    for tenant, table_number in list(manager.sessions):
+        await manager.close_session(table_number, tenant)
+    await manager.order_service.aclose()
+
+
+def run_worker(
+    args: argparse.Namespace,
+    requests: multiprocessing.Queue,
+    responses: multiprocessing.Queue,
+    max_concurrent_requests_per_provider: int = 32,
+) -> None:
+    """Entry point of a worker process, which serves the turns of its tables until it receives None"""
+    asyncio.run(_serve_requests(args, requests, responses, max_concurrent_requests_per_provider))
+
+
+class WorkerPool(BaseSessionManager):
+    """
+    Serves table conversations from several worker processes, so that the CPU time spent in the frameworks
+    (validating responses, formatting prompts, rebuilding tool messages etc.) isn't bound to the GIL of one process.
+
+    Tables are sharded between the workers by their number (and tenant), so all of a table's turns are made by the
+    same worker (which holds its conversation history), each running a SessionManager for its tables. Orders are
+    shared between the workers (and the front process) through a SQLite database: `--orders-db`, or a temporary
+    database (`orders_db`) which is deleted when the pool is closed.
+    Each worker loads the tenant registry (`--tenants-dir`) once, when it starts.
+    """
+
+    def __init__(self, args: argparse.Namespace, workers: int, max_concurrent_requests_per_provider: int = 32):
+        self._orders_dir: str | None = None
+        if not getattr(args, "orders_db", None):
+            # Otherwise each worker would keep the orders of its tables in its own memory
+            self._orders_dir = tempfile.mkdtemp(prefix="ai-waiter-orders-")
+            args = argparse.Namespace(**(vars(args) | {"orders_db": f"{self._orders_dir}/orders.db"}))
+        self.args = args
+        self.orders_db: str = args.orders_db
+        # Spawned rather than forked, since the front process may have threads and an event loop running
+        self._context = multiprocessing.get_context("spawn")
+        self._requests = [self._context.Queue() for _ in range(workers)]
+        self._responses = self._context.Queue()
+        self._processes: list[BaseProcess] = [
+            self._context.Process(
+                target=run_worker,
+                args=(args, requests, self._responses, max_concurrent_requests_per_provider),
+                name=f"ai-waiter-worker-{index}",
+                daemon=True,
+            )
+            for index, requests in enumerate(self._requests)
+        ]
+        self._request_ids = itertools.count()
+        # Requests waiting for a response, with the worker they were sent to and the event loop of their caller
+        self._pending: dict[int, tuple[int, asyncio.AbstractEventLoop, asyncio.Future[Any]]] = {}
+        self._lock = threading.Lock()
+        self._reader: threading.Thread | None = None
+
+    @property
+    def workers(self) -> int:
+        return len(self._processes)
+
+    def get_worker(self, table_number: int, tenant: str | None = None) -> int:
+        """Index of the worker which serves a table"""
+        # Tenants' tables are offset by a stable hash of the tenant ID, so their table 1s aren't all in the same worker
+        offset = zlib.crc32(tenant.encode()) if tenant is not None else 0
+        return (offset + table_number) % self.workers
+
+    def start(self) -> None:
+        """Start the worker processes, waiting until each has loaded its framework"""
+        for process in self._processes:
+            process.start()
+        ready = 0
+        while ready < self.workers:
+            try:
+                ready += self._responses.get(timeout=WORKER_LIVENESS_INTERVAL) is None
+            except queue.Empty:
+                if not all(process.is_alive() for process in self._processes):
+                    self.close()
+                    raise WorkerError("Worker process exited while starting") from None
+        self._reader = threading.Thread(target=self._read_responses, name="ai-waiter-worker-responses", daemon=True)
+        self._reader.start()
+
+    def _resolve(self, request_id: int, result: Any = None, error: BaseException | None = None) -> None:
+        with self._lock:
+            if (pending := self._pending.pop(request_id, None)) is None:
+                return
+        _, loop, future = pending
+        if error is not None:
+            loop.call_soon_threadsafe(_set_exception, future, error)
+        else:
+            loop.call_soon_threadsafe(_set_result, future, result)
+
+    def _fail_requests_of_dead_workers(self) -> None:
+        dead_workers = {index for index, process in enumerate(self._processes) if not process.is_alive()}
+        if not dead_workers:
+            return
+        with self._lock:
+            request_ids = [request_id for request_id, (index, *_) in self._pending.items() if index in dead_workers]
+        for request_id in request_ids:
+            self._resolve(request_id, error=WorkerError("Worker process exited before responding"))
+
+    def _read_responses(self) -> None:
+        """Thread which passes the responses of the workers to the requests waiting for them"""
+        while True:
+            try:
+                result = self._responses.get(timeout=WORKER_LIVENESS_INTERVAL)
+            except queue.Empty:
+                self._fail_requests_of_dead_workers()
+                continue
+            if result is None:
+                return
+            self._resolve(result.request_id, result.response, result.error)
+
+    async def _send(self, table_number: int, user_message: str | None, tenant: str | None) -> Any:
+        if self._reader is None:
+            raise RuntimeError("WorkerPool must be started before making requests")
+        request_id = next(self._request_ids)
+        worker = self.get_worker(table_number, tenant)
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self._pending[request_id] = (worker, asyncio.get_running_loop(), future)
+        self._requests[worker].put(WorkerRequest(request_id, table_number, user_message, tenant))
+        return await future
+
+    async def make_request(self, table_number: int, user_message: str, tenant: str | None = None) -> LLMResponse:
+        """Process a single conversation turn for a table (of a tenant's restaurant), in the worker which serves it"""
+        return await self._send(table_number, user_message, tenant)
+
+    async def close_session(self, table_number: int, tenant: str | None = None) -> None:
+        await self._send(table_number, None, tenant)
+
+    def close(self) -> None:
+        """Stop the workers once they have finished their requests in progress, closing all their sessions"""
+        for requests, process in zip(self._requests, self._processes, strict=True):
+            if process.is_alive():
+                requests.put(None)
+        for process in self._processes:
+            if process.pid is not None:
+                process.join()
+        if self._reader is not None:
+            self._responses.put(None)
+            self._reader.join()
+            self._reader = None
+        if self._orders_dir is not None:
+            shutil.rmtree(self._orders_dir, ignore_errors=True)
+            self._orders_dir = None
+
+    def __enter__(self) -> "WorkerPool":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def _set_result(future: asyncio.Future[Any], result: Any) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future[Any], error: BaseException) -> None:
+    if not future.done():
+        future.set_exception(error)
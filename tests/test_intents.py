@@ -0,0 +1,42 @@
+import pytest
+
+from ai_framework_demo.intents import Intent, IntentClassifier
+from ai_framework_demo.services import MenuService
+
+
+@pytest.fixture
+def classifier() -> IntentClassifier:
+    return IntentClassifier(MenuService().get_index())
+
+
+@pytest.mark.parametrize(
+    ("user_message", "intent"),
+    [
+        ("Can I see the menu?", Intent("menu")),
+        ("No, can I see the menu?", Intent("menu")),
+        ("What's vegan?", Intent("menu_search", tags=["VG"])),
+        ("Any gluten free desserts?", Intent("menu_search", tags=["GF"], category="Desserts")),
+    ],
+)
+def test_classify_answerable_questions(classifier, user_message, intent):
+    assert classifier.classify(user_message) == intent
+
+
+@pytest.mark.parametrize(
+    "user_message",
+    [
+        "What is not vegan?",
+        "Do you have anything that is not vegetarian?",
+        "Which desserts are not gluten free?",
+        "Is there anything vegan that isn't a dessert?",
+        "Any vegetarian starters without cheese?",
+        "What's vegan other than the curry?",
+        "Show me the vegan menu except desserts",
+        "Is there anything vegan in the burger?",
+        "Is the risotto vegetarian?",
+        "I'd like the vegan apple crumble",
+        "Yes please",
+    ],
+)
+def test_classify_leaves_message_to_model(classifier, user_message):
+    assert classifier.classify(user_message) is None
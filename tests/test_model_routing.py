@@ -0,0 +1,40 @@
+from ai_framework_demo.llm import LLMResponse
+from ai_framework_demo.model_routing import MenuRoutedAgentRunner, ModelRouter, ModelRoutes, classify_turn
+from ai_framework_demo.services import MenuService
+
+TENANT_MENU_SERVICE = MenuService(menu={"Mains": ["Pierogi with Sour Cream (V)"]})
+
+
+class RoutingAgentRunner:
+    """Fake agent which records the models its requests were routed to"""
+
+    def __init__(self, router: ModelRouter):
+        self.router = router
+        self.routed: list[list[str]] = []
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        self.routed.append(self.router.route(user_message))
+        return LLMResponse(message="Enjoy!", end_conversation=False)
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        return self.make_request(user_message)
+
+
+def test_classify_turn_with_items_of_menu():
+    assert classify_turn("How are the pierogi?") == "simple"
+    assert classify_turn("How are the pierogi?", TENANT_MENU_SERVICE.get_index()) == "order"
+    assert classify_turn("How is the calamari?") == "order"
+    assert classify_turn("How is the calamari?", TENANT_MENU_SERVICE.get_index()) == "simple"
+
+
+async def test_turns_are_routed_with_menu_of_runner():
+    router = ModelRouter(ModelRoutes(primary="test:strong", cheap="test:cheap"))
+    runner = RoutingAgentRunner(router)
+    menu_routed_runner = MenuRoutedAgentRunner(runner, TENANT_MENU_SERVICE)  # type: ignore[arg-type]
+
+    menu_routed_runner.make_request("How are the pierogi?")
+    await menu_routed_runner.make_request_async("How is the calamari?")
+    # Outside of the runner, turns are classified with the default menu
+    runner.make_request("How are the pierogi?")
+
+    assert runner.routed == [["test:strong"], ["test:cheap", "test:strong"], ["test:cheap", "test:strong"]]
@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import dataclasses
+import uuid
+
+import pytest
+
+from ai_framework_demo.llm import LLMResponse, PrefetchedToolCall
+from ai_framework_demo.resilience import CircuitBreaker, CircuitOpenError, ResilienceConfig, ResilientCaller
+from ai_framework_demo.run_agent import AgentRunner, ResilientAgentRunner
+from ai_framework_demo.services import MenuService, OrderService
+
+CONFIG = ResilienceConfig(max_retries=2, retry_backoff=0, turn_retries=1, circuit_failures=3, circuit_reset=30)
+
+
+class FailingRequest:
+    """Fake model request which fails with the given errors before succeeding"""
+
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "response"
+
+    async def call_async(self) -> str:
+        return self()
+
+
+class FakeAgentRunner(AgentRunner):
+    """Fake agent which fails the first turns with the given errors, optionally creating an order before failing"""
+
+    def __init__(self, menu_service: MenuService, order_service: OrderService, args: argparse.Namespace):
+        self.order_service = order_service
+        self.args = args
+        self.turn_usage = []
+        self.discarded_turns: list[str] = []
+        self.requests = 0
+
+    def make_request(self, user_message: str) -> LLMResponse:
+        self.requests += 1
+        if self.args.errors:
+            if self.args.create_order:
+                self.order_service.create_order(self.args.table_number, ["Classic Tiramisu"])
+            raise self.args.errors.pop(0)
+        return LLMResponse(message="Enjoy!", end_conversation=False)
+
+    async def make_request_async(self, user_message: str) -> LLMResponse:
+        return self.make_request(user_message)
+
+    def discard_failed_turn(self, user_message: str) -> None:
+        self.discarded_turns.append(user_message)
+
+    def record_turn(self, user_message: str, response: LLMResponse) -> None:
+        pass
+
+    def add_tool_results(self, tool_calls: list[PrefetchedToolCall]) -> None:
+        pass
+
+    def dump_history(self) -> tuple[bool, bytes]:
+        return False, b""
+
+    def load_history(self, chunks: list[bytes]) -> None:
+        pass
+
+
+def build_caller(config: ResilienceConfig = CONFIG) -> ResilientCaller:
+    # A new API key for each caller, so it doesn't share the circuit breaker of other tests
+    return ResilientCaller("test:model", str(uuid.uuid4()), config)
+
+
+def build_runner(*errors: Exception, create_order: bool = False) -> tuple[ResilientAgentRunner, FakeAgentRunner]:
+    order_service = OrderService()
+    args = argparse.Namespace(table_number=1, errors=list(errors), create_order=create_order)
+    runner = FakeAgentRunner(MenuService(), order_service, args)
+    return ResilientAgentRunner(runner, order_service, 1, CONFIG), runner
+
+
+async def test_call_retries_transient_errors():
+    request = FailingRequest(ConnectionError(), TimeoutError())
+
+    assert await build_caller().call(request.call_async) == "response"
+    assert request.calls == 3
+
+
+def test_call_sync_raises_once_retries_are_exhausted():
+    request = FailingRequest(*(ConnectionError() for _ in range(3)))
+
+    with pytest.raises(ConnectionError):
+        build_caller().call_sync(request)
+    assert request.calls == 3
+
+
+def test_call_sync_does_not_retry_permanent_errors():
+    request = FailingRequest(ValueError())
+
+    with pytest.raises(ValueError):
+        build_caller().call_sync(request)
+    assert request.calls == 1
+
+
+def test_call_sync_fails_fast_once_circuit_is_open():
+    caller = build_caller()
+    with pytest.raises(ConnectionError):
+        caller.call_sync(FailingRequest(*(ConnectionError() for _ in range(3))))
+
+    request = FailingRequest()
+    with pytest.raises(CircuitOpenError):
+        caller.call_sync(request)
+    assert request.calls == 0
+
+
+def test_circuit_breaker_half_open_trial_closes_circuit():
+    breaker = CircuitBreaker("test", failures=2, reset=30)
+    breaker.record_failure()
+    breaker.before_request()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    assert breaker.opened_at is not None
+    breaker.opened_at -= breaker.reset
+    breaker.before_request()
+    # Only a single trial request is let through while the circuit is half-open
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    breaker.record_success()
+    breaker.before_request()
+    assert breaker.opened_at is None
+
+
+def test_circuit_breaker_half_open_trial_reopens_circuit():
+    breaker = CircuitBreaker("test", failures=2, reset=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.opened_at is not None
+    breaker.opened_at -= breaker.reset
+    breaker.before_request()
+
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    assert not breaker.trial_in_progress
+
+
+def test_call_sync_trial_which_fails_with_permanent_error_reopens_circuit():
+    caller = build_caller(dataclasses.replace(CONFIG, max_retries=0, circuit_failures=1))
+    breaker = caller.guard.circuit_breaker
+    with pytest.raises(TimeoutError):
+        caller.call_sync(FailingRequest(TimeoutError()))
+
+    assert breaker.opened_at is not None
+    breaker.opened_at -= breaker.reset
+    with pytest.raises(ValueError):
+        caller.call_sync(FailingRequest(ValueError()))
+    assert not breaker.trial_in_progress
+    with pytest.raises(CircuitOpenError):
+        caller.call_sync(FailingRequest())
+
+    breaker.opened_at -= breaker.reset
+    assert caller.call_sync(FailingRequest()) == "response"
+    assert breaker.opened_at is None
+
+
+async def test_cancelled_trial_reopens_circuit():
+    caller = build_caller(dataclasses.replace(CONFIG, max_retries=0, circuit_failures=1))
+    breaker = caller.guard.circuit_breaker
+    with pytest.raises(TimeoutError):
+        await caller.call(FailingRequest(TimeoutError()).call_async)
+
+    assert breaker.opened_at is not None
+    breaker.opened_at -= breaker.reset
+    trial = asyncio.create_task(caller.call(asyncio.Event().wait))
+    await asyncio.sleep(0)
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    assert not breaker.trial_in_progress
+
+    breaker.opened_at -= breaker.reset
+    assert await caller.call(FailingRequest().call_async) == "response"
+
+
+class ConcurrentRequest:
+    """Fake model request which waits for the test to finish it, recording the most requests in flight at once"""
+
+    def __init__(self):
+        self.finished = asyncio.Event()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self) -> str:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await self.finished.wait()
+        finally:
+            self.in_flight -= 1
+        return "response"
+
+    def call_sync(self) -> str:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.in_flight -= 1
+        return "response"
+
+
+async def test_call_caps_requests_in_flight_with_provider():
+    config, api_key = dataclasses.replace(CONFIG, max_concurrent_requests=2), str(uuid.uuid4())
+    caller = ResilientCaller("test:model", api_key, config)
+    request = ConcurrentRequest()
+
+    calls = [asyncio.create_task(caller.call(request)) for _ in range(3)]
+    # Requests for other models of the provider share its cap, including sync requests from other threads
+    other_model_caller = ResilientCaller("test:other_model", api_key, config)
+    sync_call = asyncio.create_task(asyncio.to_thread(other_model_caller.call_sync, request.call_sync))
+    await asyncio.sleep(0.01)
+    assert request.in_flight == 2
+    assert not sync_call.done()
+
+    request.finished.set()
+    assert await asyncio.gather(*calls, sync_call) == ["response"] * 4
+    assert request.max_in_flight == 2
+    assert caller.guard.concurrency_limiter is not None
+    assert caller.guard.concurrency_limiter.in_flight == 0
+
+
+async def test_cancelled_waiting_call_passes_on_its_slot():
+    caller = build_caller(dataclasses.replace(CONFIG, max_concurrent_requests=1))
+    request = ConcurrentRequest()
+    first_call = asyncio.create_task(caller.call(request))
+    waiting_call = asyncio.create_task(caller.call(request))
+    await asyncio.sleep(0)
+    waiting_call.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting_call
+
+    request.finished.set()
+    assert await first_call == "response"
+    assert await caller.call(request) == "response"
+    assert caller.guard.concurrency_limiter is not None
+    assert caller.guard.concurrency_limiter.in_flight == 0
+
+
+def test_turn_is_retried_after_transient_error():
+    resilient_runner, runner = build_runner(ConnectionError())
+
+    assert resilient_runner.make_request("A tiramisu please").message == "Enjoy!"
+    assert runner.requests == 2
+    assert runner.discarded_turns == ["A tiramisu please"]
+
+
+async def test_turn_is_not_retried_after_creating_order():
+    resilient_runner, runner = build_runner(ConnectionError(), create_order=True)
+
+    with pytest.raises(ConnectionError):
+        await resilient_runner.make_request_async("A tiramisu please")
+    assert runner.requests == 1
+    assert runner.discarded_turns == []
+    assert len(runner.order_service.get_orders(table_number=1)) == 1
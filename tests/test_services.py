@@ -0,0 +1,92 @@
+import asyncio
+from collections.abc import Iterator
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+from ai_framework_demo.services import DEFAULT_MENU, MenuService, Order, OrderService, SQLiteOrderService
+
+
+def test_get_menu_returns_copy():
+    menu = MenuService().get_menu()
+    menu["Desserts"].append("Sticky Toffee Pudding")
+    menu["Drinks"] = ["Espresso"]
+
+    assert MenuService().get_menu() == DEFAULT_MENU
+    assert "Sticky Toffee Pudding" not in DEFAULT_MENU["Desserts"]
+
+
+def test_menu_index_is_not_aliased_to_given_menu():
+    menu = {"Desserts": ["Classic Tiramisu"]}
+    menu_service = MenuService(menu=menu)
+    menu["Desserts"].append("Vegan Apple Crumble (VG)")
+
+    assert menu_service.get_menu() == {"Desserts": ["Classic Tiramisu"]}
+    assert menu_service.search_menu(tags=["VG"]) == {}
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def order_service(request, tmp_path) -> Iterator[OrderService]:
+    if request.param == "memory":
+        yield OrderService()
+    else:
+        order_service = SQLiteOrderService(tmp_path / "orders.db")
+        yield order_service
+        order_service.close()
+
+
+def test_create_order_with_duplicate_idempotency_key(order_service):
+    order = order_service.create_order(1, ["Classic Tiramisu"], idempotency_key="turn-1")
+    duplicate = order_service.create_order(1, ["Vegan Apple Crumble (VG)"], idempotency_key="turn-1")
+
+    assert duplicate == order
+    assert order_service.get_orders(table_number=1) == [order]
+
+
+async def test_create_order_async_with_duplicate_idempotency_keys_in_batch(order_service):
+    orders = await asyncio.gather(
+        *(order_service.create_order_async(1, [f"Item {index}"], idempotency_key="turn-1") for index in range(3))
+    )
+
+    assert orders[1:] == orders[:1] * 2
+    assert order_service.get_orders(table_number=1) == orders[:1]
+
+
+def test_get_orders_since(order_service):
+    start = datetime.now(UTC)
+    order_service.restore_orders(
+        [Order(menu_items=["Classic Tiramisu"], table_number=1, created_at=start - timedelta(hours=1))]
+    )
+    orders = [order_service.create_order(2, ["Espresso"]), order_service.create_order(1, ["Vegan Apple Crumble (VG)"])]
+
+    assert order_service.get_orders(table_number=1, since=start) == orders[1:]
+    assert order_service.get_orders(since=start) == orders
+    assert len(order_service.get_orders(table_number=1)) == 2
+
+
+async def test_aclose_writes_queued_orders(tmp_path):
+    order_service = SQLiteOrderService(tmp_path / "orders.db", batch_interval=0.05)
+    tasks = [asyncio.create_task(order_service.create_order_async(1, [f"Item {index}"])) for index in range(3)]
+    await asyncio.sleep(0)
+    await order_service.aclose()
+
+    assert all(task.done() for task in tasks)
+    order_service = SQLiteOrderService(tmp_path / "orders.db")
+    assert [order.menu_items for order in order_service.get_orders(table_number=1)] == [
+        ["Item 0"],
+        ["Item 1"],
+        ["Item 2"],
+    ]
+    order_service.close()
+
+
+# Closed before the writer task has started, and while it is waiting to write a batch
+@pytest.mark.parametrize("delay", [0, 0.01])
+async def test_close_fails_queued_orders(tmp_path, delay):
+    order_service = SQLiteOrderService(tmp_path / "orders.db", batch_interval=0.05)
+    tasks = [asyncio.create_task(order_service.create_order_async(1, [f"Item {index}"])) for index in range(3)]
+    await asyncio.sleep(delay)
+    order_service.close()
+
+    results = await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), timeout=1)
+    assert all(isinstance(result, RuntimeError) for result in results)
@@ -0,0 +1,12 @@
+from ai_framework_demo.bench.startup import STARTUP_BUDGET_MS, get_outdated_model_names, measure_startup
+
+
+def test_cli_startup_is_within_budget():
+    duration, heavy_modules = measure_startup(runs=3)
+
+    assert heavy_modules == []
+    assert duration * 1000 <= STARTUP_BUDGET_MS
+
+
+def test_known_model_names_are_up_to_date():
+    assert get_outdated_model_names() == set()
@@ -0,0 +1,77 @@
+import argparse
+
+import pytest
+
+from ai_framework_demo.bench.__main__ import RUNNERS
+from ai_framework_demo.langchain.memory import LangchainMessageAdapter
+from ai_framework_demo.langchain.tools import to_prefetched_tool_messages
+from ai_framework_demo.llm import PrefetchedToolCall
+from ai_framework_demo.scripted import (
+    GREETING_MESSAGE,
+    SCRIPTED_CONVERSATIONS,
+    ScriptedConversation,
+    ScriptedToolCall,
+    ScriptedTurn,
+    respond,
+)
+from ai_framework_demo.services import MenuService, OrderService
+
+# The model orders the same dish twice in one response, which must create two orders
+ORDER_TWICE = ScriptedConversation(
+    name="test_order_twice",
+    turns=[
+        ScriptedTurn(GREETING_MESSAGE, [respond("Welcome!")]),
+        ScriptedTurn(
+            "Two tiramisus please, on separate bills",
+            [
+                [
+                    ScriptedToolCall("create_order", {"table_number": 3, "order_items": ["Classic Tiramisu"]}),
+                    ScriptedToolCall("create_order", {"table_number": 3, "order_items": ["Classic Tiramisu"]}),
+                ],
+                respond("Two tiramisus are on their way!", end_conversation=True),
+            ],
+        ),
+    ],
+)
+SCRIPTED_CONVERSATIONS[ORDER_TWICE.name] = ORDER_TWICE
+
+
+def build_runner(runner_name: str, order_service: OrderService):
+    args = argparse.Namespace(
+        model=f"scripted:{ORDER_TWICE.name}", api_key=None, restaurant_name="Le Bistro", table_number=3
+    )
+    return RUNNERS[runner_name](MenuService(), order_service, args)
+
+
+@pytest.mark.parametrize("runner_name", RUNNERS)
+def test_identical_tool_calls_create_separate_orders(runner_name):
+    order_service = OrderService()
+    runner = build_runner(runner_name, order_service)
+    for turn in ORDER_TWICE.turns:
+        runner.make_request(turn.user_message)
+
+    orders = order_service.get_orders(table_number=3)
+    assert len(orders) == 2
+    assert orders[0].idempotency_key != orders[1].idempotency_key
+    assert all(order.idempotency_key and order.idempotency_key.startswith("3:") for order in orders)
+
+
+@pytest.mark.parametrize("runner_name", RUNNERS)
+async def test_identical_tool_calls_create_separate_orders_async(runner_name):
+    order_service = OrderService()
+    runner = build_runner(runner_name, order_service)
+    for turn in ORDER_TWICE.turns:
+        await runner.make_request_async(turn.user_message)
+
+    orders = order_service.get_orders(table_number=3)
+    assert len(orders) == 2
+    assert orders[0].idempotency_key != orders[1].idempotency_key
+
+
+def test_prefetched_tool_messages_are_named_after_their_tool():
+    messages = to_prefetched_tool_messages(
+        [PrefetchedToolCall(tool_call_id="prefetched_1_0", tool_name="get_menu", args={}, result={"Desserts": []})]
+    )
+
+    adapter = LangchainMessageAdapter()
+    assert [name for message in messages for name in adapter.tool_return_names(message)] == ["get_menu"]